@@ -1,16 +1,107 @@
 from __future__ import annotations
 
+import random
+import threading
 import time
 
 
 class Backoff:
-    def __init__(self, timeout_mins: float, backoff_secs: float):
+    """
+    sleep between retries until timeout
+    with factor > 1 delay grows exponentially up to max_backoff_secs, jitter
+    randomizes every delay by +-jitter fraction so that many waiters do not
+    wake up at the same moment
+    """
+
+    def __init__(
+        self,
+        timeout_mins: float,
+        backoff_secs: float,
+        factor: float = 1.0,
+        max_backoff_secs: float | None = None,
+        jitter: float = 0.0,
+    ):
         self.start_time = time.time()
         self.timeout_mins = timeout_mins
         self.backoff_secs = backoff_secs
+        self.factor = factor
+        self.max_backoff_secs = max_backoff_secs
+        self.jitter = jitter
 
     def timeout(self):
         return time.time() - self.start_time > self.timeout_mins * 60
 
+    def remaining(self) -> float:
+        return max(0.0, self.start_time + self.timeout_mins * 60 - time.time())
+
+    def delay(self) -> float:
+        delay = self.backoff_secs
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        self.backoff_secs *= self.factor
+        if self.max_backoff_secs is not None:
+            self.backoff_secs = min(self.backoff_secs, self.max_backoff_secs)
+        # do not oversleep deadline
+        return min(delay, self.remaining())
+
     def backoff(self):
-        time.sleep(self.backoff_secs)
+        time.sleep(self.delay())
+
+
+class TokenBucket:
+    """
+    token bucket rate limiter: allows bursts up to capacity messages and
+    rate messages per second on average
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def available(self, tokens: float = 1) -> bool:
+        self.refill()
+        return self.tokens >= tokens
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        if not self.available(tokens):
+            return False
+        self.tokens -= tokens
+        return True
+
+    def penalize(self, secs: float):
+        """
+        drain bucket and forbid refilling for secs seconds
+        (e.g. after server returned 429 Too Many Requests)
+        """
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + secs)
+
+
+class Stagger:
+    """
+    space out actions from several threads so that they start at least
+    interval_secs apart from each other
+    """
+
+    def __init__(self, interval_secs: float):
+        self.interval_secs = interval_secs
+        self.next_start = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval_secs
+        time.sleep(start - now)
@@ -2,15 +2,20 @@ import io
 import json
 import os
 import pathlib
+import select
 import shlex
+import shutil
+import signal
 import subprocess
 import time
-import yaml
 
 from cprint import *
-from Backoff import Backoff
+from defs import *
+from Trace import span
 
 MINUTE_SECS = 60
+# ioctl to share extents of source file with destination file
+FICLONE = 0x40049409
 
 
 class Cmd:
@@ -41,6 +46,9 @@ class Cmd:
 
     @classmethod
     def jload(cls, text: str) -> dict:
+        # yaml is slow to import and used only to parse relaxed json configs
+        import yaml
+
         return yaml.safe_load(io.StringIO(text))
 
     @classmethod
@@ -52,41 +60,270 @@ class Cmd:
         if isinstance(cmd, str):
             cmd = shlex.split(cmd)
 
-        stdout = subprocess.run(cmd, text=True, capture_output=True, check=True).stdout
+        with span(str(cmd[0]), "cmd", argv=cmd):
+            stdout = subprocess.run(
+                cmd, text=True, capture_output=True, check=True
+            ).stdout
         if strip:
             stdout = stdout.strip()
         return stdout
 
     @classmethod
-    def cmd(cls, cmd: str | list, check=True, timeout_mins=1, **kwargs) -> int:
+    def cmd(
+        cls, cmd: str | list, check=True, timeout_mins: float | None = 1, **kwargs
+    ) -> int:
         if isinstance(cmd, str):
             cmd = shlex.split(cmd)
-        cprint("green", f"> {' '.join(cmd)}")
+        cls.echo(*cmd)
+        timeout = timeout_mins * MINUTE_SECS if timeout_mins is not None else None
 
         try:
-            proc = subprocess.run(
-                cmd,
-                text=True,
-                check=check,
-                timeout=timeout_mins * MINUTE_SECS,
-                **kwargs,
-            )
+            with span(str(cmd[0]), "cmd", argv=cmd) as attrs:
+                proc = subprocess.run(
+                    cmd,
+                    text=True,
+                    check=check,
+                    timeout=timeout,
+                    **kwargs,
+                )
+                attrs["returncode"] = proc.returncode
         except subprocess.TimeoutExpired:
             FAIL(f"timed out after {timeout_mins}m running command {cmd}")
             raise
         return proc.returncode
 
+    @classmethod
+    def echo(cls, *argv):
+        """
+        log executed command, including ones done in-process
+        """
+        argv = [str(arg) for arg in argv]
+        emit("CMD", *argv)
+        cprint("green", f"> {shlex.join(argv)}")
+
+    @classmethod
+    def rm(cls, *paths: str, recursive=False, force=False):
+        """
+        in-process equivalent of rm [-r] [-f]
+        """
+        flags = ("r" if recursive else "") + ("f" if force else "")
+        cls.echo("rm", *([f"-{flags}"] if flags else []), *paths)
+
+        for path in paths:
+            p = pathlib.Path(path)
+            try:
+                if recursive and p.is_dir() and not p.is_symlink():
+                    cls.rmtree(p)
+                else:
+                    p.unlink()
+            except FileNotFoundError:
+                if not force:
+                    FAIL(f"cannot remove {path}: no such file or directory")
+                    raise
+
+    @classmethod
+    def rmtree(cls, path: str | pathlib.Path, jobs=Fs.RM_JOBS):
+        """
+        remove directory tree, unlinking files of large trees (worlds with
+        thousands of region and data files) on several threads
+        """
+        files = []
+        dirs = []
+        for root, dirnames, filenames in os.walk(path):
+            dirs.append(root)
+            files.extend(os.path.join(root, name) for name in filenames)
+            # symlinks to directories are not followed by os.walk
+            for name in dirnames:
+                if os.path.islink(os.path.join(root, name)):
+                    files.append(os.path.join(root, name))
+
+        if len(files) < Fs.RM_PARALLEL_MIN_FILES:
+            shutil.rmtree(path)
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(os.unlink, files))
+        # os.walk lists parents first, remove children first
+        for d in reversed(dirs):
+            os.rmdir(d)
+
+    @classmethod
+    def reflink(cls, src: str, dst: str) -> bool:
+        """
+        make copy-on-write clone of file (btrfs, xfs), returns False if
+        filesystem does not support it
+        """
+        import fcntl
+
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except OSError:
+                return False
+        shutil.copystat(src, dst)
+        return True
+
+    @classmethod
+    def clonetree(
+        cls,
+        src: str,
+        dst: str,
+        skip: tuple[str, ...] = (),
+        hardlink: tuple[str, ...] = (),
+        jobs=Fs.COPY_JOBS,
+        throttle=None,
+        update=False,
+    ) -> dict[str, int]:
+        """
+        copy directory tree as cheap as filesystem allows: reflink every file
+        if supported, otherwise hardlink files matching hardlink patterns
+        (which are never modified in place) and copy the rest on several
+        threads
+        files which paths relative to src match skip patterns are not copied,
+        copies are paced by throttle if given
+        with update=True files of previous copy which have the same size and
+        mtime as in src are kept
+        returns number of reflinked, hardlinked, copied and kept files and bytes
+        """
+        import fnmatch
+        from concurrent.futures import ThreadPoolExecutor
+
+        cls.echo("cp", "-a", "--reflink=auto", src, dst)
+        matches = lambda rel, patterns: any(fnmatch.fnmatch(rel, p) for p in patterns)
+        files = []
+        for root, dirnames, filenames in os.walk(src, followlinks=True):
+            rel_root = os.path.relpath(root, src)
+            dirnames[:] = [
+                d
+                for d in dirnames
+                if not matches(os.path.normpath(os.path.join(rel_root, d)), skip)
+            ]
+            os.makedirs(os.path.join(dst, rel_root), exist_ok=True)
+            for name in filenames:
+                rel = os.path.normpath(os.path.join(rel_root, name))
+                if not matches(rel, skip):
+                    files.append(rel)
+
+        stats = {"reflink": 0, "hardlink": 0, "copy": 0, "kept": 0, "bytes": 0}
+        reflink = True
+
+        def clone(rel: str) -> str:
+            nonlocal reflink
+            s, d = os.path.join(src, rel), os.path.join(dst, rel)
+            if update and os.path.lexists(d):
+                s_stat, d_stat = os.stat(s), os.lstat(d)
+                same_size = s_stat.st_size == d_stat.st_size
+                if same_size and s_stat.st_mtime_ns == d_stat.st_mtime_ns:
+                    return "kept"
+            # file left by interrupted attempt may be hardlink to source,
+            # it must not be truncated
+            if os.path.lexists(d):
+                os.unlink(d)
+            if reflink:
+                if cls.reflink(s, d):
+                    return "reflink"
+                reflink = False
+                os.unlink(d)
+            if matches(rel, hardlink):
+                try:
+                    os.link(s, d)
+                    return "hardlink"
+                except OSError:
+                    # e.g. destination is on other filesystem
+                    pass
+            if throttle is not None:
+                throttle.copy(s, d)
+            else:
+                shutil.copy2(s, d)
+            return "copy"
+
+        if update:
+            # files removed from src since previous copy
+            copied = set(files)
+            for root, _, filenames in os.walk(dst):
+                for name in filenames:
+                    path = os.path.join(root, name)
+                    if os.path.relpath(path, dst) not in copied:
+                        os.unlink(path)
+
+        # probe reflink support on first file, so other threads do not waste
+        # time trying it
+        if files:
+            stats[clone(files[0])] += 1
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for how in pool.map(clone, files[1:]):
+                stats[how] += 1
+        stats["bytes"] = sum(os.path.getsize(os.path.join(dst, f)) for f in files)
+        return stats
+
+    @classmethod
+    def mkdir(cls, path: str):
+        cls.echo("mkdir", "-p", path)
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def mkfifo(cls, path: str):
+        cls.echo("mkfifo", path)
+        os.mkfifo(path)
+
+    @classmethod
+    def touch(cls, path: str):
+        cls.echo("touch", path)
+        pathlib.Path(path).touch()
+
+    @classmethod
+    def kill(cls, pid: int, sig=signal.SIGTERM) -> bool:
+        """
+        send signal to process, returns False if there is no such process
+        """
+        if sig == signal.SIGTERM:
+            cls.echo("kill", pid)
+        else:
+            cls.echo("kill", f"-{signal.Signals(sig).name[3:]}", pid)
+        try:
+            os.kill(int(pid), sig)
+        except ProcessLookupError:
+            return False
+        return True
+
+    @classmethod
+    def builtin(cls, argv: str | list[str]):
+        """
+        run command in-process if it is one of simple filesystem commands,
+        used for compensations recorded in Saga journal
+        """
+        if isinstance(argv, str):
+            argv = shlex.split(argv)
+        match argv:
+            case ["rm", "-rf", *paths]:
+                cls.rm(*paths, recursive=True, force=True)
+            case ["rm", "-f", *paths]:
+                cls.rm(*paths, force=True)
+            case _:
+                cls.cmd(argv, check=False)
+
     @classmethod
     def wget(cls, url: str, out: str, timeout_mins=10, backoff_secs=10):
+        """
+        download url to out through out.part file
+        partial file is kept on failure, so next attempt continues downloading
+        from where previous one stopped
+        """
         if pathlib.Path(out).exists():
             FAIL(f"output path {out} exists")
             raise MCFetchError()
 
+        part = f"{out}.part"
         timeout = timeout_mins * MINUTE_SECS
         time_start = time.time()
         prev_file_size = 0
+        if pathlib.Path(part).exists():
+            prev_file_size = pathlib.Path(part).stat().st_size
+            INFO(f"resuming partial download {part} from {prev_file_size} bytes")
 
-        proc = subprocess.Popen(["wget", url, "-O", out, "--verbose"])
+        proc = subprocess.Popen(["wget", "--continue", url, "-O", part, "--verbose"])
         try:
             while True:
                 try:
@@ -98,14 +335,13 @@ class Cmd:
                         break
 
                 except subprocess.TimeoutExpired:
-                    if not pathlib.Path(out).exists():
+                    if not pathlib.Path(part).exists():
                         FAIL(f"failed to connect to url: {url}")
                         raise MCFetchError()
 
-                    file_size = pathlib.Path(out).stat().st_size
+                    file_size = pathlib.Path(part).stat().st_size
                     if file_size == prev_file_size:
                         FAIL(f"file downloading is stuck, aborting")
-                        proc.kill()
                         raise MCFetchError()
                     prev_file_size = file_size
 
@@ -113,23 +349,78 @@ class Cmd:
                         FAIL(f"downloading timed out after {timeout} seconds")
                         raise MCFetchError()
 
-        except Exception:
-            Cmd.cmd(f"rm -f {out}")
+        except BaseException:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            part_path = pathlib.Path(part)
+            if part_path.exists() and part_path.stat().st_size > 0:
+                WARN(f"partial download kept in {part}, next attempt will resume it")
+            else:
+                part_path.unlink(missing_ok=True)
             raise
 
+        os.replace(part, out)
+
     @classmethod
-    def waitpid(cls, pid: int, timeout_mins=10, backoff_secs=1):
-        bo = Backoff(timeout_mins, backoff_secs)
-        while True:
+    def waitpid(cls, pid: int, timeout_mins=10):
+        if pid not in cls.waitpids([pid], timeout_mins * MINUTE_SECS):
+            FAIL(f"timed out while waiting for pid {pid} after {timeout_mins} minutes")
+            raise MCSystemError()
+
+    @classmethod
+    def waitpids(
+        cls, pids: list[int], timeout_secs: float, backoff_secs=0.5
+    ) -> dict[int, float]:
+        """
+        wait for several processes (not necessarily our children) at once
+        returns mapping from pid to time.monotonic() it was seen exited,
+        processes which did not exit before timeout are not in result
+        uses pidfd to wake up exactly on exit, polls kill(pid, 0) if pidfd is
+        not supported
+        """
+        exited: dict[int, float] = {}
+        deadline = time.monotonic() + timeout_secs
+        poller = select.poll()
+        pidfds: dict[int, int] = {}
+        polled: list[int] = []
+
+        for pid in pids:
             try:
-                os.kill(pid, 0)
+                fd = os.pidfd_open(pid)
             except ProcessLookupError:
-                break
-            if bo.timeout():
-                FAIL(
-                    f"timed out while waiting for pid {pid} after {timeout_mins} minutes"
-                )
-            bo.backoff()
+                exited[pid] = time.monotonic()
+                continue
+            except (AttributeError, OSError):
+                polled.append(pid)
+                continue
+            pidfds[fd] = pid
+            poller.register(fd, select.POLLIN)
+
+        try:
+            while len(exited) < len(pids):
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+
+                wait_secs = deadline - now
+                if polled:
+                    wait_secs = min(wait_secs, backoff_secs)
+                for fd, _ in poller.poll(wait_secs * 1000):
+                    exited[pidfds[fd]] = time.monotonic()
+                    poller.unregister(fd)
+
+                for pid in list(polled):
+                    try:
+                        os.kill(pid, 0)
+                    except ProcessLookupError:
+                        exited[pid] = time.monotonic()
+                        polled.remove(pid)
+        finally:
+            for fd in pidfds:
+                os.close(fd)
+
+        return exited
 
     @classmethod
     def git_clone(cls, url: str, dst="", timeout_mins=10):
@@ -160,19 +451,19 @@ class Cmd:
             raise
 
     @classmethod
-    def wait_for_file(cls, fname: str, timeout_mins=1, backoff_secs=0.2):
-        bo = Backoff(timeout_mins, backoff_secs)
-        while not pathlib.Path(fname).exists():
-            if bo.timeout():
-                FAIL(f"waiting for file {fname} timed out after {timeout_mins} minutes")
-                raise MCFetchError()
-            bo.backoff()
+    def wait_for_file(cls, fname: str, timeout_mins=1):
+        from Watch import Watcher
+
+        exists = lambda: pathlib.Path(fname).exists()
+        if not Watcher.shared().wait(exists, [fname], timeout_mins * MINUTE_SECS):
+            FAIL(f"waiting for file {fname} timed out after {timeout_mins} minutes")
+            raise MCFetchError()
 
     @classmethod
-    def wait_for_line(cls, fname: str, line: str, timeout_mins=5, backoff_secs=1):
-        bo = Backoff(timeout_mins, backoff_secs)
-        while line not in Cmd.fread(fname):
-            if bo.timeout():
-                FAIL(f"waiting for line {line} timed out after {timeout_mins} minutes")
-                raise MCFetchError()
-            bo.backoff()
+    def wait_for_line(cls, fname: str, line: str, timeout_mins=5):
+        from Watch import Watcher
+
+        found = lambda: pathlib.Path(fname).exists() and line in Cmd.fread(fname)
+        if not Watcher.shared().wait(found, [fname], timeout_mins * MINUTE_SECS):
+            FAIL(f"waiting for line {line} timed out after {timeout_mins} minutes")
+            raise MCFetchError()
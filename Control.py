@@ -0,0 +1,295 @@
+"""
+control daemon protocol, newline delimited json over unix socket:
+ - client sends {"argv": [...]} with main.py arguments
+ - daemon streams {"kind": ..., "text": ...} for every printed message
+ - daemon finishes with {"ok": bool, "value": ..., "error": ...}
+
+host agent speaks the same protocol over tcp, with authentication first:
+ - agent sends {"challenge": <random hex>}
+ - client adds "mac" to request: hex hmac-sha256 of challenge and argv with
+   key shared by agent and manager, so key is never sent and captured
+   request cannot be replayed
+"""
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import signal
+import socket
+import socketserver
+import threading
+from contextlib import nullcontext
+
+from cprint import *
+from defs import *
+
+
+def replay(kind: str, text: str):
+    """
+    print message captured in control daemon same way it was printed there
+    """
+    match kind:
+        case "LOG":
+            log(text)
+        case "STEP":
+            cprint("yellow")
+            cprint("yellow", text)
+        case "CMD":
+            cprint("green", f"> {text}")
+        case "DBUG":
+            DEBUG(text)
+        case "INFO":
+            INFO(text)
+        case "OK":
+            OK(text)
+        case "WARN":
+            WARN(text)
+        case "FAIL":
+            FAIL(text)
+
+
+def forward(argv: list[str], path: str = Fname.SOCKET) -> bool:
+    """
+    send command to running control daemon and print it's output
+    returns False if there is no daemon, so caller should run command itself,
+    failed command raises MCError just like when it is run in process
+    """
+    if not os.path.exists(path):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # stale socket left by dead daemon
+        sock.close()
+        return False
+
+    with sock, sock.makefile("rwb") as f:
+        result = exchange(f, {"argv": argv})
+    if not result["ok"]:
+        raise MCError(result["error"])
+    return True
+
+
+def exchange(f, request: dict, on_event=replay) -> dict:
+    """
+    send request and pass streamed messages to on_event until final result
+    """
+    f.write(json.dumps(request).encode() + b"\n")
+    f.flush()
+    for line in f:
+        message = json.loads(line)
+        if "kind" in message:
+            on_event(message["kind"], message["text"])
+        else:
+            return message
+
+    FAIL("control daemon closed connection unexpectedly")
+    raise MCSystemError()
+
+
+def sign(key: bytes, challenge: str, argv: list[str]) -> str:
+    message = challenge.encode() + b"\n" + json.dumps(argv).encode()
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def send(self, message: dict):
+        with self.write_lock:
+            self.wfile.write(json.dumps(message, default=str).encode() + b"\n")
+            self.wfile.flush()
+
+    def read_request(self) -> dict | None:
+        return json.loads(self.rfile.readline())
+
+    def handle(self):
+        import main
+
+        self.write_lock = threading.Lock()
+        request = self.read_request()
+        if request is None:
+            return
+        argv = request["argv"]
+
+        try:
+            args = main.build_parser().parse_args(argv)
+        except SystemExit:
+            self.send({"ok": False, "error": f"invalid arguments: {argv}"})
+            return
+
+        def sink(kind: str, text: str):
+            try:
+                self.send({"kind": kind, "text": text})
+            except OSError:
+                # client went away, keep running operation to the end
+                pass
+
+        name = getattr(args, "name", None)
+        lock = self.server.lock(name) if name else nullcontext()
+        with lock, capture(sink):
+            try:
+                value = main.dispatch(args)
+            except MCError as e:
+                self.send({"ok": False, "error": str(e)})
+                return
+            except Exception as e:
+                self.send({"ok": False, "error": repr(e)})
+                raise
+
+        self.send({"ok": True, "value": value})
+
+
+class AgentHandler(ControlHandler):
+    def read_request(self) -> dict | None:
+        # peer is not authenticated yet, it may not hold the thread for long
+        # or make it buffer whatever it sends
+        self.request.settimeout(Agent.AUTH_TIMEOUT_SECS)
+        try:
+            challenge = secrets.token_hex(16)
+            self.send({"challenge": challenge})
+            line = self.rfile.readline(Agent.MAX_REQUEST + 1)
+            if len(line) > Agent.MAX_REQUEST:
+                raise ValueError("request is too long")
+            request = json.loads(line)
+            expected = sign(self.server.key, challenge, request["argv"])
+            if hmac.compare_digest(expected, str(request["mac"])):
+                self.request.settimeout(None)
+                return request
+        except (ValueError, KeyError, TypeError, OSError):
+            pass
+        finally:
+            self.server.unauthenticated.release()
+        WARN(f"rejected unauthenticated request from {self.client_address[0]}")
+        try:
+            self.send({"ok": False, "error": "authentication failed"})
+        except OSError:
+            pass
+        return None
+
+
+class Locks:
+    def init_locks(self):
+        self.locks: dict[str, threading.Lock] = {}
+        self.locks_lock = threading.Lock()
+
+    def lock(self, name: str) -> threading.Lock:
+        """
+        commands to the same server are serialized
+        """
+        with self.locks_lock:
+            if name not in self.locks:
+                self.locks[name] = threading.Lock()
+            return self.locks[name]
+
+
+class ControlServer(Locks, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, ControlHandler)
+        self.init_locks()
+
+
+class AgentServer(Locks, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple[str, int], key: bytes):
+        super().__init__(address, AgentHandler)
+        self.key = key
+        self.init_locks()
+        self.unauthenticated = threading.BoundedSemaphore(Agent.MAX_UNAUTHENTICATED)
+
+    def verify_request(self, request, client_address) -> bool:
+        """
+        refuse connections over limit of ones waiting for authentication,
+        before thread is started for them
+        """
+        if self.unauthenticated.acquire(blocking=False):
+            return True
+        WARN(f"too many unauthenticated connections, refusing {client_address[0]}")
+        return False
+
+
+def serve(path: str = Fname.SOCKET):
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            INFO(f"removing stale socket {path}")
+            os.unlink(path)
+        else:
+            FAIL(f"control daemon is already running on {path}")
+            raise MCInvalidOperationError()
+        finally:
+            probe.close()
+
+    # import everything now, so forwarded commands do not pay for it
+    import main
+    import Manager
+    from Scheduler import Scheduler
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    # systemd stops services with SIGTERM, remove socket in that case too
+    signal.signal(signal.SIGTERM, terminate)
+
+    with ControlServer(path) as server:
+        OK(f"control daemon listening on {path}")
+        scheduler = Scheduler(server)
+        scheduler.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            scheduler.stop()
+            os.unlink(path)
+
+
+def load_key(fname: str, create=False) -> bytes:
+    if not os.path.exists(fname):
+        if not create:
+            FAIL(f"agent key file {fname} not found")
+            raise MCNotFoundError()
+        INFO(f"generating agent key {fname}, copy it to manager host")
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    with open(fname) as f:
+        return f.read().strip().encode()
+
+
+def serve_agent(address: tuple[str, int], key_fname: str = Fname.AGENT_KEY):
+    """
+    run host agent: control daemon reachable over network, every request
+    must be signed with agent key
+    """
+    key = load_key(key_fname, create=True)
+
+    import main
+    import Manager
+    from Scheduler import Scheduler
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    with AgentServer(address, key) as server:
+        OK(f"host agent listening on {address[0]}:{address[1]} in {os.getcwd()}")
+        scheduler = Scheduler(server)
+        scheduler.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            scheduler.stop()
@@ -1,3 +1,4 @@
+import json
 import os
 import sys
 import subprocess
@@ -12,19 +13,37 @@ def daemon(
     cwd: str | None = None,
     pidfile="pid",
 ):
-    if os.fork() > 0:
-        return
+    """
+    start process detached from current one, it's pid is written to pidfile
 
-    try:
-        os.setsid()
-        os.umask(0)
+    caller is never forked: it may have other threads (control daemon, agent,
+    bulk operations), and forked copy of it could hang on locks they held.
+    fresh interpreter is started in new session instead, it forks the process
+    keeper and exits at once, so it is reaped here and leaves no zombie
+    """
+    spec = {
+        "args": [str(arg) for arg in args],
+        "stdout": stdout,
+        "stderr": stderr,
+        "stdin": stdin,
+        "cwd": cwd,
+        "pidfile": pidfile,
+    }
+    subprocess.run(
+        [sys.executable, __file__, json.dumps(spec)],
+        stdin=subprocess.DEVNULL,
+        start_new_session=True,
+        check=True,
+    )
 
-        if os.fork() > 0:
-            os._exit(0)
 
-        sys.stdout.flush()
-        sys.stderr.flush()
+def detach(args, stdout, stderr, stdin, cwd, pidfile):
+    os.umask(0)
+
+    if os.fork() > 0:
+        os._exit(0)
 
+    try:
         with open(stdout, "w") as so:
             os.dup2(so.fileno(), sys.stdout.fileno())
 
@@ -45,8 +64,11 @@ def daemon(
 
         proc = subprocess.Popen(args, close_fds=True)
 
-        with open(pidfile_resolved, "w") as pf:
+        # readers wait for pidfile to appear, it must never be seen empty
+        pidfile_tmp = f"{pidfile_resolved}.tmp"
+        with open(pidfile_tmp, "w") as pf:
             pf.write(str(proc.pid))
+        os.replace(pidfile_tmp, pidfile_resolved)
 
         proc.wait()
 
@@ -54,3 +76,7 @@ def daemon(
         pass
     finally:
         os._exit(0)
+
+
+if __name__ == "__main__":
+    detach(**json.loads(sys.argv[1]))
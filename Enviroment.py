@@ -1,9 +1,15 @@
+import fcntl
+import json
+import os
 import pathlib
+import re
+import shutil
+import zipfile
 from abc import ABC, abstractmethod
-from collections import OrderedDict
+from contextlib import contextmanager
 
 from Cmd import Cmd
-from Saga import Saga
+from Manifest import Fetcher, VersionManifest
 from cprint import *
 from defs import *
 
@@ -22,13 +28,19 @@ class IEnviroment(ABC):
         pass
 
     @abstractmethod
-    def list_versions(self, show_snapshots: bool):
+    def list_versions(self, show_snapshots: bool) -> list[str]:
         pass
 
     @abstractmethod
     def download_server(self, version: str) -> str:
         pass
 
+    def resolve_version(self, version: str) -> str:
+        """
+        exact version to create server with from version given by user
+        """
+        return version
+
     def _filter_version(self, version: str) -> bool:
         split = version.split(".")
         if len(split) not in (2, 3):
@@ -37,48 +49,43 @@ class IEnviroment(ABC):
 
 
 class VanillaEnviroment(IEnviroment):
-    def update_versions(self):
-        def convert() -> str:
-            d = OrderedDict()
-            for line in Cmd.freadlines("gist/minecraft-server-jar-downloads.md")[2:]:
-                _, version, url, _, _ = line.split("|")
-                url = url.strip()
-                version = version.strip()
-                if url.lower() == "not found":
-                    continue
-                d[version] = url
-
-            return Cmd.jdump(d, indent=4)
+    def __init__(self, manifest_url: str | None = None, fetcher=None):
+        # fetcher and url can point to local stand-in of manifest server
+        self.manifest = VersionManifest(Fname.VERSIONS_VANILLA, manifest_url, fetcher)
 
+    def update_versions(self):
         with STEP("updating vanilla version list"):
-            with Saga() as saga:
-                url = "https://gist.github.com/77a982a7503669c3e1acb0a0cf6127e9.git"
-
-                Cmd.git_clone(url, "gist", timeout_mins=1)
-                saga.defer(lambda: Cmd.cmd("rm -rf gist"))
-
-                saga.compensation(lambda: Cmd.cmd(f"rm -f {Fname.VERSIONS_VANILLA}"))
-                Cmd.fwrite(Fname.VERSIONS_VANILLA, convert())
+            self.manifest.load()
+            fetched, kept = self.manifest.update()
+            if fetched == kept == 0:
+                OK("version manifest did not change")
+                return
+            self.manifest.save()
+            INFO(f"{fetched} versions fetched, {kept} versions did not change")
 
     def check_update_versions(self):
         if not pathlib.Path(Fname.VERSIONS_VANILLA).exists():
             INFO(f"{Fname.VERSIONS_VANILLA} not found. updating vanilla versions")
             self.update_versions()
 
-    def list_versions(self, show_snapshots: bool):
+    def list_versions(self, show_snapshots: bool) -> list[str]:
         self.check_update_versions()
 
-        # parsing file directly instead of json lib to keep release order
-        versions = Cmd.fread(Fname.VERSIONS_VANILLA)
-        for line in reversed(versions.splitlines()[1:-1]):
-            v = line.split(":", maxsplit=1)[0].replace('"', "").strip()
+        # file keeps newest versions first, print them last
+        versions = self.manifest.load().versions
+        response = []
+        for v, record in reversed(versions.items()):
+            if record.get("url") is None:
+                continue
             if not show_snapshots and self._filter_version(v):
                 continue
             log(v)
+            response.append(v)
+        return response
 
     def download_server(self, version: str) -> str:
         folder = f"{Folder.SERVERS}/{LauncherType.VANILLA}"
-        Cmd.cmd(f"mkdir -p {folder}")
+        Cmd.mkdir(folder)
 
         core_fname = f"{folder}/{version}.jar"
         if pathlib.Path(core_fname).exists():
@@ -86,9 +93,9 @@ class VanillaEnviroment(IEnviroment):
             return core_fname
 
         self.check_update_versions()
-        versions = Cmd.jload(Cmd.fread(Fname.VERSIONS_VANILLA))
+        record = self.manifest.load().versions.get(version) or {}
 
-        url = versions.get(version)
+        url = record.get("url")
         if url is None:
             FAIL(f'version "{version}" not found. run list-versions command')
             raise MCNotFoundError()
@@ -97,40 +104,305 @@ class VanillaEnviroment(IEnviroment):
         INFO(f"url: {url}")
 
         Cmd.wget(url, core_fname)
+        if record.get("sha1") is not None:
+            sha1 = VersionManifest.sha1(core_fname)
+            if sha1 != record["sha1"]:
+                Cmd.rm(core_fname)
+                FAIL(f'sha1 of downloaded jar {sha1} is not {record["sha1"]}')
+                raise MCFetchError()
+            OK(f"sha1 checksum matches: {sha1}")
         return core_fname
 
 
-# class ForgeEnviroment(IEnviroment):
-#    def update_versions(self):
-#        cprint("yellow", "UPDATING FORGE VERSIONS")
-#        url = "https://files.minecraftforge.net/net/minecraftforge/forge/promotions_slim.json"
-#        versions_raw = Cmd.run(f"curl {url}")
-#        versions = Cmd.jload(versions_raw)
-#
-#        filtered = OrderedDict()
-#        for version in reversed(versions["promos"]):
-#            ver, _ = version.split("-")
-#            if self._filter_version(ver):
-#                continue
-#            if f"{version}-recommended" in versions:
-#                filtered[version] = f"{version}-recommended"
-#            else:
-#                filtered[version] = f"{version}-latest"
-#
-#        Cmd.fwrite("versions.forge.json", Cmd.jdump(filtered))
-#
-#    def list_versions(self, show_snapshots: bool):
-#        j = Cmd.jload(Cmd.fread("versions.forge.json"))
-#        print("\n".join(j.keys()))
-#
-#    def download_server(self, version: str) -> str:
-#        return ""
+class ForgeEnviroment(IEnviroment):
+    """
+    forge is installed once per forge version into cores/forge/<version>,
+    servers start from there with absolute library paths, so new server of
+    installed version costs nothing
+
+    installations share one cores/forge/libraries store (their libraries
+    folders are symlinks to it), so libraries common to several forge
+    versions are kept once. libraries listed by installer are downloaded in
+    parallel with sha1 check before installer runs, and vanilla server jar is
+    hardlinked from vanilla cores, installer finds them in place and only
+    runs it's processors
+
+    versions file format:
+        {
+            "promos": {"1.20.1-recommended": "47.2.0", ...},
+            "versions": {"1.20.1": ["1.20.1-47.3.0", ...], ...}
+        }
+    """
+
+    def __init__(self, fetcher=None):
+        self.promotions_url = (
+            os.environ.get(Env.FORGE_PROMOTIONS) or Forge.PROMOTIONS_URL
+        )
+        self.metadata_url = os.environ.get(Env.FORGE_METADATA) or Forge.METADATA_URL
+        self.maven_url = os.environ.get(Env.FORGE_MAVEN) or Forge.MAVEN_URL
+        self.fetcher = fetcher
+        self.folder = f"{Folder.SERVERS}/{LauncherType.FORGE}"
+        self.libraries = f"{self.folder}/{Forge.LIBRARIES}"
+
+    def fetcher_for(self, url: str) -> Fetcher:
+        return self.fetcher or Fetcher.for_url(url, Forge.TIMEOUT_SECS)
+
+    def get(self, url: str):
+        return self.fetcher_for(url).get(url)
+
+    def update_versions(self):
+        with STEP("updating forge version list"):
+            data = {
+                "promos": self.get(self.promotions_url).json()["promos"],
+                "versions": self.get(self.metadata_url).json(),
+            }
+            tmp_fname = f"{Fname.VERSIONS_FORGE}.tmp"
+            Cmd.fwrite(tmp_fname, Cmd.jdump(data, indent=4))
+            os.replace(tmp_fname, Fname.VERSIONS_FORGE)
+            builds = sum(len(v) for v in data["versions"].values())
+            INFO(
+                f'{builds} forge builds for {len(data["versions"])} minecraft versions'
+            )
+
+    def load(self) -> dict:
+        if not pathlib.Path(Fname.VERSIONS_FORGE).exists():
+            INFO(f"{Fname.VERSIONS_FORGE} not found. updating forge versions")
+            self.update_versions()
+        return Cmd.jload(Cmd.fread(Fname.VERSIONS_FORGE))
+
+    def list_versions(self, show_snapshots: bool) -> list[str]:
+        """
+        recommended and latest builds of every release, or all builds with
+        show_snapshots
+        """
+        data = self.load()
+        response = []
+        for mc, builds in data["versions"].items():
+            if self._filter_version(mc):
+                continue
+            if show_snapshots:
+                shown = {build: "" for build in builds}
+            else:
+                shown = {}
+                for kind in ("recommended", "latest"):
+                    build = data["promos"].get(f"{mc}-{kind}")
+                    if build is not None:
+                        shown.setdefault(f"{mc}-{build}", f" ({kind})")
+            for build, kind in shown.items():
+                log(f"{build}{kind}")
+                response.append(build)
+        return response
+
+    def resolve_version(self, version: str) -> str:
+        """
+        accepts full forge version (1.20.1-47.3.0), minecraft version with
+        promotion (1.20.1-recommended, 1.20.1-latest) or minecraft version
+        alone meaning recommended or latest build of it
+        """
+        data = self.load()
+        mc, _, build = version.partition("-")
+        kinds = [build] if build in ("recommended", "latest") else []
+        if not build:
+            kinds = ["recommended", "latest"]
+        for kind in kinds:
+            promoted = data["promos"].get(f"{mc}-{kind}")
+            if promoted is not None:
+                INFO(f'forge version "{version}" is {mc}-{promoted}')
+                return f"{mc}-{promoted}"
+        if version in data["versions"].get(mc, []):
+            return version
+        FAIL(f'forge version "{version}" not found. run list-versions command')
+        raise MCNotFoundError()
+
+    @contextmanager
+    def lock(self):
+        """
+        installations write to shared library store, so only one runs at a time
+        """
+        with open(f"{self.folder}/install.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def download_installer(self, version: str) -> str:
+        installer = f"{self.folder}/installers/forge-{version}-installer.jar"
+        if pathlib.Path(installer).exists():
+            return installer
+        Cmd.mkdir(os.path.dirname(installer))
+
+        url = f"{self.maven_url}/{version}/forge-{version}-installer.jar"
+        INFO(f"downloading forge installer {url}")
+        sha1 = self.get(f"{url}.sha1").body.decode().split()[0]
+        self.fetcher_for(url).download(url, installer, sha1)
+        return installer
+
+    @classmethod
+    def read_installer(cls, installer: str) -> tuple[dict, list[dict]]:
+        """
+        install profile and artifacts of libraries installer would download
+        """
+        with zipfile.ZipFile(installer) as jar:
+            profile = json.loads(jar.read("install_profile.json"))
+            version_json = profile.get("json", "/version.json").lstrip("/")
+            version = {}
+            if version_json in jar.namelist():
+                version = json.loads(jar.read(version_json))
+
+        artifacts = {}
+        for library in profile.get("libraries", []) + version.get("libraries", []):
+            artifact = library.get("downloads", {}).get("artifact")
+            # artifacts without url are made by installer itself
+            if artifact and artifact.get("url"):
+                artifacts[artifact["path"]] = artifact
+        return profile, list(artifacts.values())
+
+    def download_library(self, artifact: dict) -> int:
+        fname = f"{self.libraries}/{artifact['path']}"
+        if pathlib.Path(fname).exists():
+            if VersionManifest.sha1(fname) == artifact.get("sha1"):
+                return 0
+            WARN(f"{fname} is corrupted, downloading it again")
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        url = artifact["url"]
+        return self.fetcher_for(url).download(url, fname, artifact.get("sha1"))
+
+    def download_libraries(self, artifacts: list[dict]):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=Forge.WORKERS) as pool:
+            sizes = list(pool.map(self.download_library, artifacts))
+        downloaded = sum(size > 0 for size in sizes)
+        INFO(
+            f"{downloaded} libraries downloaded ({sum(sizes) >> 20}MB), "
+            f"{len(sizes) - downloaded} already in {self.libraries}"
+        )
+
+    def place_server_jar(self, profile: dict, folder: str):
+        """
+        hardlink vanilla server jar where installer looks for it
+        """
+        mc = profile.get("minecraft")
+        if mc is None:
+            return
+        path = profile.get("serverJarPath")
+        if path is not None:
+            target = path.replace("{LIBRARY_DIR}", f"{folder}/{Forge.LIBRARIES}")
+            target = target.replace("{MINECRAFT_VERSION}", mc)
+        else:
+            target = f"{folder}/minecraft_server.{mc}.jar"
+        if pathlib.Path(target).exists():
+            return
+
+        try:
+            jar = VanillaEnviroment().download_server(mc)
+        except MCError:
+            INFO("forge installer will download vanilla server itself")
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(jar, target)
+        except OSError:
+            shutil.copy2(jar, target)
+
+    def download_server(self, version: str) -> str:
+        folder = f"{self.folder}/{version}"
+        if pathlib.Path(f"{folder}/{Forge.LAUNCH}").exists():
+            OK(f'existing forge installation: "{folder}"')
+            return folder
+
+        Cmd.mkdir(self.libraries)
+        with self.lock():
+            # other process could install it while we waited for lock
+            if pathlib.Path(f"{folder}/{Forge.LAUNCH}").exists():
+                OK(f'existing forge installation: "{folder}"')
+                return folder
+
+            installer = self.download_installer(version)
+            profile, artifacts = self.read_installer(installer)
+
+            Cmd.mkdir(folder)
+            libraries = f"{folder}/{Forge.LIBRARIES}"
+            if not os.path.lexists(libraries):
+                os.symlink(os.path.relpath(self.libraries, folder), libraries)
+
+            with STEP(f"downloading {len(artifacts)} forge libraries"):
+                self.download_libraries(artifacts)
+            self.place_server_jar(profile, folder)
+
+            with STEP(f"running forge {version} installer"):
+                with open(f"{folder}/installer.log", "w") as log_file:
+                    Cmd.cmd(
+                        [
+                            "java",
+                            "-jar",
+                            os.path.abspath(installer),
+                            "--installServer",
+                            ".",
+                        ],
+                        cwd=folder,
+                        timeout_mins=Forge.INSTALL_TIMEOUT_MINS,
+                        stdout=log_file,
+                        stderr=log_file,
+                    )
+
+            launch = self.find_launcher(folder, version)
+            tmp_fname = f"{folder}/{Forge.LAUNCH}.tmp"
+            Cmd.fwrite(tmp_fname, Cmd.jdump(launch))
+            os.replace(tmp_fname, f"{folder}/{Forge.LAUNCH}")
+            OK(f'forge {version} installed to "{folder}"')
+        return folder
+
+    @classmethod
+    def find_launcher(cls, folder: str, version: str) -> dict:
+        """
+        forge 1.17+ is started with arguments file, older with forge jar
+        """
+        args = f"{Forge.LIBRARIES}/net/minecraftforge/forge/{version}/unix_args.txt"
+        if pathlib.Path(f"{folder}/{args}").exists():
+            return {"args": args}
+        for fname in sorted(os.listdir(folder)):
+            if (
+                fname.startswith(f"forge-{version}")
+                and fname.endswith(".jar")
+                and "installer" not in fname
+            ):
+                return {"jar": fname}
+        FAIL(
+            f"forge installer did not make server launcher, see {folder}/installer.log"
+        )
+        raise MCSystemError()
+
+    def launch_args(self, version: str) -> list[str]:
+        """
+        java arguments starting installed forge server from any directory
+        """
+        folder = pathlib.Path(f"{self.folder}/{version}").absolute()
+        if not (folder / Forge.LAUNCH).exists():
+            FAIL(f"forge {version} is not installed")
+            raise MCNotFoundError()
+        launch = json.loads((folder / Forge.LAUNCH).read_text())
+        if "jar" in launch:
+            # class path in jar manifest is relative to jar itself
+            return ["-jar", str(folder / launch["jar"])]
+
+        # arguments refer libraries relative to installation folder
+        libraries = os.path.realpath(folder / Forge.LIBRARIES)
+        text = (folder / launch["args"]).read_text()
+        text = re.sub(
+            r"(^|[\s=:])libraries(?=[/\s]|$)",
+            lambda m: m.group(1) + libraries,
+            text,
+            flags=re.M,
+        )
+        return text.split()
 
 
 def Enviroment(launcher: str) -> IEnviroment:
     if launcher == LauncherType.VANILLA:
         return VanillaEnviroment()
     elif launcher == LauncherType.FORGE:
-        return ForgeRequirements()
+        return ForgeEnviroment()
     else:
         ABORT(f"invalid launcher: {launcher}")
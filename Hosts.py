@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import socket
+from typing import Any
+
+from cprint import *
+from defs import *
+import Control
+
+
+class Host:
+    """
+    host agent known to manager, hosts.json maps host name to it's agent:
+        {
+            "alpha": {"address": "10.0.0.2:25600", "key_file": "alpha.key"},
+            "beta": {"address": "10.0.0.3:25600", "key": "<hex>"}
+        }
+    key or key_file is optional, agent.key is used by default
+    """
+
+    def __init__(self, name: str, address: str, key: bytes):
+        self.name = name
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port or Agent.PORT))
+        self.key = key
+
+    @classmethod
+    def load_all(cls, fname: str = Fname.HOSTS) -> list[Host]:
+        if not pathlib.Path(fname).exists():
+            FAIL(f"no hosts configured, create {fname}")
+            raise MCNotFoundError()
+        with open(fname) as f:
+            config = json.load(f)
+
+        hosts = []
+        for name, entry in config.items():
+            if "key" in entry:
+                key = entry["key"].encode()
+            else:
+                key = Control.load_key(entry.get("key_file", Fname.AGENT_KEY))
+            hosts.append(cls(name, entry["address"], key))
+        return hosts
+
+    @classmethod
+    def get(cls, name: str) -> Host:
+        for host in cls.load_all():
+            if host.name == name:
+                return host
+        FAIL(f"host {name} is not in {Fname.HOSTS}")
+        raise MCNotFoundError()
+
+    def call(self, argv: list[str], on_event=Control.replay) -> Any:
+        """
+        run main.py command on host agent, returns it's result value
+        """
+        try:
+            sock = socket.create_connection(self.address, Agent.CONNECT_TIMEOUT_SECS)
+        except OSError as e:
+            FAIL(f"cannot connect to host {self.name} at {self.address}: {e}")
+            raise MCFetchError()
+        # operations like run take minutes
+        sock.settimeout(None)
+
+        with sock, sock.makefile("rwb") as f:
+            challenge = json.loads(f.readline())["challenge"]
+            mac = Control.sign(self.key, challenge, argv)
+            result = Control.exchange(f, {"argv": argv, "mac": mac}, on_event)
+
+        if not result["ok"]:
+            FAIL(f'host {self.name}: {result["error"] or "command failed"}')
+            raise MCSystemError()
+        return result["value"]
+
+
+def quiet(kind: str, text: str):
+    pass
+
+
+def fan_out(hosts: list[Host], argv: list[str]) -> dict[str, Any]:
+    """
+    run command on all hosts in parallel without printing their output
+    returns mapping from host name to result, None for failed hosts, their
+    errors are still reported
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(host: Host):
+        try:
+            return host.call(argv, on_event=quiet)
+        except MCError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(Agent.WORKERS, len(hosts))) as pool:
+        results = pool.map(call, hosts)
+        return {host.name: result for host, result in zip(hosts, results)}
+
+
+def score(resources: dict) -> float:
+    """
+    placement score of host: available memory scaled by idle cpu share
+    """
+    idle = 1 - resources["load"] / max(1, resources["cpus"])
+    return resources["mem_available_mb"] * max(0.05, idle)
+
+
+def place(hosts: list[Host]) -> Host:
+    """
+    choose host for new server by free memory and cpu load
+    """
+    resources = fan_out(hosts, [Action.RESOURCES])
+    candidates = []
+    for host in hosts:
+        r = resources[host.name]
+        if r is None:
+            # failure is already reported
+            continue
+        if r["mem_available_mb"] < Agent.MIN_FREE_MB:
+            INFO(f'host {host.name} has only {r["mem_available_mb"]}MB available')
+        else:
+            INFO(
+                f'host {host.name}: {r["mem_available_mb"]}MB available, '
+                f'load {r["load"]:.2f} on {r["cpus"]} cpus, score {score(r):.0f}'
+            )
+            candidates.append((score(r), host))
+
+    if not candidates:
+        FAIL("no host has enough resources for new server")
+        raise MCSystemError()
+    best = max(candidates, key=lambda candidate: candidate[0])[1]
+    OK(f"placing server on host {best.name}")
+    return best
+
+
+def remote_argv(argv: list[str]) -> list[str]:
+    """
+    main.py arguments without top-level --host and --trace options
+    """
+    i = 0
+    while i < len(argv) and argv[i].startswith(("--host", "--trace")):
+        i += 1 if "=" in argv[i] else 2
+    return argv[i:]
+
+
+def forward(host_name: str, argv: list[str], action: str) -> Any:
+    if host_name == "auto":
+        if action != Action.CREATE:
+            FAIL("automatic host placement works only for create")
+            raise MCInvalidOperationError()
+        host = place(Host.load_all())
+    else:
+        host = Host.get(host_name)
+    return host.call(remote_argv(argv))
+
+
+def fleet_list() -> list[dict]:
+    """
+    list servers of all hosts, hosts are asked in parallel
+    """
+    hosts = Host.load_all()
+    results = fan_out(hosts, [Action.LIST])
+
+    response = []
+    for host in hosts:
+        servers = results[host.name]
+        if servers is None:
+            continue
+        for server in servers:
+            status = "running" if server["running"] else "not running"
+            log(
+                f'{host.name}/{server["name"]} {server["launcher"]} '
+                f'{server["version"]} ({status})'
+            )
+            response.append(server | {"host": host.name})
+    return response
+
+
+def agent_root(root: str):
+    """
+    make agent work in it's own directory, several agents can run on one
+    machine with different roots and ports
+    """
+    import shutil
+
+    source = pathlib.Path(__file__).absolute().parent
+    os.makedirs(root, exist_ok=True)
+    for fname in Agent.TEMPLATES:
+        if not pathlib.Path(root, fname).exists():
+            shutil.copy(source / fname, pathlib.Path(root, fname))
+    os.chdir(root)
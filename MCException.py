@@ -24,3 +24,11 @@ class MCFetchError(MCSystemError):
 
 class MCInvalidOperationError(MCUserError):
     pass
+
+
+class MCPingError(MCSystemError):
+    pass
+
+
+class MCRegionError(MCSystemError):
+    pass
@@ -1,43 +1,252 @@
+import contextvars
+import fnmatch
+import os
 import pathlib
+import time
 
 from defs import *
 from cprint import *
 from Server import *
 from Enviroment import *
-from Saga import Saga
+from Saga import Saga, Journal
+from Backoff import Stagger
 
 
 def iter_servers():
     if not pathlib.Path(Folder.WORLDS).exists():
         return
-    for server in pathlib.Path(Folder.WORLDS).iterdir():
+    for server in sorted(pathlib.Path(Folder.WORLDS).iterdir()):
+        # skip worlds/.git and other non-server entries
+        if server.name.startswith(".") or not server.is_dir():
+            continue
         yield IServer.get(server.name)
 
 
+def select_servers(pattern: str | None, only_running=False) -> list[IServer]:
+    """
+    find servers which names match glob pattern (all servers if pattern is
+    None), optionally only running ones
+    """
+    servers = []
+    for server in iter_servers():
+        if pattern is not None and not fnmatch.fnmatchcase(server.name, pattern):
+            continue
+        if only_running and not server.is_running():
+            continue
+        servers.append(server)
+
+    if not servers:
+        FAIL(f'no servers match "{pattern or "*"}"')
+        raise MCNotFoundError()
+    return servers
+
+
+def bulk(
+    title: str,
+    servers: list[IServer],
+    action,
+    jobs=Fleet.JOBS,
+    stagger_secs=0.0,
+) -> list[dict]:
+    """
+    run action(server) for every server on worker pool of jobs threads
+    starts of actions are spaced at least stagger_secs apart
+    returns per-server report, raises if any action failed
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    stagger = Stagger(stagger_secs)
+
+    def worker(server: IServer) -> dict:
+        errors = []
+
+        def sink(kind: str, text: str):
+            if kind in ("FAIL", "FAILED"):
+                errors.append(text)
+
+        stagger.wait()
+        start = time.monotonic()
+        with capture(sink):
+            try:
+                action(server)
+                ok = True
+            except Exception as e:
+                ok = False
+                if not errors:
+                    errors.append(str(e) or type(e).__name__)
+        return {
+            "name": server.name,
+            "ok": ok,
+            "secs": round(time.monotonic() - start, 3),
+            "error": errors[0] if errors else None,
+        }
+
+    INFO(f"{title}: {len(servers)} servers, {jobs} jobs")
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        # copy context to every task, so output captured by caller (control
+        # daemon, telegram bot) includes output of worker threads
+        futures = [
+            pool.submit(contextvars.copy_context().run, worker, server)
+            for server in servers
+        ]
+        report = [future.result() for future in futures]
+
+    with STEP(f"{title} report"):
+        for entry in report:
+            if entry["ok"]:
+                OK(f'{entry["name"]}: {entry["secs"]:.1f}s')
+            else:
+                FAIL(f'{entry["name"]}: {entry["secs"]:.1f}s: {entry["error"]}')
+
+        failed = sum(not entry["ok"] for entry in report)
+        if failed:
+            FAIL(f"{failed} of {len(report)} servers failed")
+            raise MCSystemError()
+    return report
+
+
 def create_server(launcher: str, name: str, version: str):
-    with Saga() as saga:
+    enviroment = Enviroment(launcher)
+    version = enviroment.resolve_version(version)
+    params = {"launcher": launcher, "name": name, "version": version}
+    with Saga(f"create-{name}", params) as saga:
         folder = f"{Folder.WORLDS}/{name}"
-        if pathlib.Path(folder).exists():
+        if pathlib.Path(folder).exists() and not saga.resumed:
             FAIL(f"server {name} already exists")
             raise MCInvalidOperationError()
 
         with STEP("downloading server jar"):
-            Enviroment(launcher).download_server(version)
+            enviroment.download_server(version)
 
         with STEP("creating server folder"):
             INFO(f'server type: "{launcher}"')
             INFO(f'server name: "{name}"')
             INFO(f'server version: "{version}"')
 
-            saga.compensation(lambda: Cmd.cmd(f"rm -rf {folder}"))
-            server = IServer.create_folder(launcher, name, version)
+            saga.compensation(["rm", "-rf", folder])
+            saga.step(
+                "create folder",
+                lambda: IServer.create_folder(launcher, name, version),
+            )
+            server = IServer.get(name)
 
         with STEP("creating server files"):
-            server.create_files()
+            saga.step("create files", server.create_files)
 
         OK(f'{launcher} server "{name}" created successfully')
 
 
+def used_ports(exclude: str | None = None) -> set[int]:
+    """
+    game and rcon ports configured for servers
+    """
+    ports = set()
+    for server in iter_servers():
+        if server.name == exclude:
+            continue
+        properties = server.properties()
+        ports.add(server.address()[1])
+        if properties.get("rcon.port", "").isdigit():
+            ports.add(int(properties["rcon.port"]))
+    return ports
+
+
+def free_port(used: set[int]) -> int:
+    """
+    first port not used by other servers and not taken by other processes
+    """
+    import socket
+
+    for port in range(Status.PORT, Clone.MAX_PORT + 1):
+        if port in used:
+            continue
+        with socket.socket() as s:
+            try:
+                s.bind(("", port))
+            except OSError:
+                continue
+        return port
+    FAIL("no free ports left")
+    raise MCSystemError()
+
+
+def clone_server(src_name: str, name: str):
+    """
+    copy existing server, even running one, to new server with it's own world
+    name and ports
+    """
+    params = {"from": src_name, "name": name}
+    with Saga(f"clone-{name}", params) as saga:
+        with STEP(f'finding server "{src_name}"'):
+            src = IServer.get(src_name)
+            if RamWorld(src).active() and not src.is_running():
+                FAIL("world of crashed server is left in RAM, run it with --recover")
+                raise MCInvalidOperationError()
+            level = src.properties().get("level-name") or "world"
+
+        folder = f"{Folder.WORLDS}/{name}"
+        if pathlib.Path(folder).exists() and not saga.resumed:
+            FAIL(f"server {name} already exists")
+            raise MCInvalidOperationError()
+
+        def copy():
+            start = time.monotonic()
+            # RAM world is followed by symlink, it's stale disk copy skipped
+            skip = Clone.SKIP + (f"{Folder.DATA}/{level}.disk",)
+            stats = src.snapshot(src.folder, folder, skip, Clone.HARDLINK)
+            INFO(
+                f'{stats["bytes"] >> 20}MB in {time.monotonic() - start:.1f}s: '
+                f'{stats["reflink"]} files reflinked, {stats["hardlink"]} '
+                f'hardlinked, {stats["copy"]} copied'
+            )
+
+        def configure():
+            server = IServer.get(name)
+            data = f"{folder}/{Folder.DATA}"
+            if level != name and pathlib.Path(f"{data}/{level}").exists():
+                Cmd.echo("mv", f"{data}/{level}", f"{data}/{name}")
+                os.rename(f"{data}/{level}", f"{data}/{name}")
+            server.set_property("level-name", name)
+
+            used = used_ports(exclude=name)
+            port = free_port(used)
+            server.set_property("server-port", str(port))
+            server.set_property("query.port", str(port))
+            INFO(f"server port: {port}")
+            if "rcon.port" in server.properties():
+                rcon_port = free_port(used | {port})
+                server.set_property("rcon.port", str(rcon_port))
+                INFO(f"rcon port: {rcon_port}")
+
+        with STEP(f'copying server "{src_name}" to "{name}"'):
+            saga.compensation(["rm", "-rf", folder])
+            saga.step("copy files", copy)
+
+        with STEP(f'configuring server "{name}"'):
+            saga.step("configure", configure)
+
+        OK(f'server "{name}" cloned from "{src_name}"')
+
+
+def list_journal() -> list[dict]:
+    """
+    show operations interrupted by process death
+    """
+    response = []
+    for journal in Journal.interrupted():
+        data = journal.data
+        steps = ", ".join(data["steps"]) or "none"
+        log(f'{data["operation"]} {data["params"]} (completed steps: {steps})')
+        response.append(data)
+    if not response:
+        OK("no interrupted operations")
+    return response
+
+
+def rollback_operation(operation: str):
+    Saga.rollback(operation)
+
+
 def delete_server(name: str):
     with STEP(f'finding server "{name}"'):
         server = IServer.get(name)
@@ -46,18 +255,26 @@ def delete_server(name: str):
         server.delete()
 
 
-def run_server(name: str, interactive):
+def run_server(
+    name: str,
+    interactive,
+    ram=False,
+    recover=False,
+    watchdog=False,
+    profile=False,
+    warm_mb=None,
+):
     with STEP(f'finding server "{name}"'):
         server = IServer.get(name)
 
-    server.run(interactive)
+    server.run(interactive, ram, recover, watchdog, profile, warm_mb)
 
 
-def stop_server(name: str):
+def stop_server(name: str, kill=False):
     with STEP(f'finding server "{name}"'):
         server = IServer.get(name)
 
-    server.stop(kill=False)
+    server.stop(kill=kill)
 
 
 def send_cmd(name: str, cmd: str):
@@ -66,25 +283,421 @@ def send_cmd(name: str, cmd: str):
 
     server.send_cmd(cmd)
 
+    ram_world = RamWorld(server)
+    if cmd.split()[:1] == ["save-all"] and ram_world.active():
+        ram_world.sync_live()
+
+
+def watchdog(name: str, ram=False):
+    """
+    body of watchdog daemon
+    """
+    server = IServer.get(name)
+    Watchdog(server, ram).loop()
+
+
+def profile(name: str):
+    """
+    body of profiler daemon
+    """
+    server = IServer.get(name)
+    Profiler(server).loop()
+
+
+def ram_sync(name: str):
+    """
+    body of RAM world sync daemon
+    """
+    server = IServer.get(name)
+    RamWorld(server).sync_loop()
+
+
+def compact_server(name: str, compression="keep", jobs: int | None = None):
+    """
+    rewrite region files of stopped server without free space, optionally
+    recompressing chunks
+    """
+    from Region import Region
+
+    with STEP(f'finding server "{name}"'):
+        server = IServer.get(name)
+        if server.is_running():
+            FAIL("cannot compact world of running server, stop it first")
+            raise MCInvalidOperationError()
+        ram_world = RamWorld(server)
+        if ram_world.active():
+            FAIL("world of crashed server is left in RAM, run it with --recover")
+            raise MCInvalidOperationError()
+
+    if compression == "lz4":
+        version = server.version.split(".")
+        if all(v.isdigit() for v in version):
+            if tuple(map(int, version)) < Anvil.LZ4_VERSION:
+                FAIL(f"minecraft {server.version} cannot read lz4 chunks")
+                raise MCInvalidOperationError()
+
+    with STEP(f'compacting world of "{name}"'):
+        report = Region.compact(ram_world.world, compression, jobs)
+
+    if compression != "keep":
+        # chunks saved by server later should use the same codec
+        server.set_property("region-file-compression", compression)
+    return report
+
+
+def upgrade_server(name: str, version: str, erase_cache=False):
+    """
+    start upgrade of server world to new version in background, server may
+    keep running meanwhile
+    """
+    with STEP(f'finding server "{name}"'):
+        server = IServer.get(name)
+        upgrade = WorldUpgrade(server)
+        if upgrade.state().get("state") in ("copied", "upgrading"):
+            FAIL(f"server {name} is being upgraded already, see upgrade --status")
+            raise MCInvalidOperationError()
+        if RamWorld(server).active() and not server.is_running():
+            FAIL("world of crashed server is left in RAM, run it with --recover")
+            raise MCInvalidOperationError()
+
+    enviroment = Enviroment(server.launcher)
+    version = enviroment.resolve_version(version)
+    if version == server.version:
+        FAIL(f"server {name} already has version {version}")
+        raise MCInvalidOperationError()
+
+    with STEP(f"downloading {server.launcher} {version}"):
+        enviroment.download_server(version)
+
+    with STEP(f'copying world of "{name}"'):
+        with upgrade.lock():
+            upgrade.cancel()
+            port = free_port(used_ports())
+            INFO(f"upgrade runs on port {port}")
+            upgrade.prepare(version, erase_cache, port)
+
+    with STEP(f"upgrading world to {version}"):
+        upgrade.start_daemon()
+    OK(f"upgrade started, see {Action.UPGRADE} --name {name} --status")
+
+
+def upgrade_status(name: str) -> dict:
+    server = IServer.get(name)
+    return WorldUpgrade(server).show()
+
+
+def cancel_upgrade(name: str):
+    with STEP(f'cancelling upgrade of "{name}"'):
+        server = IServer.get(name)
+        upgrade = WorldUpgrade(server)
+        with upgrade.lock():
+            upgrade.cancel()
+
+
+def upgrade_worker(name: str):
+    """
+    body of upgrade worker daemon
+    """
+    server = IServer.get(name)
+    WorldUpgrade(server).loop()
+
 
 def backup_server(name: str):
     pass
 
 
-def restore_server(name: str):
-    pass
+def restore_server(
+    name: str,
+    snapshot: str,
+    regions: list[str] | None = None,
+    box: list[int] | None = None,
+    dimension="overworld",
+) -> list[dict]:
+    """
+    roll back part of stopped server world to snapshot made by save: whole
+    region files, or only chunks of block area x1 z1 x2 z2, together with
+    entities and poi of them. rest of world is not touched
+    """
+    import subprocess
+    from Region import EXTERNAL, Region
+
+    with STEP(f'finding server "{name}"'):
+        server = IServer.get(name)
+        if server.is_running():
+            FAIL("cannot restore world of running server, stop it first")
+            raise MCInvalidOperationError()
+        ram_world = RamWorld(server)
+        if ram_world.active():
+            FAIL("world of crashed server is left in RAM, run it with --recover")
+            raise MCInvalidOperationError()
+
+    def git(*args: str) -> bytes:
+        return subprocess.run(
+            ["git", "-C", Folder.WORLDS, *args], capture_output=True, check=True
+        ).stdout
+
+    with STEP(f'finding snapshot "{snapshot}"'):
+        try:
+            commit = git("rev-parse", "--verify", f"{snapshot}^{{commit}}")
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            FAIL(f'no snapshot "{snapshot}" in {Folder.WORLDS} repository')
+            raise MCNotFoundError()
+        commit = commit.decode().strip()
+        INFO(git("log", "-1", "--format=%h %ci %s", commit).decode().strip())
+
+    def ls_tree(path: str) -> dict[str, str]:
+        """
+        mode of every entry of snapshot folder by name
+        """
+        try:
+            listing = git("ls-tree", "-z", f"{commit}:{path}").decode()
+        except subprocess.CalledProcessError:
+            FAIL(f"{path} is not a folder in snapshot {commit[:7]}")
+            raise MCNotFoundError()
+        entries = {}
+        for entry in filter(None, listing.split("\0")):
+            info, _, fname = entry.partition("\t")
+            entries[fname] = info.split()[0]
+        return entries
+
+    if regions:
+        selection = {Region.parse_name(region): None for region in regions}
+    else:
+        selection = Region.chunks_in_box(*box)
+    world = os.path.normpath(os.path.join(ram_world.world, Anvil.DIMENSIONS[dimension]))
+
+    # world saved while it was in RAM is a symlink, it's files are in .disk
+    level_tree = os.path.relpath(ram_world.world, Folder.WORLDS)
+    data_tree, level = os.path.split(level_tree)
+    data_entries = ls_tree(data_tree)
+    if data_entries.get(level) == Git.SYMLINK:
+        level += ".disk"
+    if data_entries.get(level) != Git.TREE:
+        FAIL(f"no world {level_tree} in snapshot {commit[:7]}")
+        raise MCNotFoundError()
+    tree = os.path.normpath(os.path.join(data_tree, level, Anvil.DIMENSIONS[dimension]))
+    dimension_entries = ls_tree(tree)
+
+    start = time.monotonic()
+    # new content of files, None for files to remove
+    changes: dict[str, bytes | None] = {}
+    report = []
+    with STEP(f"reading {len(selection)} regions from snapshot {commit[:7]}"):
+        for folder in Anvil.REGION_FOLDERS:
+            # folder missing from snapshot really had no files yet
+            names = set()
+            if dimension_entries.get(folder) == Git.TREE:
+                names = set(ls_tree(f"{tree}/{folder}"))
+
+            for (rx, rz), indexes in selection.items():
+                fname = f"r.{rx}.{rz}.mca"
+                path = f"{world}/{folder}/{fname}"
+                old = None
+                if fname in names:
+                    old = git("cat-file", "blob", f"{commit}:{tree}/{folder}/{fname}")
+
+                if old is None and not os.path.exists(path):
+                    continue
+                if indexes is None:
+                    indexes = range(Anvil.CHUNKS)
+                    changes[path] = old
+                else:
+                    data = b""
+                    if os.path.exists(path):
+                        data = pathlib.Path(path).read_bytes()
+                    changes[path] = Region.splice(data, old or b"", indexes)
+
+                # chunks too big for region file live in .mcc files
+                for i in indexes:
+                    mcc = f"c.{rx * 32 + i % 32}.{rz * 32 + i // 32}.mcc"
+                    if mcc in names:
+                        changes[f"{world}/{folder}/{mcc}"] = git(
+                            "cat-file", "blob", f"{commit}:{tree}/{folder}/{mcc}"
+                        )
+                    elif os.path.exists(f"{world}/{folder}/{mcc}"):
+                        changes[f"{world}/{folder}/{mcc}"] = None
+
+                chunks = "all" if len(indexes) == Anvil.CHUNKS else len(indexes)
+                report.append({"fname": f"{folder}/{fname}", "chunks": chunks})
+                INFO(f"{folder}/{fname}: {chunks} chunks")
+
+    with Saga() as saga, STEP(f"replacing {len(changes)} files"):
+        staged = {}
+        for path, data in changes.items():
+            if data is None:
+                continue
+            Cmd.mkdir(os.path.dirname(path))
+            tmp_fname = os.path.join(
+                os.path.dirname(path), f".{os.path.basename(path)}.restore"
+            )
+            saga.defer(lambda tmp_fname=tmp_fname: Cmd.rm(tmp_fname, force=True))
+            with open(tmp_fname, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            staged[path] = tmp_fname
+
+        for path, data in changes.items():
+            if data is None and not os.path.exists(path):
+                continue
+            if os.path.exists(path):
+                orig = os.path.join(
+                    os.path.dirname(path), f".{os.path.basename(path)}.orig"
+                )
+                Cmd.rm(orig, force=True)
+                os.link(path, orig)
+                saga.compensation(lambda path=path, orig=orig: os.replace(orig, path))
+                saga.defer(lambda orig=orig: Cmd.rm(orig, force=True))
+                if data is None:
+                    os.unlink(path)
+            else:
+                saga.compensation(lambda path=path: Cmd.rm(path, force=True))
+            if data is not None:
+                os.replace(staged[path], path)
+
+    OK(
+        f"restored {len(report)} region files of {name} from snapshot "
+        f"{commit[:7]} in {time.monotonic() - start:.2f}s"
+    )
+    return report
+
+
+def host_resources() -> dict:
+    """
+    free resources of this host, used by manager to place new servers
+    """
+    meminfo = {}
+    for line in Cmd.freadlines("/proc/meminfo"):
+        if ":" in line:
+            key, value = line.split(":", maxsplit=1)
+            meminfo[key] = int(value.split()[0])
+
+    servers = list(iter_servers())
+    resources = {
+        "mem_total_mb": meminfo.get("MemTotal", 0) >> 10,
+        "mem_available_mb": meminfo.get("MemAvailable", 0) >> 10,
+        "cpus": os.cpu_count() or 1,
+        "load": os.getloadavg()[0],
+        "servers": len(servers),
+        "running": sum(server.is_running() for server in servers),
+    }
+    log(
+        f'{resources["mem_available_mb"]}/{resources["mem_total_mb"]}MB available, '
+        f'load {resources["load"]:.2f} on {resources["cpus"]} cpus, '
+        f'{resources["running"]}/{resources["servers"]} servers running'
+    )
+    return resources
+
+
+def proxy_stats() -> dict:
+    """
+    counters of routes written by running proxy
+    """
+    try:
+        stats = Cmd.jload(Cmd.fread(Fname.PROXY_STATS))
+    except FileNotFoundError:
+        FAIL(f"no {Fname.PROXY_STATS}, proxy did not run here")
+        raise MCNotFoundError()
+
+    age = time.time() - stats["updated"]
+    if age > 3 * Proxy.STATS_SECS:
+        WARN(f"proxy stats are {age:.0f}s old, proxy is not running")
+    for name, counters in sorted(stats["routes"].items()):
+        log(
+            f'{name}: {counters["active"]} active, '
+            f'{counters["connections"]} connections, '
+            f'{counters["status"]} status requests, {counters["refused"]} refused, '
+            f'{counters["bytes_in"] >> 20}MB in, {counters["bytes_out"] >> 20}MB out'
+        )
+    if stats["unrouted"]:
+        log(f'{stats["unrouted"]} connections to unknown hostnames')
+    return stats
+
+
+def list_schedule() -> list[dict]:
+    from Scheduler import Schedule
+
+    return Schedule().load().show()
+
+
+def schedule_task(task_id: str, cron: str, command: list[str], jitter=0, group=None):
+    from Scheduler import Schedule
+
+    commands = [[]]
+    for arg in command:
+        if arg == ";":
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+    commands = [argv for argv in commands if argv]
+    if not commands:
+        FAIL(f'task "{task_id}" has no command')
+        raise MCInvalidOperationError()
+    Schedule().load().add(task_id, cron, commands, jitter, group)
+
+
+def unschedule_task(task_id: str):
+    from Scheduler import Schedule
+
+    Schedule().load().remove(task_id)
+
+
+def limit_schedule_group(group: str, jobs: int):
+    from Scheduler import Schedule
+
+    if jobs < 1:
+        FAIL("group must run at least one task at a time")
+        raise MCInvalidOperationError()
+    Schedule().load().set_limit(group, jobs)
+
+
+def health_check(servers: list) -> dict[str, PingResult | None]:
+    """
+    ping all given servers in parallel
+    returns mapping from server name to ping result or None if ping failed
+    """
+
+    def check(server):
+        try:
+            return server.status()
+        except MCPingError:
+            return None
+
+    if not servers:
+        return {}
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = min(Status.WORKERS, len(servers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(check, servers)
+        return {server.name: result for server, result in zip(servers, results)}
 
 
 def list_servers(only_running=False):
+    servers = list(iter_servers())
+    running = [server for server in servers if server.is_running()]
+    health = health_check(running)
+
     response = []
-    for server in iter_servers():
-        is_running = server.is_running()
+    for server in servers:
+        is_running = server.name in health
+        status = health.get(server.name)
+        ram_bytes = RamWorld(server).usage()
         if is_running:
-            running_msg = "server running"
+            if status is not None:
+                running_msg = f"server online: {status}"
+            else:
+                running_msg = "server running, not responding"
         else:
             running_msg = "server not running"
             if only_running:
                 continue
+        if ram_bytes:
+            running_msg += f", RAM world {ram_bytes / 2**20:.1f}MB"
+        watchdog_state = Watchdog(server).state().get("state")
+        if watchdog_state == "crash-loop":
+            running_msg += ", watchdog gave up after crash loop"
         log(f"{server.name} {server.launcher} {server.version} ({running_msg})")
         response.append(
             {
@@ -92,15 +705,161 @@ def list_servers(only_running=False):
                 "launcher": server.launcher,
                 "version": server.version,
                 "running": is_running,
+                "status": status.to_dict() if status is not None else None,
+                "ram_bytes": ram_bytes,
+                "watchdog": watchdog_state,
             }
         )
     return response
 
 
 def save_server(name: str):
-    cprint("yellow", f'SAVING SERVER "{name}"')
-    server = find_server(name, announce=False)
-    server.save()
+    with STEP(f'finding server "{name}"'):
+        server = IServer.get(name)
+
+    with STEP(f'saving server "{name}"'):
+        server.save()
+
+
+def shutdown_all(
+    message=Shutdown.MESSAGE,
+    warn_secs=Shutdown.WARN_SECS,
+    stop_timeout_secs=Shutdown.STOP_TIMEOUT_SECS,
+    term_timeout_secs=Shutdown.TERM_TIMEOUT_SECS,
+) -> list[dict]:
+    """
+    stop all running servers at once: warn players, ask every server to save
+    and stop, then wait for all java processes together escalating to SIGTERM
+    and SIGKILL after deadlines
+    total time is about slowest server save, not sum of all of them
+    """
+    import signal
+
+    servers = list(iter_servers())
+    # also watchdogs waiting to restart crashed servers, which are not running
+    for server in servers:
+        Watchdog(server).stop_daemon()
+        Profiler(server).stop_daemon()
+    servers = [server for server in servers if server.is_running()]
+    if not servers:
+        OK("no running servers")
+        return []
+
+    pids = {}
+    with STEP(f"asking {len(servers)} servers to stop"):
+        for server in servers:
+            pid = server.pid()
+            if pid is None:
+                WARN(f"server {server.name} has no java process")
+                continue
+            pids[pid] = server
+            if message:
+                server.send_cmd(f"say {message}")
+
+        if message and warn_secs and pids:
+            INFO(f"waiting {warn_secs}s after warning players")
+            time.sleep(warn_secs)
+
+        start = time.monotonic()
+        for server in pids.values():
+            server.send_cmd("save-all flush")
+            server.send_cmd("stop")
+
+    pending = list(pids)
+    exited = {}
+    how = {}
+    for timeout_secs, sig in (
+        (stop_timeout_secs, signal.SIGTERM),
+        (term_timeout_secs, signal.SIGKILL),
+        (Shutdown.KILL_TIMEOUT_SECS, None),
+    ):
+        with STEP(f"waiting {len(pending)} servers to stop"):
+            done = Cmd.waitpids(pending, timeout_secs)
+        for pid, when in done.items():
+            exited[pid] = when
+            how.setdefault(pid, "stop")
+        pending = [pid for pid in pending if pid not in done]
+        if not pending or sig is None:
+            break
+
+        for pid in pending:
+            WARN(f"server {pids[pid].name} did not stop in time, sending {sig.name}")
+            how[pid] = sig.name
+            Cmd.kill(pid, sig)
+
+    report = []
+    for pid, server in pids.items():
+        if pid in exited:
+            server.cleanup()
+        report.append(
+            {
+                "name": server.name,
+                "ok": pid in exited,
+                "how": how.get(pid, "stop"),
+                "secs": round(exited.get(pid, time.monotonic()) - start, 3),
+            }
+        )
+
+    with STEP("shutdown report"):
+        for entry in report:
+            text = f'{entry["name"]}: {entry["how"]} after {entry["secs"]:.1f}s'
+            if entry["ok"] and entry["how"] == "stop":
+                OK(text)
+            elif entry["ok"]:
+                WARN(text)
+            else:
+                FAIL(f'{entry["name"]}: still running after SIGKILL')
+        total = round(time.monotonic() - start, 3)
+        INFO(f"total shutdown time {total:.1f}s")
+
+        if not all(entry["ok"] for entry in report):
+            raise MCSystemError()
+    return report
+
+
+def bulk_run(
+    pattern,
+    only_running,
+    jobs,
+    stagger_secs,
+    ram=False,
+    recover=False,
+    watchdog=False,
+    profile=False,
+    warm_mb=None,
+) -> list[dict]:
+    servers = select_servers(pattern, only_running)
+    return bulk(
+        "running servers",
+        [server for server in servers if not server.is_running()],
+        lambda server: server.run(False, ram, recover, watchdog, profile, warm_mb),
+        jobs,
+        stagger_secs,
+    )
+
+
+def bulk_stop(pattern, only_running, jobs, kill=False) -> list[dict]:
+    servers = select_servers(pattern, only_running)
+    return bulk(
+        "stopping servers",
+        [server for server in servers if server.is_running()],
+        lambda server: server.stop(kill=kill),
+        jobs,
+    )
+
+
+def bulk_cmd(pattern, only_running, jobs, cmd: str) -> list[dict]:
+    servers = select_servers(pattern, only_running)
+    return bulk(f'sending "{cmd}"', servers, lambda server: server.send_cmd(cmd), jobs)
+
+
+def bulk_save(pattern, only_running, jobs) -> list[dict]:
+    servers = select_servers(pattern, only_running)
+    return bulk("saving servers", servers, lambda server: server.save(), jobs)
+
+
+def list_versions(launcher: str, show_snapshots: bool) -> list[str]:
+    return Enviroment(launcher).list_versions(show_snapshots)
 
 
 def update_versions(launcher: str):
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pathlib
+import urllib.error
+import urllib.parse
+import urllib.request
+from abc import ABC, abstractmethod
+from email.utils import formatdate
+
+from cprint import *
+from defs import *
+
+
+class Response:
+    def __init__(self, status: int, body: bytes = b"", etag=None, modified=None):
+        self.status = status
+        self.body = body
+        self.etag = etag
+        self.modified = modified
+
+    def json(self) -> dict:
+        return json.loads(self.body)
+
+
+class Fetcher(ABC):
+    """
+    conditional GET: with etag or modified given, unchanged resource is
+    answered with status 304 and empty body
+    """
+
+    @abstractmethod
+    def get(self, url: str, etag=None, modified=None) -> Response:
+        pass
+
+    def download(self, url: str, fname: str, sha1: str | None = None) -> int:
+        """
+        download url to fname through fname.part checking sha1, returns
+        downloaded bytes
+        """
+        part = f"{fname}.part"
+        with open(part, "wb") as f:
+            f.write(self.get(url).body)
+        if sha1 and VersionManifest.sha1(part) != sha1:
+            os.unlink(part)
+            FAIL(f"sha1 of {url} is not {sha1}")
+            raise MCFetchError()
+        os.replace(part, fname)
+        return os.path.getsize(fname)
+
+    @classmethod
+    def for_url(cls, url: str, timeout_secs=Mojang.TIMEOUT_SECS) -> Fetcher:
+        if urllib.parse.urlparse(url).scheme in ("", "file"):
+            return FileFetcher()
+        return HttpFetcher(timeout_secs)
+
+
+class HttpFetcher(Fetcher):
+    def __init__(self, timeout_secs=Mojang.TIMEOUT_SECS):
+        self.timeout_secs = timeout_secs
+
+    def get(self, url: str, etag=None, modified=None) -> Response:
+        request = urllib.request.Request(url)
+        if etag:
+            request.add_header("If-None-Match", etag)
+        if modified:
+            request.add_header("If-Modified-Since", modified)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout_secs) as r:
+                return Response(
+                    r.status,
+                    r.read(),
+                    r.headers.get("ETag"),
+                    r.headers.get("Last-Modified"),
+                )
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return Response(304, etag=etag, modified=modified)
+            FAIL(f"failed to fetch {url}: HTTP {e.code}")
+            raise MCFetchError()
+        except (urllib.error.URLError, OSError) as e:
+            FAIL(f"failed to fetch {url}: {e}")
+            raise MCFetchError()
+
+
+class FileFetcher(Fetcher):
+    """
+    local stand-in for manifest server: serves files from disk, etag is made
+    of file size and modification time
+    """
+
+    def get(self, url: str, etag=None, modified=None) -> Response:
+        path = urllib.parse.urlparse(url).path if "://" in url else url
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            FAIL(f"failed to fetch {url}: no such file")
+            raise MCFetchError()
+
+        file_etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        file_modified = formatdate(stat.st_mtime, usegmt=True)
+        if etag == file_etag or (etag is None and modified == file_modified):
+            return Response(304, etag=etag, modified=modified)
+        return Response(200, pathlib.Path(path).read_bytes(), file_etag, file_modified)
+
+
+class VersionManifest:
+    """
+    list of vanilla server jars built from launcher version manifest
+
+    manifest itself is fetched with conditional request, so unchanged catalog
+    costs one request answered with 304. per-version metadata (with server jar
+    url and sha1) is fetched only for versions which are new or which sha1 in
+    manifest changed, everything else is reused from previous update
+
+    versions file format:
+        {
+            "etag": ..., "modified": ..., "latest": {...},
+            "versions": {
+                "<id>": {"type", "time", "meta_sha1", "url", "sha1", "size"},
+                ...  # newest first, in manifest order
+            }
+        }
+    url is None for versions which have no server jar
+    """
+
+    def __init__(self, fname: str, url: str | None = None, fetcher=None):
+        self.fname = fname
+        self.url = url or os.environ.get(Env.MANIFEST) or Mojang.MANIFEST_URL
+        self.fetcher = fetcher or Fetcher.for_url(self.url)
+        self.data = {"etag": None, "modified": None, "latest": {}, "versions": {}}
+
+    def load(self) -> VersionManifest:
+        if not pathlib.Path(self.fname).exists():
+            return self
+        with open(self.fname) as f:
+            data = json.load(f)
+        if isinstance(data.get("versions"), dict):
+            self.data |= data
+        else:
+            # old format: plain mapping from version to jar url
+            self.data["versions"] = {
+                version: {"url": url, "sha1": None} for version, url in data.items()
+            }
+        return self
+
+    def save(self):
+        tmp_fname = f"{self.fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_fname, self.fname)
+
+    @property
+    def versions(self) -> dict[str, dict]:
+        return self.data["versions"]
+
+    def fetch_entry(self, entry: dict) -> dict:
+        meta = self.fetcher.get(entry["url"]).json()
+        server = meta.get("downloads", {}).get("server")
+        return {
+            "type": entry.get("type"),
+            "time": entry.get("releaseTime"),
+            "meta_sha1": entry.get("sha1"),
+            "url": server["url"] if server else None,
+            "sha1": server["sha1"] if server else None,
+            "size": server["size"] if server else None,
+        }
+
+    def update(self) -> tuple[int, int]:
+        """
+        refresh versions from manifest, returns number of fetched and kept
+        version entries, (0, 0) if manifest did not change
+        """
+        response = self.fetcher.get(self.url, self.data["etag"], self.data["modified"])
+        if response.status == 304:
+            return 0, 0
+
+        manifest = response.json()
+        old = self.versions
+        stale = [
+            entry
+            for entry in manifest["versions"]
+            if old.get(entry["id"], {}).get("meta_sha1") != entry.get("sha1")
+            or entry.get("sha1") is None
+        ]
+
+        fetched = {}
+        if stale:
+            from concurrent.futures import ThreadPoolExecutor
+
+            INFO(f"fetching metadata of {len(stale)} versions")
+            with ThreadPoolExecutor(max_workers=Mojang.WORKERS) as pool:
+                for entry, result in zip(stale, pool.map(self.fetch_entry, stale)):
+                    fetched[entry["id"]] = result
+
+        # manifest order is newest first, versions which disappeared from
+        # manifest are kept after them in previous order
+        versions = {}
+        for entry in manifest["versions"]:
+            versions[entry["id"]] = fetched.get(entry["id"]) or old[entry["id"]]
+        for version, record in old.items():
+            versions.setdefault(version, record)
+
+        self.data = {
+            "etag": response.etag,
+            "modified": response.modified,
+            "latest": manifest.get("latest", {}),
+            "versions": versions,
+        }
+        return len(fetched), len(manifest["versions"]) - len(fetched)
+
+    @classmethod
+    def sha1(cls, fname: str) -> str:
+        h = hashlib.sha1()
+        with open(fname, "rb") as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        return h.hexdigest()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from cprint import *
+from defs import *
+
+
+class OperationResult:
+    def __init__(
+        self,
+        ok: bool,
+        value: Any = None,
+        error: str | None = None,
+        output: list[str] | None = None,
+    ):
+        self.ok = ok
+        self.value = value
+        self.error = error
+        self.output = output or []
+
+    def text(self) -> str:
+        return "\n".join(self.output)
+
+
+class Operations:
+    """
+    run Manager operations in-process on worker threads
+
+    operations with the same key (usually server name) are serialized, so
+    concurrent requests from several users cannot race on one server folder.
+    read-only queries run on separate pool, so they are answered while long
+    operations take all workers
+    """
+
+    def __init__(self, workers: int = Bot.WORKERS):
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="operation"
+        )
+        self.queries = ThreadPoolExecutor(
+            max_workers=Bot.QUERY_WORKERS, thread_name_prefix="query"
+        )
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def lock(self, key: str) -> asyncio.Lock:
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        return self.locks[key]
+
+    async def run(
+        self,
+        key: str,
+        func: Callable,
+        *args,
+        on_event: Callable[[str, str], None] | None = None,
+        query=False,
+        **kwargs,
+    ) -> OperationResult:
+        """
+        run func(*args, **kwargs) on worker pool, or on query pool if it
+        only reads
+        on_event(kind, text) is called from event loop for every printed message
+        """
+        loop = asyncio.get_running_loop()
+        output = []
+
+        def sink(kind: str, text: str):
+            if kind not in ("STEP", "DONE", "FAILED", "CMD"):
+                output.append(text)
+            if on_event is not None:
+                loop.call_soon_threadsafe(on_event, kind, text)
+
+        def worker():
+            with capture(sink):
+                return func(*args, **kwargs)
+
+        async with self.lock(key):
+            try:
+                pool = self.queries if query else self.pool
+                value = await loop.run_in_executor(pool, worker)
+            except MCError as e:
+                return OperationResult(
+                    False, error=str(e) or type(e).__name__, output=output
+                )
+            except Exception as e:
+                traceback.print_exc()
+                return OperationResult(False, error=repr(e), output=output)
+
+        return OperationResult(True, value=value, output=output)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.queries.shutdown(wait=True)
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from cprint import *
+from defs import *
+from Backoff import Backoff
+
+
+class PingResult:
+    def __init__(
+        self,
+        latency_ms: float,
+        version: str,
+        protocol: int,
+        players_online: int,
+        players_max: int,
+        motd: str,
+        timestamp: float | None = None,
+    ):
+        self.latency_ms = latency_ms
+        self.version = version
+        self.protocol = protocol
+        self.players_online = players_online
+        self.players_max = players_max
+        self.motd = motd
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def to_dict(self) -> dict:
+        return {
+            "latency_ms": self.latency_ms,
+            "version": self.version,
+            "protocol": self.protocol,
+            "players_online": self.players_online,
+            "players_max": self.players_max,
+            "motd": self.motd,
+            "timestamp": self.timestamp,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> PingResult:
+        return cls(**d)
+
+    def __str__(self):
+        return (
+            f"{self.players_online}/{self.players_max} players, "
+            f"{self.version}, {self.latency_ms:.1f}ms"
+        )
+
+
+class Ping:
+    """
+    minimal Server List Ping client
+    https://minecraft.wiki/w/Java_Edition_protocol/Server_List_Ping
+    """
+
+    STATE_STATUS = 1
+    PACKET_HANDSHAKE = 0x00
+    PACKET_STATUS = 0x00
+    PACKET_PING = 0x01
+
+    @classmethod
+    def pack_varint(cls, value: int) -> bytes:
+        value &= 0xFFFFFFFF
+        out = bytearray()
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                out.append(byte | 0x80)
+            else:
+                out.append(byte)
+                return bytes(out)
+
+    @classmethod
+    def pack_string(cls, value: str) -> bytes:
+        data = value.encode("utf-8")
+        return cls.pack_varint(len(data)) + data
+
+    @classmethod
+    def pack_packet(cls, packet_id: int, payload: bytes = b"") -> bytes:
+        body = cls.pack_varint(packet_id) + payload
+        return cls.pack_varint(len(body)) + body
+
+    @classmethod
+    def recv_exact(cls, sock: socket.socket, size: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = sock.recv(size - len(buf))
+            if not chunk:
+                raise MCPingError("connection closed by server")
+            buf += chunk
+        return bytes(buf)
+
+    @classmethod
+    def recv_varint(cls, sock: socket.socket) -> int:
+        value = 0
+        for i in range(5):
+            byte = cls.recv_exact(sock, 1)[0]
+            value |= (byte & 0x7F) << (7 * i)
+            if not byte & 0x80:
+                break
+        else:
+            raise MCPingError("varint is too big")
+        if value & 0x80000000:
+            value -= 1 << 32
+        return value
+
+    @classmethod
+    def unpack_varint(cls, data: bytes, offset=0) -> tuple[int, int]:
+        value = 0
+        for i in range(5):
+            if offset >= len(data):
+                raise MCPingError("truncated varint")
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << (7 * i)
+            if not byte & 0x80:
+                if value & 0x80000000:
+                    value -= 1 << 32
+                return value, offset
+        raise MCPingError("varint is too big")
+
+    @classmethod
+    def recv_packet(cls, sock: socket.socket) -> tuple[int, bytes]:
+        length = cls.recv_varint(sock)
+        if length <= 0 or length > Status.MAX_PACKET:
+            raise MCPingError(f"invalid packet length {length}")
+        body = cls.recv_exact(sock, length)
+        packet_id, offset = cls.unpack_varint(body)
+        return packet_id, body[offset:]
+
+    @classmethod
+    def ping(
+        cls, host: str, port: int, timeout_secs: float = Status.TIMEOUT_SECS
+    ) -> PingResult:
+        """
+        perform handshake, status request and ping/pong exchange
+        latency is measured as round trip time of ping packet
+        """
+        try:
+            with socket.create_connection((host, port), timeout=timeout_secs) as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                handshake = (
+                    cls.pack_varint(-1)
+                    + cls.pack_string(host)
+                    + struct.pack(">H", port)
+                    + cls.pack_varint(cls.STATE_STATUS)
+                )
+                sock.sendall(
+                    cls.pack_packet(cls.PACKET_HANDSHAKE, handshake)
+                    + cls.pack_packet(cls.PACKET_STATUS)
+                )
+
+                packet_id, payload = cls.recv_packet(sock)
+                if packet_id != cls.PACKET_STATUS:
+                    raise MCPingError(f"unexpected status packet id {packet_id}")
+                size, offset = cls.unpack_varint(payload)
+                status = json.loads(payload[offset : offset + size].decode("utf-8"))
+
+                token = int.from_bytes(os.urandom(8), "big", signed=True)
+                start = time.perf_counter()
+                sock.sendall(cls.pack_packet(cls.PACKET_PING, struct.pack(">q", token)))
+                packet_id, payload = cls.recv_packet(sock)
+                latency_ms = (time.perf_counter() - start) * 1000
+                if packet_id != cls.PACKET_PING or payload != struct.pack(">q", token):
+                    raise MCPingError("invalid pong response")
+
+        except (OSError, ValueError) as e:
+            raise MCPingError(str(e)) from e
+
+        version = status.get("version", {})
+        players = status.get("players", {})
+        motd = status.get("description", "")
+        if isinstance(motd, dict):
+            motd = motd.get("text", "")
+
+        return PingResult(
+            latency_ms=latency_ms,
+            version=version.get("name", ""),
+            protocol=version.get("protocol", -1),
+            players_online=players.get("online", 0),
+            players_max=players.get("max", 0),
+            motd=motd,
+        )
+
+    @classmethod
+    def cached(
+        cls,
+        cache_fname: str,
+        host: str,
+        port: int,
+        ttl_secs: float = Status.CACHE_TTL_SECS,
+    ) -> PingResult:
+        """
+        return ping result stored in cache_fname if it is younger than ttl_secs,
+        otherwise ping server and update cache
+        """
+        try:
+            with open(cache_fname) as f:
+                result = PingResult.from_dict(json.load(f))
+            if time.time() - result.timestamp < ttl_secs:
+                return result
+        except (OSError, ValueError, TypeError):
+            pass
+
+        result = cls.ping(host, port)
+        # servers are pinged from several threads and processes at once
+        tmp_fname = f"{cache_fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(result.to_dict(), f)
+        os.replace(tmp_fname, cache_fname)
+        return result
+
+    @classmethod
+    def wait_online(
+        cls,
+        host: str,
+        port: int,
+        pid: int | None = None,
+        timeout_mins=5,
+        backoff_secs=0.1,
+    ) -> PingResult:
+        """
+        wait until server answers status request
+        if pid is given - fail early when server process exits
+        """
+        # answer soon after server binds port, without hammering it for minutes
+        bo = Backoff(timeout_mins, backoff_secs, factor=1.5, max_backoff_secs=2)
+        while True:
+            try:
+                return cls.ping(host, port)
+            except MCPingError:
+                pass
+
+            if pid is not None:
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    FAIL(f"server process {pid} exited before becoming online")
+                    raise MCPingError()
+
+            if bo.timeout():
+                FAIL(
+                    f"server {host}:{port} did not answer ping "
+                    f"after {timeout_mins} minutes"
+                )
+                raise MCPingError()
+            bo.backoff()
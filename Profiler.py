@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import shutil
+import sys
+import time
+
+from cprint import *
+from defs import *
+from Cmd import Cmd
+from Throttle import LAG, MSPT
+
+
+class Profiler:
+    """
+    background process which collects evidence of lag spikes: when server
+    warns "Can't keep up" or reports mspt above Profile.MSPT_SPIKE, thread
+    dump is taken with jcmd and short java flight recording is started on
+    running jvm. captures are saved to profiles/<time> folder and listed by
+    time in profiles/index.json. they are taken at most once per
+    Profile.MIN_INTERVAL_SECS, oldest ones are removed when all of them take
+    more than Profile.MAX_MB
+
+    profiler follows server restarted by watchdog and exits with it otherwise
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.pid_fname = f"{server.folder}/PROFILER_PID"
+        self.stdout_fname = f"{server.folder}/stdout.log"
+        self.profiles = f"{server.folder}/profiles"
+        self.index_fname = f"{self.profiles}/index.json"
+
+    def index(self) -> list[dict]:
+        try:
+            return json.loads(Cmd.fread(self.index_fname))
+        except FileNotFoundError:
+            return []
+
+    def write_index(self, entries: list[dict]):
+        tmp_fname = f"{self.index_fname}.tmp"
+        Cmd.fwrite(tmp_fname, Cmd.jdump(entries, indent=4))
+        os.replace(tmp_fname, self.index_fname)
+
+    @classmethod
+    def check(cls):
+        if not shutil.which("jcmd"):
+            FAIL("jcmd not found, install full JDK to profile lag spikes")
+            raise MCNotFoundError()
+
+    def start_daemon(self):
+        from Daemon import daemon
+
+        main = pathlib.Path(__file__).absolute().parent / "main.py"
+        cmd = [sys.executable, str(main), Action.PROFILE, "--name", self.server.name]
+        daemon(
+            cmd,
+            stdout=f"{self.server.folder}/profiler.log",
+            pidfile=self.pid_fname,
+            cwd=os.getcwd(),
+        )
+        Cmd.wait_for_file(self.pid_fname)
+        OK(f"profiler started with pid {Cmd.fread(self.pid_fname)}")
+
+    def stop_daemon(self):
+        if not pathlib.Path(self.pid_fname).exists():
+            return
+        pid = int(Cmd.fread(self.pid_fname))
+        Cmd.kill(pid)
+        Cmd.waitpid(pid, timeout_mins=1)
+        Cmd.rm(self.pid_fname, force=True)
+
+    def spike(self, text: str) -> str | None:
+        """
+        reason to capture profile if server output shows lag spike
+        """
+        lag = LAG.findall(text)
+        if lag:
+            ms, ticks = max(lag, key=lambda m: int(m[0]))
+            return f'"Can\'t keep up", running {ms}ms or {ticks} ticks behind'
+        mspt = max((float(m) for m in MSPT.findall(text)), default=0)
+        if mspt > Profile.MSPT_SPIKE:
+            return f"average time per tick {mspt}ms"
+        return None
+
+    def jcmd(self, pid: int, *args: str, out: str | None = None) -> bool:
+        with open(out or os.devnull, "w") as f:
+            returncode = Cmd.cmd(
+                ["jcmd", str(pid), *args],
+                check=False,
+                stdout=f,
+                stderr=f,
+                timeout_mins=Profile.JCMD_TIMEOUT_MINS,
+            )
+        if returncode != 0:
+            WARN(f"jcmd {args[0]} failed with code {returncode}")
+        return returncode == 0
+
+    def capture(self, pid: int, reason: str) -> dict:
+        """
+        save thread dump and start flight recording, recording is written by
+        jvm itself when it ends
+        """
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        folder = f"{self.profiles}/{stamp}"
+        Cmd.mkdir(folder)
+        Cmd.fwrite(f"{folder}/reason.txt", f"{reason}\npid {pid}\n")
+        files = ["reason.txt"]
+
+        if self.jcmd(pid, "Thread.print", "-l", out=f"{folder}/threads.txt"):
+            files.append("threads.txt")
+        jfr = pathlib.Path(f"{folder}/recording.jfr").absolute()
+        if self.jcmd(
+            pid,
+            "JFR.start",
+            f"name=lag-{stamp}",
+            "settings=profile",
+            f"duration={Profile.JFR_SECS}s",
+            f"maxsize={Profile.JFR_MAX_MB}M",
+            f"filename={jfr}",
+        ):
+            files.append("recording.jfr")
+
+        entry = {
+            "time": time.time(),
+            "folder": stamp,
+            "reason": reason,
+            "pid": pid,
+            "files": files,
+        }
+        self.write_index(self.index() + [entry])
+        return entry
+
+    def prune(self):
+        """
+        remove oldest captures until all of them fit into Profile.MAX_MB,
+        leaving space for next recording
+        """
+
+        def size(entry: dict) -> int:
+            folder = pathlib.Path(f"{self.profiles}/{entry['folder']}")
+            return sum(f.stat().st_size for f in folder.glob("*") if f.is_file())
+
+        entries = self.index()
+        sizes = [size(entry) for entry in entries]
+        limit = (Profile.MAX_MB - Profile.JFR_MAX_MB) << 20
+        while entries and sum(sizes) > limit:
+            entry = entries.pop(0)
+            sizes.pop(0)
+            INFO(f"removing old profile {entry['folder']}")
+            Cmd.rm(f"{self.profiles}/{entry['folder']}", recursive=True, force=True)
+        self.write_index(entries)
+
+    def loop(self):
+        """
+        body of profiler daemon
+        """
+        Cmd.mkdir(self.profiles)
+        version = self.server.version.split("-")[0].split(".")
+        query_mspt = all(v.isdigit() for v in version) and (
+            tuple(map(int, version)) >= Io.TICK_QUERY_VERSION
+        )
+        entries = self.index()
+        last_capture = entries[-1]["time"] if entries else 0
+        last_query = 0.0
+        offset = os.path.getsize(self.stdout_fname)
+
+        while True:
+            pid = self.server.pid()
+            if pid is None:
+                # server may be restarted by watchdog
+                if not pathlib.Path(f"{self.server.folder}/WATCHDOG_PID").exists():
+                    break
+                time.sleep(Profile.CHECK_SECS)
+                continue
+            if Cmd.waitpids([pid], Profile.CHECK_SECS):
+                continue
+
+            if query_mspt and time.monotonic() - last_query >= Profile.MSPT_QUERY_SECS:
+                last_query = time.monotonic()
+                try:
+                    self.server.send_cmd("tick query")
+                except MCError:
+                    continue
+
+            try:
+                if os.path.getsize(self.stdout_fname) < offset:
+                    # restarted server truncated log
+                    offset = 0
+                with open(self.stdout_fname, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            offset += len(data)
+
+            reason = self.spike(data.decode(errors="replace"))
+            if reason is None:
+                continue
+            if time.time() - last_capture < Profile.MIN_INTERVAL_SECS:
+                INFO(f"lag spike ({reason}), last profile is too recent")
+                continue
+
+            WARN(f"server {self.server.name} lag spike: {reason}")
+            self.prune()
+            entry = self.capture(pid, reason)
+            last_capture = entry["time"]
+            INFO(f"profile saved to {self.profiles}/{entry['folder']}")
+
+        Cmd.rm(self.pid_fname, force=True)
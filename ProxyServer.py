@@ -0,0 +1,401 @@
+"""
+front-end listening on one public port for all servers of this host
+
+route is chosen by server address client puts into handshake packet:
+ - exact hostname from routes.json ({"play.example.com": "survival"})
+ - otherwise first label of hostname, if there is server with such name, so
+   survival.example.com goes to server "survival"
+ - otherwise default server, if it is given
+status requests are answered from per-server cache, so server list refreshes
+of many clients cost backend one ping per Status.CACHE_TTL_SECS. login
+connections are forwarded as they are, handshake included, with asyncio
+protocols pausing reading of one side while other side can not keep up
+
+counters of every route are written to proxy.stats.json every
+Proxy.STATS_SECS, see proxy-stats
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import resource
+import signal
+import struct
+import time
+
+from cprint import *
+from defs import *
+from Ping import Ping
+
+STATE_STATUS = 1
+STATE_LOGIN = 2
+STATE_TRANSFER = 3
+PACKET_DISCONNECT = 0x00
+COUNTERS = ("connections", "active", "status", "refused", "bytes_in", "bytes_out")
+
+
+def read_packet(buffer: bytes | bytearray) -> tuple[int, bytes] | None:
+    """
+    end offset and body of first packet in buffer, None if it is incomplete
+    """
+    try:
+        length, offset = Ping.unpack_varint(buffer)
+    except MCPingError:
+        if len(buffer) < 5 and all(byte & 0x80 for byte in buffer):
+            return None
+        raise
+    if length <= 0 or length > Proxy.MAX_HANDSHAKE:
+        raise MCPingError(f"invalid packet length {length}")
+    if len(buffer) < offset + length:
+        return None
+    return offset + length, bytes(buffer[offset : offset + length])
+
+
+def parse_handshake(body: bytes) -> tuple[int, str, int]:
+    """
+    protocol version, server address and next state of handshake packet
+    """
+    packet_id, offset = Ping.unpack_varint(body)
+    if packet_id != Ping.PACKET_HANDSHAKE:
+        raise MCPingError(f"unexpected handshake packet id {packet_id}")
+    protocol, offset = Ping.unpack_varint(body, offset)
+    size, offset = Ping.unpack_varint(body, offset)
+    address = body[offset : offset + size].decode("utf-8", errors="replace")
+    offset += size + struct.calcsize(">H")
+    state, offset = Ping.unpack_varint(body, offset)
+    # forge appends "\0FML\0" markers, srv records may leave trailing dot
+    return protocol, address.split("\0")[0].rstrip(".").lower(), state
+
+
+def status_packet(name: str, text: str) -> bytes:
+    status = {
+        "version": {"name": name, "protocol": -1},
+        "players": {"online": 0, "max": 0},
+        "description": {"text": text},
+    }
+    return Ping.pack_packet(Ping.PACKET_STATUS, Ping.pack_string(json.dumps(status)))
+
+
+class Pipe(asyncio.Protocol):
+    """
+    one side of forwarded connection, writes everything it reads to peer
+    """
+
+    def __init__(self, counters: dict | None, counter: str):
+        self.counters = counters
+        self.counter = counter
+        self.transport: asyncio.Transport | None = None
+        self.peer: Pipe | None = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self.counters[self.counter] += len(data)
+        self.peer.transport.write(data)
+
+    def pause_writing(self):
+        # peer sends faster than this side receives
+        if self.peer is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None:
+            self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        # close() still sends data left in peer buffer
+        if self.peer is not None:
+            self.peer.transport.close()
+
+
+class Client(Pipe):
+    """
+    connection from player: reads handshake, then answers status from cache
+    or forwards connection to server it is routed to
+    """
+
+    def __init__(self, proxy: ProxyServer):
+        super().__init__(None, "bytes_in")
+        self.proxy = proxy
+        self.buffer = bytearray()
+        self.state: int | None = None
+        self.route: str | None = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.timer = asyncio.get_running_loop().call_later(
+            Proxy.HANDSHAKE_TIMEOUT_SECS, transport.abort
+        )
+
+    def data_received(self, data: bytes):
+        if self.peer is not None:
+            super().data_received(data)
+            return
+        self.buffer += data
+        try:
+            if self.state is None:
+                self.handshake()
+            if self.state == STATE_STATUS:
+                self.status()
+        except MCPingError:
+            self.transport.abort()
+
+    def handshake(self):
+        packet = read_packet(self.buffer)
+        if packet is None:
+            return
+        end, body = packet
+        _, self.address, state = parse_handshake(body)
+        self.state = state
+        self.route = self.proxy.resolve(self.address)
+        if self.route is None:
+            self.proxy.unrouted += 1
+        else:
+            self.counters = self.proxy.counters(self.route)
+            self.counters["connections"] += 1
+
+        if state == STATE_STATUS:
+            self.handshake_body = body
+            del self.buffer[:end]
+        elif self.route is None:
+            self.refuse(f"no server for {self.address}")
+        elif state in (STATE_LOGIN, STATE_TRANSFER):
+            # server gets handshake and everything after it untouched
+            self.transport.pause_reading()
+            asyncio.create_task(self.connect())
+        else:
+            raise MCPingError(f"invalid next state {state}")
+
+    def status(self):
+        while (packet := read_packet(self.buffer)) is not None:
+            end, body = packet
+            del self.buffer[:end]
+            packet_id, _ = Ping.unpack_varint(body)
+            if packet_id == Ping.PACKET_STATUS and self.route is None:
+                reason = f"no server for {self.address}"
+                self.transport.write(status_packet("unavailable", reason))
+            elif packet_id == Ping.PACKET_STATUS:
+                self.counters["status"] += 1
+                asyncio.create_task(self.send_status())
+            elif packet_id == Ping.PACKET_PING:
+                self.transport.write(Ping.pack_packet(Ping.PACKET_PING, body[1:]))
+                self.transport.close()
+                return
+
+    async def send_status(self):
+        packet = await self.proxy.status(self.route, self.handshake_body)
+        if not self.transport.is_closing():
+            self.transport.write(packet)
+
+    def refuse(self, reason: str):
+        if self.counters is not None:
+            self.counters["refused"] += 1
+        if self.state in (STATE_LOGIN, STATE_TRANSFER):
+            reason = Ping.pack_string(json.dumps({"text": reason}))
+            self.transport.write(Ping.pack_packet(PACKET_DISCONNECT, reason))
+        self.transport.close()
+
+    async def connect(self):
+        backend = self.proxy.backend(self.route)
+        try:
+            if backend is None:
+                raise OSError("server is not found")
+            _, server = await asyncio.wait_for(
+                asyncio.get_running_loop().create_connection(
+                    lambda: Pipe(self.counters, "bytes_out"), *backend
+                ),
+                Proxy.CONNECT_TIMEOUT_SECS,
+            )
+        except (OSError, asyncio.TimeoutError):
+            self.refuse(f"server {self.route} is offline")
+            return
+        if self.transport.is_closing():
+            server.transport.close()
+            return
+
+        self.timer.cancel()
+        server.peer, self.peer = self, server
+        self.counters["active"] += 1
+        server.transport.write(bytes(self.buffer))
+        self.counters["bytes_in"] += len(self.buffer)
+        self.buffer = None
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.timer.cancel()
+        if self.peer is not None:
+            self.counters["active"] -= 1
+        super().connection_lost(exc)
+
+
+class ProxyServer:
+    def __init__(self, default: str | None = None):
+        self.default = default
+        self.stats: dict[str, dict[str, int]] = {}
+        self.unrouted = 0
+        self.started = time.time()
+        # server name to address, refreshed in background
+        self.routes: dict[str, tuple[str, int]] = {}
+        self.hostnames: dict[str, str] = {}
+        # server name to (expiration time, status packet)
+        self.cache: dict[str, tuple[float, bytes]] = {}
+        self.pending: dict[str, asyncio.Future] = {}
+
+    def counters(self, route: str) -> dict[str, int]:
+        if route not in self.stats:
+            self.stats[route] = dict.fromkeys(COUNTERS, 0)
+        return self.stats[route]
+
+    def resolve(self, address: str) -> str | None:
+        route = self.hostnames.get(address)
+        if route is None:
+            label = address.split(".")[0]
+            route = label if label in self.routes else self.default
+        return route
+
+    def backend(self, route: str) -> tuple[str, int] | None:
+        return self.routes.get(route)
+
+    def load_routes(self) -> tuple[dict, dict]:
+        from Server import IServer
+
+        routes = {}
+        if os.path.isdir(Folder.WORLDS):
+            for name in os.listdir(Folder.WORLDS):
+                if name.startswith(".") or not os.path.isdir(f"{Folder.WORLDS}/{name}"):
+                    continue
+                try:
+                    routes[name] = IServer.get(name).address()
+                except (MCError, OSError, ValueError):
+                    continue
+        hostnames = {}
+        if os.path.exists(Fname.ROUTES):
+            with open(Fname.ROUTES) as f:
+                hostnames = {host.lower(): name for host, name in json.load(f).items()}
+        return routes, hostnames
+
+    async def refresh_routes(self):
+        while True:
+            try:
+                routes, hostnames = await asyncio.to_thread(self.load_routes)
+            except (OSError, ValueError) as e:
+                WARN(f"cannot load routes: {e}")
+            else:
+                if routes.keys() != self.routes.keys():
+                    INFO(f"routing to {len(routes)} servers")
+                self.routes, self.hostnames = routes, hostnames
+            await asyncio.sleep(Proxy.ROUTES_SECS)
+
+    async def status(self, route: str, handshake: bytes) -> bytes:
+        """
+        status response packet of server, one request to server at a time
+        """
+        cached = self.cache.get(route)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        future = self.pending.get(route)
+        if future is not None:
+            # waiter being cancelled must not cancel request for others
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[route] = future
+        try:
+            try:
+                packet = await self.fetch_status(route, handshake)
+            except (OSError, MCPingError, asyncio.TimeoutError):
+                packet = status_packet("offline", f"server {route} is offline")
+            self.cache[route] = (time.monotonic() + Status.CACHE_TTL_SECS, packet)
+            future.set_result(packet)
+        finally:
+            del self.pending[route]
+            if not future.done():
+                future.cancel()
+        return packet
+
+    async def fetch_status(self, route: str, handshake: bytes) -> bytes:
+        backend = self.backend(route)
+        if backend is None:
+            raise OSError("server is not found")
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*backend), Proxy.CONNECT_TIMEOUT_SECS
+        )
+        try:
+            writer.write(
+                Ping.pack_varint(len(handshake))
+                + handshake
+                + Ping.pack_packet(Ping.PACKET_STATUS)
+            )
+            # status json may be longer than handshake, read it by length
+            data = bytearray()
+            async with asyncio.timeout(Status.TIMEOUT_SECS):
+                while True:
+                    try:
+                        length, offset = Ping.unpack_varint(data)
+                        if len(data) >= offset + length:
+                            return bytes(data[: offset + length])
+                    except MCPingError:
+                        if len(data) >= 5:
+                            raise
+                    chunk = await reader.read(1 << 16)
+                    if not chunk:
+                        raise MCPingError("connection closed by server")
+                    data += chunk
+        finally:
+            writer.close()
+
+    def dump_stats(self):
+        data = {
+            "started": self.started,
+            "updated": time.time(),
+            "unrouted": self.unrouted,
+            "routes": self.stats,
+        }
+        tmp_fname = f"{Fname.PROXY_STATS}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_fname, Fname.PROXY_STATS)
+
+    async def write_stats(self):
+        while True:
+            await asyncio.sleep(Proxy.STATS_SECS)
+            self.dump_stats()
+
+    async def serve(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+
+        self.routes, self.hostnames = self.load_routes()
+        tasks = [
+            asyncio.create_task(self.refresh_routes()),
+            asyncio.create_task(self.write_stats()),
+        ]
+        server = await loop.create_server(
+            lambda: Client(self), host, port, backlog=Proxy.BACKLOG
+        )
+        OK(f"proxy listening on {host}:{port}, routing to {len(self.routes)} servers")
+        try:
+            await stopped.wait()
+        finally:
+            server.close()
+            for task in tasks:
+                task.cancel()
+            self.dump_stats()
+
+
+def serve(address: tuple[str, int], default: str | None = None):
+    # every forwarded connection takes two descriptors
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    try:
+        import uvloop
+    except ModuleNotFoundError:
+        INFO("uvloop is not installed, using default event loop")
+        asyncio.run(ProxyServer(default).serve(*address))
+    else:
+        uvloop.run(ProxyServer(default).serve(*address))
@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import pathlib
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+
+from cprint import *
+from defs import *
+from Cmd import Cmd
+
+
+class RamWorld:
+    """
+    keep server world in memory-backed directory (tmpfs) while it runs
+
+    world folder data/<level-name> is renamed to data/<level-name>.disk, copied
+    to RAM and replaced with symlink to RAM copy, so server does not notice
+    anything. RAM copy is synced back to .disk copy on schedule, on save and on
+    stop, after that symlink is replaced by .disk copy again
+
+    RAM_WORLD state file exists while world lives in RAM, so state file of not
+    running server means it crashed before final sync
+    """
+
+    def __init__(self, server):
+        self.server = server
+        level = server.properties().get("level-name") or "world"
+        data = f"{server.folder}/{Folder.DATA}"
+        self.world = f"{data}/{level}"
+        self.disk = f"{self.world}.disk"
+        self.ram = f"{Ram.ROOT}/{server.name}/{level}"
+        self.state_fname = f"{server.folder}/RAM_WORLD"
+        self.sync_pid_fname = f"{server.folder}/RAM_SYNC_PID"
+
+    def active(self) -> bool:
+        return pathlib.Path(self.state_fname).exists()
+
+    def state(self) -> dict:
+        return json.loads(Cmd.fread(self.state_fname))
+
+    def write_state(self, **kwargs):
+        state = self.state() if self.active() else {}
+        state |= kwargs
+        tmp_fname = f"{self.state_fname}.tmp"
+        Cmd.fwrite(tmp_fname, Cmd.jdump(state, indent=4))
+        os.replace(tmp_fname, self.state_fname)
+
+    @contextmanager
+    def lock(self):
+        """
+        sync daemon, save and stop may sync at the same time
+        """
+        with open(f"{self.server.folder}/RAM_WORLD.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def setup(self):
+        """
+        move world to RAM before server start
+        """
+        if self.active():
+            ABORT(f"RAM world of {self.server.name} is already set up")
+
+        if not pathlib.Path(self.world).exists():
+            # new server, world will be generated right in RAM
+            Cmd.mkdir(self.world)
+
+        Cmd.mkdir(os.path.dirname(self.ram))
+        free = shutil.disk_usage(os.path.dirname(self.ram)).free
+        size = self.tree_size(self.world)
+        if size > free * Ram.MAX_FILL:
+            FAIL(
+                f"world size {size >> 20}MB does not fit into {Ram.ROOT} "
+                f"({free >> 20}MB free)"
+            )
+            raise MCInvalidOperationError()
+
+        INFO(f"copying world {self.world} ({size >> 20}MB) to {self.ram}")
+        try:
+            Cmd.rm(self.ram, recursive=True, force=True)
+            Cmd.echo("cp", "-a", self.world, self.ram)
+            shutil.copytree(self.world, self.ram, symlinks=True)
+
+            self.write_state(
+                ram=self.ram, disk=self.disk, started=time.time(), synced=0
+            )
+            Cmd.echo("mv", self.world, self.disk)
+            os.rename(self.world, self.disk)
+            Cmd.echo("ln", "-s", self.ram, self.world)
+            os.symlink(os.path.abspath(self.ram), self.world)
+        except BaseException:
+            # server did not run yet, so .disk copy is up to date
+            self.teardown()
+            raise
+
+    def teardown(self):
+        """
+        put .disk copy of world back to it's place and free RAM
+        """
+        if os.path.islink(self.world):
+            Cmd.rm(self.world)
+        if pathlib.Path(self.disk).exists():
+            Cmd.echo("mv", self.disk, self.world)
+            os.rename(self.disk, self.world)
+        Cmd.rm(os.path.dirname(self.ram), recursive=True, force=True)
+        Cmd.rm(self.state_fname, force=True)
+
+    @classmethod
+    def tree_size(cls, path: str) -> int:
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    pass
+        return size
+
+    def usage(self) -> int:
+        """
+        memory taken by RAM copy of world
+        """
+        if not self.active():
+            return 0
+        return self.tree_size(self.ram)
+
+    @classmethod
+    def sync_tree(cls, src: str, dst: str) -> tuple[int, int, int]:
+        """
+        make dst same as src copying only files which size or mtime differ
+        returns number of copied files, copied bytes and deleted entries
+        """
+        copied = copied_bytes = deleted = 0
+        for root, dirs, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            dst_root = os.path.normpath(os.path.join(dst, rel))
+            os.makedirs(dst_root, exist_ok=True)
+
+            for name in files:
+                s = os.lstat(os.path.join(root, name))
+                try:
+                    d = os.lstat(os.path.join(dst_root, name))
+                    if s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns:
+                        continue
+                except FileNotFoundError:
+                    pass
+
+                tmp = os.path.join(dst_root, f".{name}.sync")
+                shutil.copy2(os.path.join(root, name), tmp, follow_symlinks=False)
+                with open(tmp, "rb") as f:
+                    os.fsync(f.fileno())
+                os.replace(tmp, os.path.join(dst_root, name))
+                copied += 1
+                copied_bytes += s.st_size
+
+            # remove what was deleted in src since last sync
+            names = set(dirs) | set(files)
+            for name in os.listdir(dst_root):
+                if name in names:
+                    continue
+                path = os.path.join(dst_root, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+                deleted += 1
+
+        return copied, copied_bytes, deleted
+
+    def sync(self):
+        """
+        copy changes from RAM to disk, caller must make sure server does not
+        write world at this moment
+        """
+        start = time.monotonic()
+        copied, copied_bytes, deleted = self.sync_tree(self.ram, self.disk)
+        self.write_state(synced=time.time())
+        INFO(
+            f"synced RAM world of {self.server.name}: {copied} files, "
+            f"{copied_bytes >> 10}KB, {deleted} deleted, "
+            f"{time.monotonic() - start:.2f}s"
+        )
+
+    def sync_live(self):
+        """
+        sync world of running server: disable autosave, flush world to RAM,
+        sync it and enable autosave again
+        """
+        with self.lock():
+            if not self.active():
+                return
+            with self.server.save_paused():
+                self.sync()
+
+    def sync_final(self):
+        """
+        sync world of stopped server and move it back to disk
+        """
+        with self.lock():
+            if not self.active():
+                return
+            with STEP(f"syncing RAM world of {self.server.name} back to disk"):
+                if pathlib.Path(self.ram).exists():
+                    self.sync()
+                self.teardown()
+
+    @classmethod
+    def wait_for_log(cls, fname: str, offset: int, line: str):
+        """
+        wait for line to appear in log after offset
+        """
+        from Watch import Watcher
+
+        def found() -> bool:
+            with open(fname, "rb") as f:
+                f.seek(offset)
+                return line.encode() in f.read()
+
+        if not Watcher.shared().wait(found, [fname], Ram.SAVE_TIMEOUT_SECS):
+            FAIL(f'server did not report "{line}" in {Ram.SAVE_TIMEOUT_SECS}s')
+            raise MCSystemError()
+
+    def check_crashed(self, recover: bool):
+        """
+        state file left by crashed server: refuse to start or recover it
+        """
+        if not self.active():
+            return
+
+        state = self.state()
+        synced = state.get("synced") or state.get("started")
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(synced))
+        if not recover:
+            FAIL(
+                f"server {self.server.name} was stopped without syncing RAM world "
+                f"to disk, last sync at {when}"
+            )
+            INFO("run with --recover to sync what is left and start")
+            raise MCInvalidOperationError()
+
+        if not pathlib.Path(self.ram).exists():
+            WARN(f"RAM copy is lost, restoring world saved at {when}")
+        self.sync_final()
+
+    def start_sync_daemon(self):
+        from Daemon import daemon
+
+        main = pathlib.Path(__file__).absolute().parent / "main.py"
+        cmd = [sys.executable, str(main), Action.RAM_SYNC, "--name", self.server.name]
+        daemon(
+            cmd,
+            stdout=f"{self.server.folder}/ram-sync.log",
+            pidfile=self.sync_pid_fname,
+            cwd=os.getcwd(),
+        )
+        Cmd.wait_for_file(self.sync_pid_fname)
+        OK(f"RAM sync daemon started with pid {Cmd.fread(self.sync_pid_fname)}")
+
+    def stop_sync_daemon(self):
+        if not pathlib.Path(self.sync_pid_fname).exists():
+            return
+        pid = int(Cmd.fread(self.sync_pid_fname))
+        # daemon touches world only under lock, so it is safe to kill it here
+        with self.lock():
+            Cmd.kill(pid)
+        Cmd.waitpid(pid, timeout_mins=Ram.SAVE_TIMEOUT_SECS / 60)
+        Cmd.rm(self.sync_pid_fname, force=True)
+
+    def sync_loop(self):
+        """
+        body of sync daemon: sync world periodically while server runs, make
+        final sync if server process died without stop
+        """
+        while self.active():
+            pid = self.server.pid()
+            # wakes up at once when server process dies
+            if pid is None or Cmd.waitpids([pid], Ram.SYNC_SECS):
+                WARN(f"server {self.server.name} exited, making final sync")
+                self.sync_final()
+                break
+            try:
+                self.sync_live()
+            except MCError:
+                WARN("periodic sync failed, will retry")
+        Cmd.rm(self.sync_pid_fname, force=True)
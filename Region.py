@@ -0,0 +1,413 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import struct
+import time
+import zlib
+
+from cprint import *
+from defs import *
+
+GZIP = 1
+ZLIB = 2
+NONE = 3
+LZ4 = 4
+# chunk is stored in c.<x>.<z>.mcc file next to region, record keeps only type
+EXTERNAL = 0x80
+
+CODECS = {"deflate": ZLIB, "lz4": LZ4, "none": NONE}
+
+# r.<x>.<z>.mca file name or just <x>,<z> region coordinates
+REGION_NAME = re.compile(r"(?:r\.)?(-?\d+)[.,](-?\d+)(?:\.mca)?")
+
+# lz4-java LZ4BlockOutputStream format, used by minecraft for lz4 chunks
+LZ4_MAGIC = b"LZ4Block"
+LZ4_HEADER = struct.Struct("<8sBiii")
+LZ4_METHOD_RAW = 0x10
+LZ4_METHOD_LZ4 = 0x20
+LZ4_BLOCK_SIZE = 1 << 16
+LZ4_LEVEL = 6  # log2(LZ4_BLOCK_SIZE) - 10
+LZ4_SEED = 0x9747B28C
+
+
+def xxh32(data: bytes, seed: int) -> int:
+    """
+    pure python xxHash32, used only when xxhash module is not installed
+    """
+    P1, P2, P3, P4, P5 = 2654435761, 2246822519, 3266489917, 668265263, 374761393
+    M = 0xFFFFFFFF
+
+    def rotl(x: int, r: int) -> int:
+        return ((x << r) | (x >> (32 - r))) & M
+
+    n = len(data)
+    i = 0
+    if n >= 16:
+        v = [(seed + P1 + P2) & M, (seed + P2) & M, seed & M, (seed - P1) & M]
+        while i <= n - 16:
+            for j, lane in enumerate(struct.unpack_from("<4I", data, i)):
+                v[j] = rotl((v[j] + lane * P2) & M, 13) * P1 & M
+            i += 16
+        h = (rotl(v[0], 1) + rotl(v[1], 7) + rotl(v[2], 12) + rotl(v[3], 18)) & M
+    else:
+        h = (seed + P5) & M
+
+    h = (h + n) & M
+    while i + 4 <= n:
+        h = rotl((h + struct.unpack_from("<I", data, i)[0] * P3) & M, 17) * P4 & M
+        i += 4
+    while i < n:
+        h = rotl((h + data[i] * P5) & M, 11) * P1 & M
+        i += 1
+
+    h = (h ^ (h >> 15)) * P2 & M
+    h = (h ^ (h >> 13)) * P3 & M
+    return h ^ (h >> 16)
+
+
+class Region:
+    """
+    reader and writer of anvil region (.mca) files
+
+    file starts with two 4KiB tables of 1024 entries: chunk locations (3 byte
+    offset and 1 byte size, both in 4KiB sectors) and chunk timestamps. every
+    chunk record is 4 byte length, 1 byte compression type and compressed
+    data, padded to whole sectors. sectors of chunks which were moved or
+    shrunk stay in file as free space until file is rewritten
+    """
+
+    @classmethod
+    def checksum(cls, data: bytes) -> int:
+        try:
+            import xxhash
+
+            value = xxhash.xxh32_intdigest(data, LZ4_SEED)
+        except ModuleNotFoundError:
+            value = xxh32(data, LZ4_SEED)
+        # lz4-java checksum keeps only 28 bits of hash
+        return value & 0xFFFFFFF
+
+    @classmethod
+    def lz4_compress(cls, data: bytes) -> bytes:
+        import lz4.block
+
+        out = bytearray()
+        for i in range(0, len(data), LZ4_BLOCK_SIZE):
+            block = data[i : i + LZ4_BLOCK_SIZE]
+            compressed = lz4.block.compress(block, store_size=False)
+            method = LZ4_METHOD_LZ4
+            if len(compressed) >= len(block):
+                compressed, method = block, LZ4_METHOD_RAW
+            out += LZ4_HEADER.pack(
+                LZ4_MAGIC,
+                method | LZ4_LEVEL,
+                len(compressed),
+                len(block),
+                cls.checksum(block),
+            )
+            out += compressed
+        # end of stream mark
+        out += LZ4_HEADER.pack(LZ4_MAGIC, LZ4_METHOD_RAW | LZ4_LEVEL, 0, 0, 0)
+        return bytes(out)
+
+    @classmethod
+    def lz4_decompress(cls, data: bytes) -> bytes:
+        import lz4.block
+
+        out = bytearray()
+        offset = 0
+        while offset < len(data):
+            magic, token, size, original, check = LZ4_HEADER.unpack_from(data, offset)
+            offset += LZ4_HEADER.size
+            if magic != LZ4_MAGIC:
+                raise MCRegionError("bad lz4 block magic")
+            if original == 0:
+                break
+            block = data[offset : offset + size]
+            offset += size
+            if token & 0xF0 == LZ4_METHOD_LZ4:
+                block = lz4.block.decompress(block, uncompressed_size=original)
+            elif token & 0xF0 != LZ4_METHOD_RAW:
+                raise MCRegionError(f"unknown lz4 block method {token:#x}")
+            if len(block) != original or cls.checksum(block) != check & 0xFFFFFFF:
+                raise MCRegionError("lz4 block checksum mismatch")
+            out += block
+        return bytes(out)
+
+    @classmethod
+    def decompress(cls, codec: int, data: bytes) -> bytes:
+        if codec == GZIP:
+            return gzip.decompress(data)
+        if codec == ZLIB:
+            return zlib.decompress(data)
+        if codec == NONE:
+            return data
+        if codec == LZ4:
+            return cls.lz4_decompress(data)
+        raise MCRegionError(f"unknown chunk compression {codec}")
+
+    @classmethod
+    def compress(cls, codec: int, data: bytes) -> bytes:
+        if codec == ZLIB:
+            return zlib.compress(data)
+        if codec == NONE:
+            return data
+        if codec == LZ4:
+            return cls.lz4_compress(data)
+        raise MCRegionError(f"cannot compress chunks with {codec}")
+
+    @classmethod
+    def read(cls, data: bytes) -> list[tuple[int, int, bytes] | None]:
+        """
+        parse region file to list of 1024 (timestamp, type, data) records,
+        None for chunks which were not generated
+        """
+        if len(data) == 0:
+            return [None] * Anvil.CHUNKS
+        if len(data) < 2 * Anvil.SECTOR:
+            raise MCRegionError("file is shorter than header")
+
+        locations = struct.unpack_from(f">{Anvil.CHUNKS}I", data, 0)
+        timestamps = struct.unpack_from(f">{Anvil.CHUNKS}I", data, Anvil.SECTOR)
+        chunks = []
+        for i, location in enumerate(locations):
+            sector, count = location >> 8, location & 0xFF
+            if location == 0:
+                chunks.append(None)
+                continue
+            start = sector * Anvil.SECTOR
+            if sector < 2 or start + 5 > len(data):
+                raise MCRegionError(f"chunk {i} points outside of file")
+            length, codec = struct.unpack_from(">iB", data, start)
+            if length < 1 or length + 4 > count * Anvil.SECTOR:
+                raise MCRegionError(f"chunk {i} has bad length {length}")
+            if start + 4 + length > len(data):
+                raise MCRegionError(f"chunk {i} is truncated")
+            chunks.append((timestamps[i], codec, data[start + 5 : start + 4 + length]))
+        return chunks
+
+    @classmethod
+    def write(cls, chunks: list[tuple[int, int, bytes] | None]) -> bytes:
+        """
+        build region file with chunks placed one after another without gaps
+        """
+        locations = []
+        timestamps = []
+        body = bytearray()
+        sector = 2
+        for chunk in chunks:
+            if chunk is None:
+                locations.append(0)
+                timestamps.append(0)
+                continue
+            timestamp, codec, payload = chunk
+            record = struct.pack(">iB", len(payload) + 1, codec) + payload
+            count = -(-len(record) // Anvil.SECTOR)
+            record += bytes(count * Anvil.SECTOR - len(record))
+            locations.append(sector << 8 | count)
+            timestamps.append(timestamp)
+            body += record
+            sector += count
+
+        header = struct.pack(f">{Anvil.CHUNKS}I", *locations)
+        header += struct.pack(f">{Anvil.CHUNKS}I", *timestamps)
+        return header + body
+
+    @classmethod
+    def splice(cls, data: bytes, snapshot: bytes, indexes: list[int]) -> bytes:
+        """
+        replace chunks at indexes of region file with ones from older copy of
+        it, chunks missing there are removed
+        """
+        chunks = cls.read(data)
+        old = cls.read(snapshot)
+        for i in indexes:
+            chunks[i] = old[i]
+        return cls.write(chunks)
+
+    @classmethod
+    def parse_name(cls, text: str) -> tuple[int, int]:
+        match = REGION_NAME.fullmatch(text)
+        if match is None:
+            FAIL(f'bad region "{text}", expected r.<x>.<z>.mca or <x>,<z>')
+            raise MCInvalidOperationError()
+        return int(match[1]), int(match[2])
+
+    @classmethod
+    def chunks_in_box(
+        cls, x1: int, z1: int, x2: int, z2: int
+    ) -> dict[tuple[int, int], list[int]]:
+        """
+        indexes of chunks in region files covering block area, bounds are
+        inclusive
+        """
+        cx1, cx2 = sorted((x1 >> 4, x2 >> 4))
+        cz1, cz2 = sorted((z1 >> 4, z2 >> 4))
+        regions = {}
+        for rz in range(cz1 >> 5, (cz2 >> 5) + 1):
+            for rx in range(cx1 >> 5, (cx2 >> 5) + 1):
+                xs = range(max(cx1, rx * 32), min(cx2, rx * 32 + 31) + 1)
+                zs = range(max(cz1, rz * 32), min(cz2, rz * 32 + 31) + 1)
+                regions[rx, rz] = [(cz & 31) * 32 + (cx & 31) for cz in zs for cx in xs]
+        return regions
+
+    @classmethod
+    def digest(cls, codec: int, payload: bytes) -> bytes:
+        if codec & EXTERNAL:
+            return hashlib.blake2b(payload).digest()
+        return hashlib.blake2b(cls.decompress(codec, payload)).digest()
+
+    @classmethod
+    def convert(
+        cls, chunk: tuple[int, int, bytes], codec: int | None
+    ) -> tuple[int, int, bytes]:
+        timestamp, old_codec, payload = chunk
+        if codec is None or old_codec == codec or old_codec & EXTERNAL:
+            return chunk
+
+        new_payload = cls.compress(codec, cls.decompress(old_codec, payload))
+        if len(new_payload) + 5 > Anvil.MAX_SECTORS * Anvil.SECTOR:
+            # would need external .mcc file, keep chunk as it is
+            return chunk
+        return timestamp, codec, new_payload
+
+    @classmethod
+    def compact_file(cls, fname: str, codec: int | None) -> dict:
+        """
+        rewrite region file without free sectors, recompressing chunks to
+        codec if given. new file is read back and compared chunk by chunk
+        before it replaces original
+        """
+        start = time.monotonic()
+        report = {"fname": fname, "before": os.path.getsize(fname), "after": None}
+        report |= {"chunks": 0, "recompressed": 0, "error": None}
+        tmp_fname = os.path.join(
+            os.path.dirname(fname), f".{os.path.basename(fname)}.compact"
+        )
+        try:
+            with open(fname, "rb") as f:
+                chunks = cls.read(f.read())
+
+            converted = []
+            expected = []
+            for chunk in chunks:
+                if chunk is None:
+                    converted.append(None)
+                    expected.append(None)
+                    continue
+                new_chunk = cls.convert(chunk, codec)
+                converted.append(new_chunk)
+                report["chunks"] += 1
+                if new_chunk is chunk:
+                    expected.append((chunk[0], chunk[1], chunk[2]))
+                else:
+                    report["recompressed"] += 1
+                    expected.append((chunk[0], cls.digest(chunk[1], chunk[2])))
+
+            data = cls.write(converted)
+            with open(tmp_fname, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            shutil.copymode(fname, tmp_fname)
+
+            with open(tmp_fname, "rb") as f:
+                written = cls.read(f.read())
+            for i, (got, want) in enumerate(zip(written, expected)):
+                if want is None or got is None:
+                    ok = want is got
+                elif len(want) == 3:
+                    ok = got == want
+                else:
+                    ok = got[0] == want[0] and cls.digest(got[1], got[2]) == want[1]
+                if not ok:
+                    raise MCRegionError(f"chunk {i} differs after rewrite")
+
+            os.replace(tmp_fname, fname)
+            report["after"] = len(data)
+        except Exception as e:
+            if os.path.exists(tmp_fname):
+                os.unlink(tmp_fname)
+            report["error"] = f"{type(e).__name__}: {e}"
+
+        report["secs"] = round(time.monotonic() - start, 3)
+        return report
+
+    @classmethod
+    def find(cls, world: str) -> list[str]:
+        """
+        region files of all dimensions of world, including entities and poi
+        empty files server created but never wrote to are skipped
+        """
+        fnames = []
+        for root, _, files in os.walk(world):
+            for name in files:
+                fname = os.path.join(root, name)
+                if name.endswith(".mca") and os.path.getsize(fname) > 0:
+                    fnames.append(fname)
+        # biggest files first, so pool is not left waiting for one of them
+        return sorted(fnames, key=os.path.getsize, reverse=True)
+
+    @classmethod
+    def check_codec(cls, compression: str):
+        if compression == "lz4":
+            try:
+                import lz4.block
+            except ModuleNotFoundError:
+                FAIL("lz4 module is not installed, install it with")
+                INFO("pip3 install lz4")
+                raise MCInvalidOperationError()
+
+    @classmethod
+    def compact(cls, world: str, compression: str, jobs: int | None) -> list[dict]:
+        """
+        compact all region files of world on pool of jobs processes
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        cls.check_codec(compression)
+        codec = CODECS.get(compression)
+        fnames = cls.find(world)
+        if not fnames:
+            OK(f"no region files in {world}")
+            return []
+
+        jobs = jobs or os.cpu_count() or 1
+        INFO(f"compacting {len(fnames)} region files with {jobs} jobs")
+        start = time.monotonic()
+        report = []
+        # forkserver: this may run in threaded control daemon
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+            futures = [pool.submit(cls.compact_file, f, codec) for f in fnames]
+            for future in as_completed(futures):
+                entry = future.result()
+                entry["fname"] = os.path.relpath(entry["fname"], world)
+                if entry["error"] is None:
+                    saved = entry["before"] - entry["after"]
+                    OK(
+                        f'{entry["fname"]}: {entry["before"] >> 10}KB -> '
+                        f'{entry["after"] >> 10}KB ({saved >> 10}KB saved, '
+                        f'{entry["recompressed"]}/{entry["chunks"]} chunks '
+                        f'recompressed) in {entry["secs"]:.2f}s'
+                    )
+                else:
+                    FAIL(f'{entry["fname"]}: {entry["error"]}, file left untouched')
+                report.append(entry)
+
+        done = [entry for entry in report if entry["error"] is None]
+        before = sum(entry["before"] for entry in done)
+        after = sum(entry["after"] for entry in done)
+        INFO(
+            f"{len(done)} of {len(report)} files compacted, "
+            f"{before >> 20}MB -> {after >> 20}MB "
+            f"({(before - after) >> 20}MB saved) in {time.monotonic() - start:.1f}s"
+        )
+        if len(done) != len(report):
+            raise MCSystemError()
+        return report
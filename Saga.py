@@ -1,13 +1,146 @@
 from __future__ import annotations
 
-from typing import Callable
+import json
+import os
+import pathlib
+import time
+from typing import Any, Callable
+
 from cprint import *
+from defs import *
+from Trace import span
+
+# operations running in this process, journals of other processes are
+# checked by pid
+_active: set[str] = set()
+
+
+class Journal:
+    """
+    on-disk record of long operation: it's arguments, completed steps and
+    compensation commands needed to roll it back
+    journal exists only while operation is in progress, so journal found on
+    startup means previous attempt was interrupted
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.fname = f"{Folder.JOURNAL}/{operation}.json"
+        self.data = {
+            "operation": operation,
+            "pid": os.getpid(),
+            "started": time.time(),
+            "params": {},
+            "steps": [],
+            "compensations": [],
+        }
+
+    @classmethod
+    def load(cls, operation: str) -> Journal | None:
+        journal = cls(operation)
+        try:
+            with open(journal.fname) as f:
+                journal.data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return journal
+
+    @classmethod
+    def interrupted(cls) -> list[Journal]:
+        if not pathlib.Path(Folder.JOURNAL).exists():
+            return []
+        journals = []
+        for fname in sorted(pathlib.Path(Folder.JOURNAL).glob("*.json")):
+            journal = cls.load(fname.stem)
+            if journal is not None:
+                journals.append(journal)
+        return journals
+
+    def in_progress(self) -> bool:
+        """
+        check if operation is still running, not interrupted
+        """
+        pid = self.data.get("pid")
+        if pid == os.getpid():
+            return self.operation in _active
+        try:
+            os.kill(pid, 0)
+        except (ProcessLookupError, TypeError):
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def write(self):
+        pathlib.Path(Folder.JOURNAL).mkdir(parents=True, exist_ok=True)
+        tmp_fname = f"{self.fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self.fname)
+
+    def remove(self):
+        pathlib.Path(self.fname).unlink(missing_ok=True)
+
+    def rollback(self):
+        """
+        run recorded compensation commands of interrupted operation
+        """
+        from Cmd import Cmd
+
+        for cmd in reversed(self.data["compensations"]):
+            Cmd.builtin(cmd)
+        self.remove()
 
 
 class Saga:
-    def __init__(self):
+    """
+    run steps with compensations executed in reverse order on failure
+
+    with operation name given, saga is backed by Journal: completed steps and
+    compensation commands are persisted, so if process dies, next saga with
+    the same operation name resumes it skipping completed steps, or it can be
+    rolled back with Saga.rollback(operation)
+    """
+
+    def __init__(self, operation: str | None = None, params: dict | None = None):
         self.compensations = []
         self.defers = []
+        self.journal = None
+        self.resumed = False
+
+        if operation is None:
+            return
+
+        self.journal = Journal.load(operation)
+        if self.journal is not None and self.journal.in_progress():
+            FAIL(f'operation "{operation}" is already in progress')
+            self.journal = None
+            raise MCInvalidOperationError()
+        _active.add(operation)
+
+        if self.journal is None:
+            self.journal = Journal(operation)
+            self.journal.data["params"] = params or {}
+            self.journal.write()
+            return
+
+        if params is not None and self.journal.data["params"] != params:
+            _active.discard(operation)
+            FAIL(
+                f'interrupted operation "{operation}" was started with different '
+                f'parameters: {self.journal.data["params"]}'
+            )
+            INFO(f'roll it back with "journal --rollback {operation}"')
+            raise MCInvalidOperationError()
+
+        INFO(f'resuming interrupted operation "{operation}"')
+        self.resumed = True
+        self.journal.data["pid"] = os.getpid()
+        self.journal.write()
+        for cmd in self.journal.data["compensations"]:
+            self.compensations.append(self.command(cmd))
 
     def __enter__(self):
         return self
@@ -15,20 +148,73 @@ class Saga:
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is not None:
             DEBUG("running compensation steps")
-            for compensation in reversed(self.compensations):
-                compensation()
+            for label, compensation in reversed(self.compensations):
+                with span(label, "saga"):
+                    compensation()
 
         for defer in reversed(self.defers):
             defer()
 
+        if self.journal is not None:
+            self.journal.remove()
+            _active.discard(self.journal.operation)
+
         if exc_type is not None:
             DEBUG(exc_type)
             raise
 
         return False
 
-    def compensation(self, compensation):
-        self.compensations.append(compensation)
+    @classmethod
+    def command(cls, cmd: str | list[str]) -> tuple[str, Callable[[], Any]]:
+        from Cmd import Cmd
+
+        label = cmd if isinstance(cmd, str) else " ".join(cmd)
+        return f"compensation: {label}", lambda: Cmd.builtin(cmd)
+
+    def compensation(self, compensation: Callable[[], Any] | list[str]):
+        """
+        compensation given as command argv is also recorded to journal, so
+        it can be executed to roll back operation interrupted by process death
+        """
+        if isinstance(compensation, (str, list)):
+            if self.journal is not None:
+                recorded = self.journal.data["compensations"]
+                if compensation in recorded:
+                    # already registered by interrupted attempt
+                    return
+                recorded.append(compensation)
+                self.journal.write()
+            self.compensations.append(self.command(compensation))
+        else:
+            label = getattr(compensation, "__qualname__", "callable")
+            self.compensations.append((f"compensation: {label}", compensation))
 
     def defer(self, action):
         self.defers.append(action)
+
+    def step(self, name: str, action: Callable[[], Any]):
+        """
+        run action once, step completed by interrupted attempt is skipped
+        """
+        if self.journal is not None and name in self.journal.data["steps"]:
+            OK(f'step "{name}" already done')
+            return
+
+        with span(f"saga step: {name}", "saga"):
+            action()
+        if self.journal is not None:
+            self.journal.data["steps"].append(name)
+            self.journal.write()
+
+    @classmethod
+    def rollback(cls, operation: str):
+        journal = Journal.load(operation)
+        if journal is None:
+            FAIL(f'no interrupted operation "{operation}"')
+            raise MCNotFoundError()
+        if journal.in_progress():
+            FAIL(f'operation "{operation}" is still in progress')
+            raise MCInvalidOperationError()
+        with STEP(f'rolling back "{operation}"'):
+            journal.rollback()
@@ -0,0 +1,422 @@
+from __future__ import annotations
+
+import datetime
+import fcntl
+import json
+import os
+import pathlib
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from cprint import *
+from defs import *
+
+ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+}
+
+# (low, high) of minute, hour, day of month, month, day of week fields
+RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+class Cron:
+    """
+    standard 5 field cron expression: minute hour day-of-month month
+    day-of-week, fields support *, lists, ranges and steps (*/15, 1-5/2)
+    as in cron, if both day fields are restricted, day matching any of them
+    is used
+    """
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        fields = ALIASES.get(expr, expr).split()
+        if len(fields) != 5:
+            FAIL(f'cron expression "{expr}" must have 5 fields')
+            raise MCInvalidOperationError()
+        self.fields = [self.parse(f, *r) for f, r in zip(fields, RANGES)]
+        # sunday is both 0 and 7
+        if 7 in self.fields[4]:
+            self.fields[4].add(0)
+        self.any_dom = fields[2] == "*"
+        self.any_dow = fields[4] == "*"
+
+    @classmethod
+    def parse(cls, field: str, low: int, high: int) -> set[int]:
+        values = set()
+        for part in field.split(","):
+            rng, _, step = part.partition("/")
+            try:
+                if rng == "*":
+                    start, end = low, high
+                elif "-" in rng:
+                    start, end = map(int, rng.split("-"))
+                else:
+                    start = end = int(rng)
+                step = int(step) if step else 1
+            except ValueError:
+                FAIL(f'invalid cron field "{field}"')
+                raise MCInvalidOperationError()
+            if start < low or end > high or start > end or step < 1:
+                FAIL(f'cron field "{field}" is out of range {low}-{high}')
+                raise MCInvalidOperationError()
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, day: datetime.datetime) -> bool:
+        dom = day.day in self.fields[2]
+        dow = (day.isoweekday() % 7) in self.fields[4]
+        if self.any_dom or self.any_dow:
+            return dom and dow
+        return dom or dow
+
+    def next(self, after: float) -> float:
+        """
+        first matching minute strictly after timestamp
+        """
+        minutes, hours, _, months, _ = self.fields
+        t = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+        t += datetime.timedelta(minutes=1)
+        # every combination repeats within few years
+        limit = t + datetime.timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in months:
+                t = (t.replace(day=1) + datetime.timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+            elif not self.day_matches(t):
+                t = (t + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif t.hour not in hours:
+                t = (t + datetime.timedelta(hours=1)).replace(minute=0)
+            elif t.minute not in minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t.timestamp()
+        FAIL(f'cron expression "{self.expr}" never matches')
+        raise MCInvalidOperationError()
+
+
+class Schedule:
+    """
+    tasks are stored in schedule.json, edited from cli:
+        {
+            "limits": {"io": 2},
+            "tasks": {
+                "<id>": {
+                    "cron": "*/30 * * * *",
+                    "commands": [["save", "--all"]],
+                    "jitter": 300,
+                    "group": "io"
+                }
+            }
+        }
+    commands of task are main.py argv run one after another, tasks of the
+    same group run at most limits[group] at a time (Timer.GROUP_JOBS if not
+    configured)
+
+    run history is written to schedule.state.json by scheduler:
+    scheduled time, due time with jitter, last start, duration, result and
+    number of missed runs of every task
+    """
+
+    def __init__(self, fname=Fname.SCHEDULE, state_fname=Fname.SCHEDULE_STATE):
+        self.fname = fname
+        self.state_fname = state_fname
+        self.limits: dict[str, int] = {}
+        self.tasks: dict[str, dict] = {}
+        self.state: dict[str, dict] = {}
+
+    def load(self) -> Schedule:
+        if pathlib.Path(self.fname).exists():
+            with open(self.fname) as f:
+                data = json.load(f)
+            self.limits = data.get("limits", {})
+            self.tasks = data.get("tasks", {})
+        if pathlib.Path(self.state_fname).exists():
+            with open(self.state_fname) as f:
+                self.state = json.load(f)
+        return self
+
+    @classmethod
+    def dump(cls, fname: str, data: dict):
+        tmp_fname = f"{fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_fname, fname)
+
+    def save(self):
+        self.dump(self.fname, {"limits": self.limits, "tasks": self.tasks})
+
+    def save_state(self):
+        self.dump(self.state_fname, self.state)
+
+    def add(self, task_id: str, cron: str, commands: list[list[str]], jitter, group):
+        import main
+
+        Cron(cron)
+        parser = main.build_parser()
+        for argv in commands:
+            try:
+                parser.parse_args(argv)
+            except SystemExit:
+                FAIL(f"invalid command: {' '.join(argv)}")
+                raise MCInvalidOperationError()
+
+        self.tasks[task_id] = {
+            "cron": cron,
+            "commands": commands,
+            "jitter": jitter,
+            "group": group,
+        }
+        self.save()
+        OK(f'task "{task_id}" scheduled at "{cron}"')
+
+    def remove(self, task_id: str):
+        if task_id not in self.tasks:
+            FAIL(f'no task "{task_id}" in schedule')
+            raise MCNotFoundError()
+        del self.tasks[task_id]
+        self.save()
+        OK(f'task "{task_id}" removed')
+
+    def set_limit(self, group: str, jobs: int):
+        self.limits[group] = jobs
+        self.save()
+        OK(f'at most {jobs} tasks of group "{group}" run at a time')
+
+    def show(self) -> list[dict]:
+        fmt = lambda t: time.strftime("%Y-%m-%d %H:%M", time.localtime(t))
+        response = []
+        for task_id, task in self.tasks.items():
+            state = self.state.get(task_id, {})
+            commands = "; ".join(" ".join(argv) for argv in task["commands"])
+            log(f'{task_id}: "{task["cron"]}" {commands}')
+            if state.get("due"):
+                log(f'    next run {fmt(state["due"])}')
+            if state.get("started"):
+                result = "ok" if state.get("ok") else f'failed: {state.get("error")}'
+                log(
+                    f'    last run {fmt(state["started"])}, '
+                    f'{state.get("secs", 0):.1f}s, {result}'
+                )
+            if state.get("missed"):
+                log(f'    missed {state["missed"]} runs')
+            response.append({"id": task_id} | task | {"state": state})
+        if not response:
+            OK("schedule is empty")
+        return response
+
+
+class Scheduler:
+    """
+    runs tasks of schedule inside control daemon, so tasks do not start new
+    interpreter and share per-server locks with forwarded commands
+
+    every task run is delayed by random jitter up to task "jitter" seconds,
+    so tasks scheduled for the same minute do not start all at once.
+    run is missed if scheduler was not running at the time or previous run
+    of the same task was still in progress, missed runs are counted and
+    one catch-up run is made for all runs missed while scheduler was down
+    """
+
+    def __init__(self, locks=None):
+        self.locks = locks
+        self.schedule = Schedule()
+        self.mtime = None
+        self.running: set[str] = set()
+        # tasks holding a slot of each group
+        self.group_jobs: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+
+    def reload(self):
+        """
+        pick up changes made from cli while scheduler runs
+        """
+        try:
+            mtime = os.path.getmtime(self.schedule.fname)
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        with self.lock:
+            state = self.schedule.state
+            self.schedule.load()
+            # state is owned by scheduler, do not lose updates of running tasks
+            self.schedule.state = state or self.schedule.state
+            # limits may have changed, they are checked against tasks
+            # already running, so raised limit lets waiting tasks go at once
+            self.slot_freed.notify_all()
+            for task_id in list(self.schedule.state):
+                if task_id not in self.schedule.tasks:
+                    del self.schedule.state[task_id]
+        INFO(f"loaded schedule with {len(self.schedule.tasks)} tasks")
+
+    def limit(self, group: str) -> int:
+        return self.schedule.limits.get(group, Timer.GROUP_JOBS)
+
+    @contextmanager
+    def slot(self, group: str):
+        """
+        wait until less than limit of group tasks are running
+        """
+        with self.slot_freed:
+            # limit is read on every check, it may change by reload meanwhile
+            while self.group_jobs.get(group, 0) >= self.limit(group):
+                self.slot_freed.wait()
+            self.group_jobs[group] = self.group_jobs.get(group, 0) + 1
+        try:
+            yield
+        finally:
+            with self.slot_freed:
+                self.group_jobs[group] -= 1
+                self.slot_freed.notify_all()
+
+    def plan(self, task_id: str, task: dict, now: float):
+        """
+        choose next run time of task, counting runs missed before now
+        """
+        state = self.schedule.state.setdefault(task_id, {})
+        cron = Cron(task["cron"])
+        if state.get("cron") != task["cron"] or "scheduled" not in state:
+            state["cron"] = task["cron"]
+            state["scheduled"] = cron.next(now)
+        elif state.get("due", 0) <= now:
+            # count runs which should have happened after one being made now
+            missed = 0
+            t = cron.next(state["scheduled"])
+            while t <= now and missed < Timer.MAX_MISSED:
+                missed += 1
+                t = cron.next(t)
+            if missed:
+                WARN(f'task "{task_id}" missed {missed} runs')
+                state["missed"] = state.get("missed", 0) + missed
+            state["scheduled"] = t
+        else:
+            return
+        state["due"] = state["scheduled"] + random.uniform(0, task.get("jitter") or 0)
+
+    def run_commands(self, commands: list[list[str]], errors: list[str]) -> bool:
+        """
+        run commands of task one after another, stop on first failed one
+        """
+        import main
+
+        for argv in commands:
+            try:
+                # schedule file is edited by hand, command may be invalid
+                args = main.build_parser().parse_args(argv)
+            except SystemExit:
+                errors.append(f"invalid command: {' '.join(argv)}")
+                return False
+            name = getattr(args, "name", None)
+            lock = self.locks.lock(name) if self.locks and name else None
+            try:
+                with lock or nullcontext():
+                    main.dispatch(args)
+            except Exception as e:
+                if not errors:
+                    errors.append(str(e) or type(e).__name__)
+                return False
+        return True
+
+    def execute(self, task_id: str, task: dict):
+        errors = []
+
+        def sink(kind: str, text: str):
+            if kind in ("FAIL", "FAILED"):
+                errors.append(text)
+
+        start = time.time()
+        ok = False
+        try:
+            with self.slot(task.get("group") or "default"):
+                start = time.time()
+                INFO(f'running scheduled task "{task_id}"')
+                with capture(sink):
+                    ok = self.run_commands(task["commands"], errors)
+        except Exception as e:
+            errors.append(str(e) or type(e).__name__)
+        finally:
+            with self.lock:
+                state = self.schedule.state.setdefault(task_id, {})
+                state |= {
+                    "started": start,
+                    "secs": round(time.time() - start, 3),
+                    "ok": ok,
+                    "error": errors[0] if errors else None,
+                    "runs": state.get("runs", 0) + 1,
+                }
+                try:
+                    self.schedule.save_state()
+                finally:
+                    self.running.discard(task_id)
+        if ok:
+            OK(f'scheduled task "{task_id}" done in {time.time() - start:.1f}s')
+        else:
+            FAIL(f'scheduled task "{task_id}" failed: {errors[0] if errors else ""}')
+
+    def tick(self) -> float:
+        """
+        start due tasks, returns time of next due task
+        """
+        self.reload()
+        now = time.time()
+        next_due = now + Timer.RELOAD_SECS
+        with self.lock:
+            for task_id, task in self.schedule.tasks.items():
+                state = self.schedule.state.get(task_id, {})
+                if state.get("due") is not None and state["due"] <= now:
+                    if task_id in self.running:
+                        WARN(f'task "{task_id}" is still running, skipping run')
+                        state["missed"] = state.get("missed", 0) + 1
+                    else:
+                        self.running.add(task_id)
+                        threading.Thread(
+                            target=self.execute,
+                            args=(task_id, task),
+                            name=f"task-{task_id}",
+                            daemon=True,
+                        ).start()
+                self.plan(task_id, task, now)
+                next_due = min(next_due, self.schedule.state[task_id]["due"])
+            self.schedule.save_state()
+        return next_due
+
+    def loop(self):
+        # control daemon and host agent may run in the same folder, only one
+        # of them runs the schedule, other takes over when it exits
+        with open(Fname.SCHEDULE_LOCK, "w") as f:
+            waiting = False
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not waiting:
+                        INFO("schedule is run by other process on this host")
+                        waiting = True
+                if self.stopped.wait(Timer.RELOAD_SECS):
+                    return
+            self.run_schedule()
+
+    def run_schedule(self):
+        while not self.stopped.is_set():
+            try:
+                next_due = self.tick()
+            except MCError:
+                # invalid schedule edited by hand, wait for it to be fixed
+                next_due = time.time() + Timer.RELOAD_SECS
+            self.stopped.wait(max(0, min(next_due - time.time(), Timer.RELOAD_SECS)))
+
+    def start(self):
+        threading.Thread(target=self.loop, name="scheduler", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
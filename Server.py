@@ -1,15 +1,29 @@
 from __future__ import annotations
 
+import datetime
 import pathlib
 import os
 import subprocess
+import threading
 from abc import ABC, abstractmethod
+from contextlib import ExitStack, contextmanager
 
 from defs import *
 from cprint import *
 from Cmd import Cmd
 from Saga import Saga
 from Daemon import daemon
+from Ping import Ping, PingResult
+from RamWorld import RamWorld
+from Watchdog import Watchdog
+from Profiler import Profiler
+from WorldUpgrade import WorldUpgrade
+from Warmup import Warmup
+from Throttle import Throttle
+
+# worlds folder is one git repository, so saves of several servers running in
+# parallel must not use it at the same time
+_git_lock = threading.Lock()
 
 
 class IServer(ABC):
@@ -28,9 +42,9 @@ class IServer(ABC):
         """
         folder = f"{Folder.WORLDS}/{name}"
         with Saga() as saga:
-            saga.compensation(lambda: Cmd.cmd(f"rm -rf {folder}"))
+            saga.compensation(lambda: Cmd.rm(folder, recursive=True, force=True))
 
-            Cmd.cmd(f"mkdir -p {folder}/{Folder.DATA}")
+            Cmd.mkdir(f"{folder}/{Folder.DATA}")
             Cmd.fwrite(f"{folder}/VERSION", version)
             Cmd.fwrite(f"{folder}/TYPE", launcher)
 
@@ -62,7 +76,15 @@ class IServer(ABC):
         pass
 
     @abstractmethod
-    def run(self, interactive=False):
+    def run(
+        self,
+        interactive=False,
+        ram=False,
+        recover=False,
+        watchdog=False,
+        profile=False,
+        warm_mb=None,
+    ):
         pass
 
     @abstractmethod
@@ -81,6 +103,102 @@ class IServer(ABC):
     def save(self):
         pass
 
+    @abstractmethod
+    def cleanup(self):
+        pass
+
+    @abstractmethod
+    def pid(self) -> int | None:
+        pass
+
+    def properties(self) -> dict[str, str]:
+        """
+        parse server.properties of server
+        """
+        fname = f"{self.folder}/{Folder.DATA}/server.properties"
+        properties = {}
+        if not pathlib.Path(fname).exists():
+            return properties
+        for line in Cmd.freadlines(fname):
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", maxsplit=1)
+            properties[key.strip()] = value.strip()
+        return properties
+
+    @contextmanager
+    def save_paused(self):
+        """
+        flush world of running server to disk and keep server from writing it,
+        so world files can be copied consistently
+        """
+        stdout_fname = f"{self.folder}/stdout.log"
+        offset = os.path.getsize(stdout_fname)
+        self.send_cmd("save-off")
+        try:
+            self.send_cmd("save-all flush")
+            RamWorld.wait_for_log(stdout_fname, offset, "Saved the game")
+            yield
+        finally:
+            self.send_cmd("save-on")
+
+    def snapshot(
+        self, src: str, dst: str, skip: tuple[str, ...] = (), hardlink=()
+    ) -> dict[str, int]:
+        """
+        consistent copy of server files, see Cmd.clonetree. files of running
+        server are first copied paced by Throttle while it keeps saving, then
+        saving is paused only to bring over files changed meanwhile at full
+        speed, so world is never left unsaved for long
+        returned counts are of the first pass, recopied files are reported
+        """
+        if not self.is_running():
+            return Cmd.clonetree(src, dst, skip, hardlink)
+
+        with Throttle(self) as throttle:
+            stats = Cmd.clonetree(src, dst, skip, hardlink, throttle=throttle)
+        INFO("server is running, pausing world saving")
+        with self.save_paused():
+            changed = Cmd.clonetree(src, dst, skip, hardlink, update=True)
+        recopied = changed["reflink"] + changed["hardlink"] + changed["copy"]
+        INFO(f"{recopied} files recopied while saving was paused")
+        # files of the first pass are counted once, size is of final copy
+        stats["bytes"] = changed["bytes"]
+        return stats
+
+    def set_property(self, key: str, value: str):
+        """
+        change or add one setting in server.properties
+        """
+        fname = f"{self.folder}/{Folder.DATA}/server.properties"
+        lines = Cmd.freadlines(fname) if pathlib.Path(fname).exists() else []
+        for i, line in enumerate(lines):
+            if "=" in line and line.split("=", maxsplit=1)[0].strip() == key:
+                lines[i] = f"{key}={value}"
+                break
+        else:
+            lines.append(f"{key}={value}")
+        Cmd.fwrite(fname, "\n".join(line for line in lines if line))
+
+    def address(self) -> tuple[str, int]:
+        """
+        get host and port server is listening on
+        """
+        properties = self.properties()
+        host = properties.get("server-ip") or Status.HOST
+        port = int(properties.get("server-port") or Status.PORT)
+        return host, port
+
+    def status(self, use_cache=True) -> PingResult:
+        """
+        ping running server with Server List Ping protocol
+        result is cached in STATUS.json for short time
+        """
+        host, port = self.address()
+        if use_cache:
+            return Ping.cached(f"{self.folder}/STATUS.json", host, port)
+        return Ping.ping(host, port)
+
     def delete(self):
         """
         completely delte server with it's folder
@@ -88,7 +206,10 @@ class IServer(ABC):
         if self.is_running():
             FAIL("cannot delete running server. stop or kill it first")
             raise MCInvalidOperationError()
-        Cmd.cmd(f"rm -rf {self.folder}")
+        WorldUpgrade(self).cancel()
+        Cmd.rm(self.folder, recursive=True, force=True)
+        Cmd.rm(f"{Ram.ROOT}/{self.name}", recursive=True, force=True)
+        Cmd.rm(f"{Folder.UPGRADES}/{self.name}.lock", force=True)
 
 
 class VanillaServer(IServer):
@@ -121,7 +242,45 @@ class VanillaServer(IServer):
         INFO("creating server config")
         Cmd.fwrite(server_properties_fname, convert_config(config))
 
-    def run(self, interactive=False):
+    def java_args(self) -> list[str]:
+        """
+        arguments starting server after jvm options
+        """
+        core_fname = pathlib.Path(
+            f"{Folder.SERVERS}/{LauncherType.VANILLA}/{self.version}.jar"
+        ).absolute()
+        return ["-jar", str(core_fname)]
+
+    def java_cmd(self) -> list[str]:
+        """
+        command starting server, server options go after it
+        """
+        return [
+            "java",
+            "-server",
+            "-XX:+UseParallelGC",
+            f"-Xms{Java.HEAP}",
+            f"-Xmx{Java.MAX_HEAP}",
+            *self.java_args(),
+        ]
+
+    def run(
+        self,
+        interactive=False,
+        ram=False,
+        recover=False,
+        watchdog=False,
+        profile=False,
+        warm_mb=None,
+    ):
+        """
+        with ram=True world is kept in memory-backed directory while server
+        runs, see RamWorld
+        with watchdog=True crashed or hung server is restarted, see Watchdog
+        with profile=True lag spikes are profiled, see Profiler
+        with warm_mb given hot region files are read to page cache first, see
+        Warmup
+        """
         if self.is_running():
             FAIL(f'server "{self.name}" already running')
             raise MCInvalidOperationError()
@@ -129,20 +288,39 @@ class VanillaServer(IServer):
         stdin_fname = f"{self.folder}/stdin.fifo"
         stdout_fname = f"{self.folder}/stdout.log"
         history_fname = f"{self.folder}/history.txt"
+        status_fname = f"{self.folder}/STATUS.json"
         keeper_pid_fname = f"{self.folder}/KEEPER_PID"
         java_pid_fname = f"{self.folder}/PID"
-        core_fname = pathlib.Path(
-            f"{Folder.SERVERS}/{LauncherType.VANILLA}/{self.version}.jar"
-        ).absolute()
+        ram_world = RamWorld(self)
+        upgrade = WorldUpgrade(self)
 
-        with Saga() as saga:
+        # upgrade lock is held until server is seen running, so upgrade worker
+        # does not swap world of starting server
+        with ExitStack() as upgrade_lock, Saga() as saga:
             with STEP("prepare to start"):
+                ram_world.check_crashed(recover)
+                upgrade_lock.enter_context(upgrade.lock())
+                # worker could apply upgrade while we waited for lock
+                self.version = Cmd.fread(f"{self.folder}/VERSION")
+                if upgrade.active():
+                    # world upgraded in background while server was running
+                    upgrade.apply()
+                if profile:
+                    Profiler.check()
+
                 saga.compensation(
-                    lambda: Cmd.cmd(f"rm -f {stdin_fname} {history_fname}")
+                    lambda: Cmd.rm(stdin_fname, history_fname, force=True)
                 )
-                Cmd.cmd(f"rm -f {stdin_fname}")
-                Cmd.cmd(f"mkfifo {stdin_fname}")
-                Cmd.cmd(f"touch {history_fname}")
+                Cmd.rm(stdin_fname, status_fname, force=True)
+                Cmd.mkfifo(stdin_fname)
+                Cmd.touch(history_fname)
+
+            if ram:
+                with STEP("moving world to RAM"):
+                    ram_world.setup()
+            elif warm_mb:
+                with STEP("warming up world files"):
+                    Warmup(self).warm(warm_mb)
 
             if not interactive:
                 with STEP("running stdin keeper process"):
@@ -153,20 +331,14 @@ class VanillaServer(IServer):
                     # to print keeper process pid
 
             with STEP("running server process"):
-                cmd = [
-                    "java",
-                    "-server",
-                    "-XX:+UseParallelGC",
-                    f"-Xms{Java.HEAP}",
-                    f"-Xmx{Java.MAX_HEAP}",
-                    "-jar",
-                    core_fname,
-                    "nogui",
-                ]
+                cmd = [*self.java_cmd(), "nogui"]
                 cwd = f"{self.folder}/{Folder.DATA}"
 
                 if interactive:
-                    Cmd.cmd(cmd, cwd=cwd)
+                    try:
+                        Cmd.cmd(cmd, cwd=cwd, check=False, timeout_mins=None)
+                    finally:
+                        ram_world.sync_final()
                     return
 
                 daemon(
@@ -185,22 +357,66 @@ class VanillaServer(IServer):
                 Cmd.wait_for_file(java_pid_fname)
                 pid = Cmd.fread(java_pid_fname)
                 OK(f"server started with pid {pid}")
+                upgrade_lock.close()
 
             with STEP("waiting server online"):
-                Cmd.wait_for_line(stdout_fname, "Done")
-                OK("server online")
+                host, port = self.address()
+                INFO(f"pinging server at {host}:{port}")
+                result = Ping.wait_online(host, port, pid=int(pid))
+                OK(f"server online: {result}")
+
+            if ram:
+                with STEP("running RAM sync daemon"):
+                    ram_world.start_sync_daemon()
+
+            if watchdog:
+                with STEP("running watchdog"):
+                    Watchdog(self, ram).start_daemon()
+
+            if profile:
+                with STEP("running profiler"):
+                    Profiler(self).start_daemon()
 
     def save(self):
+        ram_world = RamWorld(self)
+        if ram_world.active() and self.is_running():
+            ram_world.sync_live()
+
         tz = datetime.timezone(datetime.timedelta(hours=3))
         message = f"{datetime.datetime.now(tz)} {self.name}"
-        if not pathlib.Path(f"{WORLDS_FOLDER}/.git").exists():
-            Cmd.cmd(f"git -C {WORLDS_FOLDER} init")
-            Cmd.cmd(f"git -C {WORLDS_FOLDER} commit --allow-empty -m 'initial commit'")
-        Cmd.cmd(f"git -C {WORLDS_FOLDER} add --all")
-        Cmd.cmd(f'git -C {WORLDS_FOLDER} commit --allow-empty -m "{message}"')
+        with _git_lock:
+            if not pathlib.Path(f"{Folder.WORLDS}/.git").exists():
+                Cmd.cmd(f"git -C {Folder.WORLDS} init")
+                Cmd.cmd(
+                    f"git -C {Folder.WORLDS} commit --allow-empty -m 'initial commit'"
+                )
+            # git reads whole worlds folder, keep it from lagging the server
+            with Throttle(self) as throttle:
+                throttle.run(f"git -C {Folder.WORLDS} add --all")
+                throttle.run(
+                    [
+                        "git",
+                        "-C",
+                        Folder.WORLDS,
+                        "commit",
+                        "--allow-empty",
+                        "-m",
+                        message,
+                    ]
+                )
 
     def stop(self, kill=False):
+        # watchdog would restart stopped server, it may also be waiting to
+        # restart crashed one, which is not running meanwhile
+        watchdog = Watchdog(self)
+        restarting = pathlib.Path(watchdog.pid_fname).exists()
+        watchdog.stop_daemon()
+        Profiler(self).stop_daemon()
+
         if not self.is_running():
+            if restarting:
+                OK(f"watchdog stopped, crashed server {self.name} is not restarted")
+                return
             FAIL(f"server {self.name} is not running")
             raise MCInvalidOperationError()
 
@@ -208,20 +424,44 @@ class VanillaServer(IServer):
             pid = Cmd.fread(f"{self.folder}/PID")
             if kill:
                 INFO(f"found server process with pid {pid}")
-                Cmd.cmd(f"kill {pid}", check=False)
+                Cmd.kill(int(pid))
             else:
                 INFO(f"found server process with pid {pid}")
                 self.send_cmd("stop")
 
         with STEP("waiting server to stop"):
             Cmd.waitpid(int(pid))
-            Cmd.cmd(f"rm {self.folder}/PID")
+
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        remove pid files and stop keeper process after server process exited
+        """
+        Cmd.rm(f"{self.folder}/PID", force=True)
+
+        ram_world = RamWorld(self)
+        if ram_world.active():
+            ram_world.stop_sync_daemon()
+            ram_world.sync_final()
+
+        if not pathlib.Path(f"{self.folder}/KEEPER_PID").exists():
+            return
 
         with STEP("stopping keeper process"):
             keeper_pid = Cmd.fread(f"{self.folder}/KEEPER_PID")
             INFO(f"found keeper process with pid {keeper_pid}")
-            Cmd.cmd(f"kill {keeper_pid}", check=False)
-            Cmd.cmd(f"rm {self.folder}/KEEPER_PID")
+            Cmd.kill(int(keeper_pid))
+            Cmd.rm(f"{self.folder}/KEEPER_PID")
+
+    def pid(self) -> int | None:
+        """
+        get server java process pid or None if server is not running
+        """
+        try:
+            return int(Cmd.fread(f"{self.folder}/PID"))
+        except (FileNotFoundError, ValueError):
+            return None
 
     def send_cmd(self, cmd: str):
         if not self.is_running():
@@ -237,21 +477,17 @@ class VanillaServer(IServer):
         return server_exists or keeper_exists
 
 
-class ForgeServer(IServer):
-    def __init__(self, name: str, version: str):
-        pass
+class ForgeServer(VanillaServer):
+    """
+    forge server runs from shared installation of it's version, see
+    ForgeEnviroment, everything else is the same as for vanilla
+    """
 
-    def create_files(self):
-        pass
-
-    def run(self, log_to_stdout: bool):
-        pass
-
-    def stop(self, kill: bool = False):
-        pass
+    def __init__(self, name: str, version: str):
+        super().__init__(name, version)
+        self.launcher = LauncherType.FORGE
 
-    def is_running(self) -> bool:
-        return False
+    def java_args(self) -> list[str]:
+        from Enviroment import ForgeEnviroment
 
-    def save(self):
-        pass
+        return ForgeEnviroment().launch_args(self.version)
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+from collections import Counter
+from typing import Awaitable, Callable
+
+from cprint import *
+from defs import *
+from Backoff import TokenBucket
+from Watch import Watcher
+
+# "[12:34:56] [Server thread/INFO]: message" or "[12:34:56 INFO]: message"
+LINE_PREFIX = re.compile(r"^\[[^\]]*\](?: \[(?P<thread>[^\]]*)\])?:? ?")
+
+EVENT_PATTERNS = [
+    (Event.JOIN, re.compile(r"^\w{1,16} joined the game$")),
+    (Event.LEAVE, re.compile(r"^\w{1,16} left the game$")),
+    (
+        Event.DEATH,
+        re.compile(
+            r"^\w{1,16} (was |drowned|died|fell |hit the ground|burned to death"
+            r"|blew up|starved|suffocated|tried to swim|withered|froze"
+            r"|went up in flames|walked into|experienced kinetic|discovered the floor"
+            r"|didn't want to live|left the confines)"
+        ),
+    ),
+    (
+        Event.CRASH,
+        re.compile(
+            r"Encountered an unexpected exception|crash report has been saved"
+            r"|Exception in server tick loop|Considering it to be crashed"
+        ),
+    ),
+    (Event.LAG, re.compile(r"Can't keep up!|A single server tick took")),
+]
+
+
+def classify(line: str) -> str | None:
+    """
+    get event kind of server log line or None for regular console output
+    """
+    match = LINE_PREFIX.match(line)
+    message = line[match.end() :] if match else line
+    for kind, pattern in EVENT_PATTERNS:
+        if pattern.search(message):
+            return kind
+    return None
+
+
+class Subscription:
+    """
+    chat subscription to server console or selected events
+    lines are buffered and sent as one message per flush interval
+    """
+
+    def __init__(self, chat_id: int, server: str, kinds: set[str] | None):
+        self.chat_id = chat_id
+        self.server = server
+        # None means whole console
+        self.kinds = kinds
+        self.pending: list[str] = []
+        self.dropped: Counter[str] = Counter()
+        self.bucket = TokenBucket(Stream.CHAT_RATE, Stream.CHAT_BURST)
+
+    def push(self, line: str, kind: str | None):
+        if self.kinds is not None and kind not in self.kinds:
+            return
+        if len(self.pending) >= Stream.MAX_PENDING:
+            self.dropped[kind or Event.CONSOLE] += 1
+            return
+        self.pending.append(line)
+
+    def render(self) -> str | None:
+        """
+        take pending lines as one message, summarizing what does not fit
+        """
+        if not self.pending and not self.dropped:
+            return None
+
+        lines = []
+        size = 0
+        for i, line in enumerate(self.pending):
+            size += len(line) + 1
+            if size > Bot.MAX_MESSAGE - 200:
+                for rest in self.pending[i:]:
+                    self.dropped[classify(rest) or Event.CONSOLE] += 1
+                break
+            lines.append(line)
+
+        if self.dropped:
+            total = sum(self.dropped.values())
+            kinds = ", ".join(f"{n} {kind}" for kind, n in self.dropped.items())
+            lines.append(f"... {total} more lines skipped ({kinds})")
+
+        self.pending.clear()
+        self.dropped.clear()
+        return f"[{self.server}]\n" + "\n".join(lines)
+
+
+class LogTailer:
+    """
+    follow one log file and dispatch new lines to all subscribers
+    handles truncation and replacement of log when server restarts
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.subscriptions: list[Subscription] = []
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.follow())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def dispatch(self, line: str):
+        kind = classify(line)
+        for subscription in self.subscriptions:
+            subscription.push(line, kind)
+
+    async def follow(self):
+        watcher = Watcher.shared()
+        f = None
+        inode = None
+        rest = b""
+
+        def exists() -> bool:
+            return os.path.exists(self.fname)
+
+        def changed() -> bool:
+            try:
+                st = os.stat(self.fname)
+            except FileNotFoundError:
+                return False
+            return st.st_ino != inode or st.st_size != f.tell()
+
+        # skip existing log, but read from beginning if log appears later
+        seek_end = True
+        try:
+            while True:
+                if f is None:
+                    try:
+                        f = open(self.fname, "rb")
+                    except FileNotFoundError:
+                        seek_end = False
+                        await watcher.wait_async(exists, [self.fname], Stream.IDLE_SECS)
+                        continue
+                    inode = os.fstat(f.fileno()).st_ino
+                    if seek_end:
+                        f.seek(0, os.SEEK_END)
+
+                data = f.read()
+                if data:
+                    lines = (rest + data).split(b"\n")
+                    rest = lines.pop()
+                    for line in lines:
+                        self.dispatch(line.decode("utf-8", "replace").rstrip("\r"))
+                    continue
+
+                await watcher.wait_async(changed, [self.fname], Stream.IDLE_SECS)
+                try:
+                    st = os.stat(self.fname)
+                except FileNotFoundError:
+                    continue
+                if st.st_ino != inode or st.st_size < f.tell():
+                    # log was replaced or truncated by server restart
+                    f.close()
+                    f = open(self.fname, "rb")
+                    inode = os.fstat(f.fileno()).st_ino
+                    rest = b""
+        finally:
+            if f is not None:
+                f.close()
+
+
+class TailerHub:
+    """
+    share one LogTailer per log file between all subscriptions and flush
+    buffered lines to chats respecting per-chat and global rate limits
+    """
+
+    def __init__(self, send: Callable[[int, str], Awaitable[None]]):
+        self.send = send
+        self.tailers: dict[str, LogTailer] = {}
+        self.bucket = TokenBucket(Stream.GLOBAL_RATE, Stream.GLOBAL_BURST)
+        self.flush_task: asyncio.Task | None = None
+
+    def subscribe(
+        self, fname: str, chat_id: int, server: str, kinds: set[str] | None
+    ) -> Subscription:
+        self.unsubscribe(fname, chat_id)
+        tailer = self.tailers.get(fname)
+        if tailer is None:
+            tailer = LogTailer(fname)
+            self.tailers[fname] = tailer
+            tailer.start()
+        subscription = Subscription(chat_id, server, kinds)
+        tailer.subscriptions.append(subscription)
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_loop())
+        return subscription
+
+    def unsubscribe(self, fname: str, chat_id: int) -> bool:
+        tailer = self.tailers.get(fname)
+        if tailer is None:
+            return False
+        before = len(tailer.subscriptions)
+        tailer.subscriptions = [s for s in tailer.subscriptions if s.chat_id != chat_id]
+        if not tailer.subscriptions:
+            tailer.stop()
+            del self.tailers[fname]
+        return len(tailer.subscriptions) != before
+
+    def subscriptions(self, chat_id: int) -> list[Subscription]:
+        return [
+            s
+            for tailer in self.tailers.values()
+            for s in tailer.subscriptions
+            if s.chat_id == chat_id
+        ]
+
+    async def flush(self):
+        for tailer in list(self.tailers.values()):
+            for subscription in tailer.subscriptions:
+                if not subscription.pending and not subscription.dropped:
+                    continue
+                # chat which is out of tokens keeps buffering, extra lines are
+                # counted as dropped and summarized in next message
+                if not subscription.bucket.available() or not self.bucket.available():
+                    continue
+                text = subscription.render()
+                subscription.bucket.try_acquire()
+                self.bucket.try_acquire()
+                try:
+                    await self.send(subscription.chat_id, text)
+                except Exception as e:
+                    WARN(f"failed to send log to chat {subscription.chat_id}: {e}")
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(Stream.FLUSH_SECS)
+            await self.flush()
+
+    def stop(self):
+        for tailer in self.tailers.values():
+            tailer.stop()
+        self.tailers.clear()
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
@@ -25,13 +25,23 @@ from telegram import (
     MenuButtonCommands,
 )
 
+import asyncio
 import sys
-import os
-import re
-import pathlib
-import json
-from Manager import run_server
+
+import Manager
+from Operation import Operations, OperationResult
+from Server import IServer
+from Tailer import TailerHub
 from cprint import *
+from defs import *
+
+
+def retry_secs(e: telegram.error.RetryAfter) -> float:
+    # timedelta in newer versions of python-telegram-bot
+    retry_after = e.retry_after
+    if not isinstance(retry_after, (int, float)):
+        retry_after = retry_after.total_seconds()
+    return retry_after
 
 
 class SimpleGPTbot:
@@ -45,7 +55,11 @@ class SimpleGPTbot:
             self.token = self.get_token()
         else:
             self.token = token
-        self.application = ApplicationBuilder().token(self.token).build()
+        self.application = (
+            ApplicationBuilder().token(self.token).concurrent_updates(True).build()
+        )
+        self.operations = Operations()
+        self.hub = TailerHub(self.send_stream)
 
         start_handler = CommandHandler("start", self.start_command)
         help_handler = CommandHandler("help", self.help_command)
@@ -62,6 +76,9 @@ class SimpleGPTbot:
         update_versions_handler = CommandHandler(
             "update_versions", self.update_versions_command
         )
+        console_handler = CommandHandler("console", self.console_command)
+        events_handler = CommandHandler("events", self.events_command)
+        unsubscribe_handler = CommandHandler("unsubscribe", self.unsubscribe_command)
         echo_handler = MessageHandler(
             filters.TEXT & ~filters.COMMAND, self.echo_handler
         )
@@ -77,43 +94,91 @@ class SimpleGPTbot:
             ps_handler,
             list_versions_handler,
             update_versions_handler,
+            console_handler,
+            events_handler,
+            unsubscribe_handler,
             echo_handler,
         ):
             self.application.add_handler(handler)
 
     def start(self):
-        self.application.run_polling()
-
-    async def run_request(self, update, context, cmd: str):
-        def run_and_capture_output(cmd: str):
-            os.system(f"./main.py {cmd} 2>&1 | tee ./log")
-            with open("log") as f:
-                out = f.read()
-            os.system("rm -f ./log")
-            return re.sub(r"\x1B\[[0-9;]*[mK]", "", out)
-
-        output = run_and_capture_output(cmd)
-        if not pathlib.Path("output.json").exists():
-            chat_id = update.effective_chat.id
-            text = "INTERNAL ERROR\n" + output
-            await context.bot.send_message(chat_id=chat_id, text=text)
-            return
-
-        with open("output.json") as j:
-            return json.loads(j.read())
-
-    # async def handler(self, update, context):
-    #    if await self.prot(update, context):
-    #        return
-
-    #    chat_id = update.effective_chat.id
-    #    message = update.message.text
+        try:
+            self.application.run_polling()
+        finally:
+            self.hub.stop()
+            self.operations.shutdown()
+
+    async def run_operation(
+        self, update, context, key: str, title: str, func, *args, **kwargs
+    ) -> OperationResult:
+        """
+        run Manager operation in-process, showing it's STEP progress in one
+        message which is edited as steps start and finish
+        """
+        chat_id = update.effective_chat.id
+        message = await context.bot.send_message(chat_id=chat_id, text=title)
+        steps: list[str] = []
+        state = {"dirty": False}
+
+        async def edit(text: str):
+            while True:
+                try:
+                    await message.edit_text(text[-Bot.MAX_MESSAGE :])
+                except telegram.error.RetryAfter as e:
+                    await asyncio.sleep(retry_secs(e))
+                    continue
+                except telegram.error.BadRequest as e:
+                    if "message is not modified" not in e.message.lower():
+                        WARN(f"could not update progress message: {e}")
+                except telegram.error.TelegramError as e:
+                    # operation goes on, message is edited again next time
+                    WARN(f"could not update progress message: {e}")
+                    return
+                state["dirty"] = False
+                return
+
+        def render() -> str:
+            return "\n".join([title, *steps])
+
+        def on_event(kind: str, text: str):
+            if kind == "STEP":
+                steps.append(f"... {text}")
+            elif kind in ("DONE", "FAILED") and steps:
+                mark = "OK" if kind == "DONE" else "FAILED"
+                steps[-1] = f"{mark} {text}"
+            else:
+                return
+            state["dirty"] = True
+
+        async def progress():
+            while True:
+                await asyncio.sleep(Bot.PROGRESS_INTERVAL_SECS)
+                if state["dirty"]:
+                    await edit(render())
+
+        progress_task = asyncio.create_task(progress())
+        try:
+            result = await self.operations.run(
+                key, func, *args, on_event=on_event, **kwargs
+            )
+        finally:
+            progress_task.cancel()
+
+        if result.ok:
+            await edit(render() + "\ndone")
+        else:
+            failures = [line for line in result.output if line][-5:]
+            await edit("\n".join([render(), "FAILED: " + result.error, *failures]))
+        return result
 
-    #    output = self.run_and_capture("./main.py " + message)
+    async def send_text(self, update, context, text: str):
+        chat_id = update.effective_chat.id
+        await context.bot.send_message(
+            chat_id=chat_id, text=text[: Bot.MAX_MESSAGE] or "(empty)"
+        )
 
-    #    await context.bot.send_message(
-    #        chat_id=chat_id, text=output, disable_web_page_preview=True
-    #    )
+    async def usage(self, update, context, text: str):
+        await self.send_text(update, context, f"usage: {text}")
 
     async def start_command(self, update, context):
         if await self.prot(update, context):
@@ -157,6 +222,12 @@ class SimpleGPTbot:
             "    _list_ _avaliable_ _versions_ _to_ _create_ _servers_\n"
             "/update_versions\n"
             "    _update_ _avaliable_ _versions_ _to_ _create_ _server_\n"
+            "/console\n"
+            "    _stream_ _server_ _console_ _to_ _this_ _chat_\n"
+            "/events\n"
+            "    _notify_ _about_ _joins_ _deaths_ _crashes_ _and_ _lag_\n"
+            "/unsubscribe\n"
+            "    _stop_ _console_ _or_ _events_ _stream_\n"
             "\n"
             "***\\(c\\) tlucanti***"
         )
@@ -168,35 +239,188 @@ class SimpleGPTbot:
         )
 
     async def create_command(self, update, context):
-        await self.not_implemented(update, context)
+        if await self.prot(update, context):
+            return
+        if len(context.args) != 3:
+            await self.usage(update, context, "/create <launcher> <name> <version>")
+            return
+
+        launcher, name, version = context.args
+        await self.run_operation(
+            update,
+            context,
+            name,
+            f'creating {launcher} server "{name}" {version}',
+            Manager.create_server,
+            launcher,
+            name,
+            version,
+        )
 
     async def delete_command(self, update, context):
         await self.not_implemented(update, context)
 
     async def run_command(self, update, context):
-        await self.not_implemented(update, context)
+        if await self.prot(update, context):
+            return
+        if len(context.args) != 1:
+            await self.usage(update, context, "/run <name>")
+            return
+
+        (name,) = context.args
+        await self.run_operation(
+            update,
+            context,
+            name,
+            f'running server "{name}"',
+            Manager.run_server,
+            name,
+            interactive=False,
+        )
 
     async def stop_command(self, update, context):
-        await self.not_implemented(update, context)
+        if await self.prot(update, context):
+            return
+        if len(context.args) != 1:
+            await self.usage(update, context, "/stop <name>")
+            return
+
+        (name,) = context.args
+        await self.run_operation(
+            update,
+            context,
+            name,
+            f'stopping server "{name}"',
+            Manager.stop_server,
+            name,
+        )
 
     async def cmd_command(self, update, context):
-        await self.not_implemented(update, context)
+        if await self.prot(update, context):
+            return
+        if len(context.args) < 2:
+            await self.usage(update, context, "/cmd <name> <command>")
+            return
 
-    async def list_command(self, update, context):
-        await self.not_implemented(update, context)
+        name, *command = context.args
+        result = await self.operations.run(
+            name, Manager.send_cmd, name, " ".join(command)
+        )
+        await self.send_text(update, context, result.text() or result.error)
+
+    async def list_command(self, update, context, only_running=False):
+        if await self.prot(update, context):
+            return
+
+        result = await self.operations.run(
+            Folder.WORLDS, Manager.list_servers, only_running=only_running, query=True
+        )
+        if not result.ok:
+            await self.send_text(update, context, f"FAILED: {result.error}")
+            return
+        lines = []
+        for server in result.value:
+            line = f"{server['name']} {server['launcher']} {server['version']}"
+            status = server["status"]
+            if status is not None:
+                line += (
+                    f" - online {status['players_online']}/{status['players_max']}"
+                    f" ({status['latency_ms']:.0f}ms)"
+                )
+            elif server["running"]:
+                line += " - running, not responding"
+            lines.append(line)
+        await self.send_text(update, context, "\n".join(lines) or "no servers")
 
     async def ps_command(self, update, context):
-        await self.not_implemented(update, context)
+        await self.list_command(update, context, only_running=True)
 
     async def list_versions_command(self, update, context):
-        resp = await self.run_request(update, context, "list")
-        if not resp:
+        if await self.prot(update, context):
             return
 
-        print(resp)
+        launcher = context.args[0] if context.args else LauncherType.VANILLA
+        result = await self.operations.run(
+            Fname.VERSIONS.get(launcher, launcher),
+            Manager.list_versions,
+            launcher,
+            False,
+            query=True,
+        )
+        if not result.ok:
+            await self.send_text(update, context, f"FAILED: {result.error}")
+            return
+        # show newest versions first, telegram messages are size limited
+        await self.send_text(update, context, "\n".join(reversed(result.value)))
 
     async def update_versions_command(self, update, context):
-        await self.not_implemented(update, context)
+        if await self.prot(update, context):
+            return
+
+        launcher = context.args[0] if context.args else LauncherType.VANILLA
+        await self.run_operation(
+            update,
+            context,
+            Fname.VERSIONS.get(launcher, launcher),
+            f"updating {launcher} versions",
+            Manager.update_versions,
+            launcher,
+        )
+
+    async def send_stream(self, chat_id: int, text: str):
+        try:
+            await self.application.bot.send_message(chat_id=chat_id, text=text)
+        except telegram.error.RetryAfter as e:
+            retry_after = retry_secs(e)
+            WARN(f"telegram rate limit hit, pausing streams for {retry_after}s")
+            self.hub.bucket.penalize(retry_after)
+
+    async def subscribe(self, update, context, kinds: set[str] | None):
+        chat_id = update.effective_chat.id
+        name = context.args[0]
+        result = await self.operations.run(name, IServer.get, name, query=True)
+        if not result.ok:
+            await self.send_text(update, context, f"FAILED: {result.error}")
+            return
+
+        fname = f"{result.value.folder}/stdout.log"
+        self.hub.subscribe(fname, chat_id, name, kinds)
+        what = "console" if kinds is None else ", ".join(sorted(kinds))
+        await self.send_text(update, context, f"subscribed to {name} {what}")
+
+    async def console_command(self, update, context):
+        if await self.prot(update, context):
+            return
+        if len(context.args) != 1:
+            await self.usage(update, context, "/console <name>")
+            return
+
+        await self.subscribe(update, context, None)
+
+    async def events_command(self, update, context):
+        if await self.prot(update, context):
+            return
+        kinds = set(context.args[1:]) or set(Event.ALL)
+        if not context.args or not kinds <= set(Event.ALL):
+            await self.usage(update, context, f"/events <name> [{' '.join(Event.ALL)}]")
+            return
+
+        await self.subscribe(update, context, kinds)
+
+    async def unsubscribe_command(self, update, context):
+        if await self.prot(update, context):
+            return
+        if len(context.args) != 1:
+            await self.usage(update, context, "/unsubscribe <name>")
+            return
+
+        chat_id = update.effective_chat.id
+        (name,) = context.args
+        fname = f"{Folder.WORLDS}/{name}/stdout.log"
+        if self.hub.unsubscribe(fname, chat_id):
+            await self.send_text(update, context, f"unsubscribed from {name}")
+        else:
+            await self.send_text(update, context, f"not subscribed to {name}")
 
     async def echo_handler(self, update, context):
         if await self.prot(update, context):
@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import os
+import re
+import resource
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+
+from cprint import *
+from defs import *
+from Cmd import Cmd
+
+LAG = re.compile(r"Can't keep up!.*?Running (\d+)ms or (\d+) ticks behind")
+# output of "tick query" command
+MSPT = re.compile(r"Average time per tick: ([\d.]+) ?ms")
+
+
+class Throttle:
+    """
+    paces background i/o of operation by lag of running server: rate is halved
+    when server warns "Can't keep up" or it's mspt is high, and raised while
+    server keeps up easily. external commands run with lowest best-effort
+    ionice priority and, if cgroup v2 io controller is writable, in their own
+    cgroup with io.max set to current rate. copies made in-process pace
+    themselves with consume()
+
+    stopped server can not lag, so i/o is not limited then
+        with Throttle(server) as throttle:
+            throttle.run(["git", "add", "--all"])
+    """
+
+    def __init__(self, server=None):
+        self.server = server if server is not None and server.is_running() else None
+        self.rate = Io.START_RATE if self.server is not None else None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.cgroups: list[str] = []
+        self.cgroup_failed = False
+        self.bytes = 0
+        self.lag_warnings = 0
+        self.behind_ms = 0
+        self.max_mspt: float | None = None
+        # latest reported mspt, queried less often than rate is adjusted
+        self.mspt: float | None = None
+        self.min_rate = self.max_rate = self.rate
+
+    def __enter__(self) -> Throttle:
+        self.start = time.monotonic()
+        self.window_start, self.window_bytes = self.start, 0
+        if self.server is not None:
+            self.stdout_fname = f"{self.server.folder}/stdout.log"
+            self.offset = os.path.getsize(self.stdout_fname)
+            version = self.server.version.split(".")
+            self.query_mspt = all(v.isdigit() for v in version) and (
+                tuple(map(int, version)) >= Io.TICK_QUERY_VERSION
+            )
+            self.thread = threading.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        if self.server is not None:
+            self.thread.join()
+        if exc[0] is None:
+            self.report()
+
+    def loop(self):
+        last_query = 0.0
+        while not self.stopped.wait(Io.ADJUST_SECS):
+            if self.query_mspt and time.monotonic() - last_query >= Io.MSPT_QUERY_SECS:
+                last_query = time.monotonic()
+                try:
+                    self.server.send_cmd("tick query")
+                except MCError:
+                    # server stopped meanwhile
+                    self.query_mspt = False
+            self.adjust()
+
+    def adjust(self):
+        """
+        change rate by server output written since last adjustment
+        """
+        try:
+            with open(self.stdout_fname, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        self.offset += len(data)
+        text = data.decode(errors="replace")
+        lag = LAG.findall(text)
+        mspt = max((float(m) for m in MSPT.findall(text)), default=None)
+
+        with self.lock:
+            self.lag_warnings += len(lag)
+            self.behind_ms += sum(int(ms) for ms, _ in lag)
+            if mspt is not None:
+                self.mspt = mspt
+                self.max_mspt = max(self.max_mspt or 0, mspt)
+
+            if lag or (self.mspt is not None and self.mspt > Io.MSPT_HIGH):
+                self.rate = max(Io.MIN_RATE, self.rate // 2)
+            elif self.mspt is None or self.mspt < Io.MSPT_LOW:
+                self.rate = min(Io.MAX_RATE, self.rate * 3 // 2)
+            self.min_rate = min(self.min_rate, self.rate)
+            self.max_rate = max(self.max_rate, self.rate)
+            self.window_start, self.window_bytes = time.monotonic(), 0
+            cgroups = list(self.cgroups)
+
+        for cgroup in cgroups:
+            self.set_io_max(cgroup)
+
+    def consume(self, size: int):
+        """
+        account size bytes done in-process, sleeping to keep current rate
+        """
+        with self.lock:
+            self.bytes += size
+            if self.rate is None:
+                return
+            self.window_bytes += size
+            delay = self.window_start + self.window_bytes / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def copy(self, src: str, dst: str):
+        """
+        paced shutil.copy2
+        """
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            while chunk := fsrc.read(Io.CHUNK):
+                fdst.write(chunk)
+                self.consume(len(chunk))
+        shutil.copystat(src, dst)
+
+    @classmethod
+    def device(cls, path: str) -> str | None:
+        """
+        "major:minor" of disk holding path as io.max expects it, partitions
+        are resolved to whole disk
+        """
+        dev = os.stat(path).st_dev
+        if os.major(dev) == 0:
+            # tmpfs, overlay and other virtual filesystems
+            return None
+        sysfs = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+        if os.path.exists(f"{sysfs}/partition"):
+            return Cmd.fread(f"{os.path.realpath(sysfs)}/../dev")
+        return f"{os.major(dev)}:{os.minor(dev)}"
+
+    def set_io_max(self, cgroup: str):
+        rate = self.rate
+        limit = "max" if rate is None or rate >= Io.MAX_RATE else str(rate)
+        with open(f"{cgroup}/io.max", "w") as f:
+            f.write(f"{self.dev} rbps={limit} wbps={limit}")
+
+    def join_cgroup(self, pid: int) -> str | None:
+        """
+        move process to new cgroup limited by current rate
+        """
+        if self.cgroup_failed:
+            return None
+        cgroup = f"{Io.CGROUP}/mc-throttle-{os.getpid()}-{pid}"
+        try:
+            controllers = f"{Io.CGROUP}/cgroup.controllers"
+            if "io" not in Cmd.fread(controllers).split():
+                raise OSError(f"no io controller in {controllers}")
+            self.dev = self.device(Folder.WORLDS)
+            if self.dev is None:
+                raise OSError("worlds are not on block device")
+            with open(f"{Io.CGROUP}/cgroup.subtree_control", "w") as f:
+                f.write("+io")
+            os.mkdir(cgroup)
+            self.set_io_max(cgroup)
+            with open(f"{cgroup}/cgroup.procs", "w") as f:
+                f.write(str(pid))
+        except OSError as e:
+            INFO(f"cgroup io limit is not available ({e}), using only ionice")
+            self.cgroup_failed = True
+            if os.path.isdir(cgroup):
+                os.rmdir(cgroup)
+            return None
+        with self.lock:
+            self.cgroups.append(cgroup)
+        return cgroup
+
+    def run(self, cmd: str | list[str]):
+        """
+        run command with low io priority, limited to current rate
+        """
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        if shutil.which(Io.IONICE[0]):
+            cmd = [*Io.IONICE, *cmd]
+        Cmd.echo(*cmd)
+
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        proc = subprocess.Popen(cmd)
+        cgroup = self.join_cgroup(proc.pid) if self.rate is not None else None
+        try:
+            returncode = proc.wait()
+        finally:
+            if cgroup is not None:
+                with self.lock:
+                    self.cgroups.remove(cgroup)
+                os.rmdir(cgroup)
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        blocks = after.ru_inblock - before.ru_inblock
+        blocks += after.ru_oublock - before.ru_oublock
+        with self.lock:
+            self.bytes += blocks * 512
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def report(self):
+        secs = time.monotonic() - self.start
+        speed = self.bytes / max(secs, 1e-3) / (1 << 20)
+        message = f"{self.bytes >> 20}MB in {secs:.1f}s ({speed:.1f}MB/s)"
+        if self.server is None:
+            INFO(message)
+            return
+        INFO(f"{message}, paced at {self.min_rate >> 20}-{self.max_rate >> 20}MB/s")
+        mspt = f", max mspt {self.max_mspt}ms" if self.max_mspt is not None else ""
+        if self.lag_warnings:
+            WARN(
+                f"server {self.server.name} lagged meanwhile: {self.lag_warnings} "
+                f'"Can\'t keep up" warnings, {self.behind_ms}ms behind{mspt}'
+            )
+        else:
+            INFO(f"server {self.server.name} did not lag{mspt}")
@@ -0,0 +1,105 @@
+"""
+optional span tracing of STEP blocks, commands and saga compensations
+
+spans are collected in memory only after enable(), at exit they are written
+to trace file in chrome trace-event format (open it in chrome://tracing or
+ui.perfetto.dev) and summed up per span name on stderr. while tracing is off
+span() returns shared no-op context manager, so it costs one global lookup
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+_events: list[dict] | None = None
+_fname: str | None = None
+_pid: int | None = None
+_noop = nullcontext({})
+
+
+def enable(fname: str):
+    global _events, _fname, _pid
+    _events, _fname, _pid = [], fname, os.getpid()
+    atexit.register(write)
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def span(name: str, cat: str = "step", **attrs):
+    """
+    time block as span, yields dict of attributes which block may extend
+        with span("copy", files=10) as attrs:
+            attrs["bytes"] = copy()
+    """
+    if _events is None:
+        return _noop
+    return _span(name, cat, attrs)
+
+
+@contextmanager
+def _span(name: str, cat: str, attrs: dict):
+    start = time.perf_counter_ns()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = repr(e)
+        raise
+    finally:
+        end = time.perf_counter_ns()
+        _events.append(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": {key: text(value) for key, value in attrs.items()},
+            }
+        )
+
+
+def text(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return shlex.join(str(v) for v in value)
+    return str(value)
+
+
+def summary(events: list[dict]) -> list[tuple[str, int, float, float]]:
+    """
+    span name, count, total and max duration in ms, slowest first
+    """
+    spans: dict[str, list[float]] = {}
+    for event in events:
+        spans.setdefault(event["name"], []).append(event["dur"] / 1000)
+    rows = [(name, len(d), sum(d), max(d)) for name, d in spans.items()]
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def write():
+    # forked children inherit collected spans, only owner writes them
+    if _events is None or os.getpid() != _pid:
+        return
+    events = list(_events)
+    tmp_fname = f"{_fname}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_fname, _fname)
+
+    print(
+        f"\n{'span':50} {'count':>6} {'total ms':>10} {'max ms':>10}", file=sys.stderr
+    )
+    for name, count, total, longest in summary(events):
+        name = name if len(name) <= 50 else name[:47] + "..."
+        print(f"{name:50} {count:6} {total:10.1f} {longest:10.1f}", file=sys.stderr)
+    print(f"{len(events)} spans written to {_fname}", file=sys.stderr)
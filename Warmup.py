@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import gzip
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cprint import *
+from defs import *
+from Cmd import Cmd
+from Region import REGION_NAME, Region
+
+# named int tags of level.dat, layout of nbt is: type, name length, name, value
+SPAWN_X = b"\x03\x00\x06SpawnX"
+SPAWN_Z = b"\x03\x00\x06SpawnZ"
+
+
+class Warmup:
+    """
+    read hot region files of stopped server world into page cache, so first
+    minutes after start do not stutter on cold disk
+
+    regions around spawn go first, then the most recently written ones, as
+    players were there last. entities and poi files of region come with it.
+    files are loaded until memory budget is filled, budget is capped by
+    Warm.MAX_FILL of available memory, so warm-up never pushes out memory
+    server itself needs
+    """
+
+    def __init__(self, server):
+        from RamWorld import RamWorld
+
+        self.server = server
+        self.world = RamWorld(server).world
+
+    def spawn(self) -> tuple[int, int]:
+        """
+        spawn block coordinates from level.dat, 0 0 if they are not found
+        """
+        try:
+            with gzip.open(f"{self.world}/level.dat") as f:
+                data = f.read()
+        except (OSError, EOFError):
+            return 0, 0
+        coords = []
+        for tag in (SPAWN_X, SPAWN_Z):
+            i = data.find(tag)
+            if i < 0:
+                return 0, 0
+            coords.append(struct.unpack_from(">i", data, i + len(tag))[0])
+        return coords[0], coords[1]
+
+    def candidates(self) -> list[str]:
+        """
+        region files of world, hottest first
+        """
+        spawn_x, spawn_z = self.spawn()
+        spawn_rx, spawn_rz = spawn_x >> 9, spawn_z >> 9
+
+        def key(fname: str) -> tuple:
+            folder = os.path.dirname(fname)
+            match = REGION_NAME.fullmatch(os.path.basename(fname))
+            near_spawn = False
+            if match is not None and os.path.dirname(folder) == self.world:
+                distance = max(
+                    abs(int(match[1]) - spawn_rx), abs(int(match[2]) - spawn_rz)
+                )
+                near_spawn = distance <= Warm.SPAWN_RADIUS
+            # newest region of dimension decides for its entities and poi
+            region = os.path.join(os.path.dirname(folder), "region")
+            region = os.path.join(region, os.path.basename(fname))
+            try:
+                mtime = os.path.getmtime(region)
+            except FileNotFoundError:
+                mtime = os.path.getmtime(fname)
+            return not near_spawn, -mtime, fname
+
+        return sorted(Region.find(self.world), key=key)
+
+    @classmethod
+    def load(cls, fname: str) -> int:
+        """
+        ask kernel to read file ahead and wait until it is read
+        """
+        size = 0
+        buffer = bytearray(Io.CHUNK)
+        with open(fname, "rb", buffering=0) as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while n := f.readinto(buffer):
+                size += n
+        return size
+
+    @classmethod
+    def available(cls) -> int:
+        for line in Cmd.freadlines("/proc/meminfo"):
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) << 10
+        return 0
+
+    def warm(self, budget_mb: int = Warm.BUDGET_MB) -> dict:
+        start = time.monotonic()
+        budget = min(budget_mb << 20, int(self.available() * Warm.MAX_FILL))
+        fnames = []
+        total = 0
+        skipped = 0
+        for fname in self.candidates():
+            size = os.path.getsize(fname)
+            if total + size > budget:
+                skipped += 1
+                continue
+            fnames.append(fname)
+            total += size
+        INFO(
+            f"loading {len(fnames)} region files ({total >> 20}MB) of "
+            f"{self.server.name} to page cache, budget {budget >> 20}MB"
+        )
+
+        with ThreadPoolExecutor(max_workers=Warm.JOBS) as pool:
+            loaded = sum(pool.map(self.load, fnames))
+
+        secs = time.monotonic() - start
+        speed = loaded / max(secs, 1e-3) / (1 << 20)
+        message = f"warmed up {loaded >> 20}MB in {secs:.2f}s ({speed:.0f}MB/s)"
+        if skipped:
+            message += f", {skipped} files did not fit into budget"
+        OK(message)
+        return {"files": len(fnames), "bytes": loaded, "skipped": skipped, "secs": secs}
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import threading
+import time
+from typing import Callable
+
+from cprint import *
+from defs import *
+from Backoff import Backoff
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# directory is watched instead of file itself, so that creation, deletion and
+# replacement of file are seen too
+DIR_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+
+EVENT = struct.Struct("iIII")
+
+
+class Waiter:
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+        self.dirs: list[str] = []
+
+
+class Watcher:
+    """
+    one inotify instance shared by all waits in process
+    background thread reads events and wakes waiters which watch directory
+    event happened in, waiters then re-check their condition
+    without inotify support waits fall back to exponential backoff with jitter
+    """
+
+    _shared: Watcher | None = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # directory -> (watch descriptor, waiters)
+        self.dirs: dict[str, tuple[int, set[Waiter]]] = {}
+        self.wds: dict[int, str] = {}
+        self.fd = -1
+        self.libc = None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+
+        self.libc = libc
+        self.fd = fd
+        thread = threading.Thread(target=self.reader, name="inotify", daemon=True)
+        thread.start()
+
+    @classmethod
+    def shared(cls) -> Watcher:
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @property
+    def available(self) -> bool:
+        return self.fd >= 0
+
+    @classmethod
+    def watch_dir(cls, path: str) -> str:
+        """
+        nearest existing directory which will contain path when it is created
+        """
+        parent = pathlib.Path(path).absolute().parent
+        while not parent.exists():
+            parent = parent.parent
+        return str(parent)
+
+    def register(self, waiter: Waiter, paths: list[str]) -> bool:
+        with self.lock:
+            for path in paths:
+                d = self.watch_dir(path)
+                if d in self.dirs:
+                    self.dirs[d][1].add(waiter)
+                else:
+                    wd = self.libc.inotify_add_watch(self.fd, d.encode(), DIR_MASK)
+                    if wd < 0:
+                        # e.g. max_user_watches limit reached
+                        self.unregister_locked(waiter)
+                        return False
+                    self.dirs[d] = (wd, {waiter})
+                    self.wds[wd] = d
+                waiter.dirs.append(d)
+        return True
+
+    def unregister(self, waiter: Waiter):
+        with self.lock:
+            self.unregister_locked(waiter)
+
+    def unregister_locked(self, waiter: Waiter):
+        for d in waiter.dirs:
+            if d not in self.dirs:
+                continue
+            wd, waiters = self.dirs[d]
+            waiters.discard(waiter)
+            if not waiters:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[d]
+                self.wds.pop(wd, None)
+        waiter.dirs.clear()
+
+    def reader(self):
+        while True:
+            select.select([self.fd], [], [])
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            woken: set[Waiter] = set()
+            offset = 0
+            with self.lock:
+                while offset < len(data):
+                    wd, mask, _, size = EVENT.unpack_from(data, offset)
+                    offset += EVENT.size + size
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, everybody has to re-check
+                        for _, waiters in self.dirs.values():
+                            woken |= waiters
+                    elif wd in self.wds:
+                        woken |= self.dirs[self.wds[wd]][1]
+                    if mask & IN_IGNORED and wd in self.wds:
+                        # watched directory was deleted
+                        d = self.wds.pop(wd)
+                        woken |= self.dirs.pop(d)[1]
+
+            for waiter in woken:
+                try:
+                    waiter.wake()
+                except RuntimeError:
+                    # event loop of async waiter is already closed
+                    pass
+
+    def fallback(self, timeout_secs: float) -> Backoff:
+        return Backoff(
+            timeout_secs / 60,
+            Wait.MIN_BACKOFF_SECS,
+            factor=2,
+            max_backoff_secs=Wait.MAX_BACKOFF_SECS,
+            jitter=0.2,
+        )
+
+    def wait(
+        self, condition: Callable[[], bool], paths: list[str], timeout_secs: float
+    ) -> bool:
+        """
+        block until condition() is true, re-checking it whenever any of paths
+        is created, modified or deleted
+        returns False on timeout
+        """
+        deadline = time.monotonic() + timeout_secs
+        bo = self.fallback(timeout_secs)
+        event = threading.Event()
+        waiter = Waiter(event.set)
+
+        while True:
+            if condition():
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            if not self.available or not self.register(waiter, paths):
+                bo.backoff()
+                continue
+            try:
+                # condition could change before watch was added
+                if condition():
+                    return True
+                event.wait(remaining)
+                event.clear()
+            finally:
+                self.unregister(waiter)
+
+    async def wait_async(
+        self, condition: Callable[[], bool], paths: list[str], timeout_secs: float
+    ) -> bool:
+        """
+        same as wait(), but for asyncio callers
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_secs
+        bo = self.fallback(timeout_secs)
+        event = asyncio.Event()
+        waiter = Waiter(lambda: loop.call_soon_threadsafe(event.set))
+
+        while True:
+            if condition():
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+
+            if not self.available or not self.register(waiter, paths):
+                await asyncio.sleep(bo.delay())
+                continue
+            try:
+                if condition():
+                    return True
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+            finally:
+                self.unregister(waiter)
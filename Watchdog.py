@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import fcntl
+import glob
+import itertools
+import json
+import os
+import pathlib
+import shlex
+import shutil
+import signal
+import sys
+import time
+from contextlib import contextmanager
+
+from cprint import *
+from defs import *
+from Cmd import Cmd
+from Ping import Ping
+
+# messages of minecraft own watchdog about stuck server thread
+STUCK_TICK = ("A single server tick took", "Considering it to be crashed")
+
+
+class Watchdog:
+    """
+    background process which restarts crashed or hung server
+
+    server is considered hung when it does not answer ping for several checks
+    in a row and does not print anything meanwhile, or when minecraft reports
+    stuck tick. before restart stdout tail, crash reports and jvm error logs
+    are saved to incidents/<time> folder. restarts are delayed with
+    exponential backoff, after Restart.MAX_FAILURES failures within
+    Restart.WINDOW_SECS watchdog gives up and alerts
+    """
+
+    def __init__(self, server, ram=False):
+        self.server = server
+        self.ram = ram
+        self.pid_fname = f"{server.folder}/WATCHDOG_PID"
+        self.state_fname = f"{server.folder}/WATCHDOG.json"
+        self.stdout_fname = f"{server.folder}/stdout.log"
+        self.incidents = f"{server.folder}/incidents"
+
+    def state(self) -> dict:
+        try:
+            return json.loads(Cmd.fread(self.state_fname))
+        except FileNotFoundError:
+            return {}
+
+    def write_state(self, **kwargs):
+        state = self.state() | kwargs
+        tmp_fname = f"{self.state_fname}.tmp"
+        Cmd.fwrite(tmp_fname, Cmd.jdump(state, indent=4))
+        os.replace(tmp_fname, self.state_fname)
+
+    @contextmanager
+    def lock(self):
+        """
+        watchdog restarts server under lock, so stop does not kill it halfway
+        """
+        with open(f"{self.server.folder}/WATCHDOG.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def start_daemon(self):
+        from Daemon import daemon
+
+        main = pathlib.Path(__file__).absolute().parent / "main.py"
+        cmd = [sys.executable, str(main), Action.WATCHDOG, "--name", self.server.name]
+        if self.ram:
+            cmd.append("--ram")
+        # manual start forgets failures of previous crash loop
+        self.write_state(state="running", failures=[], started=time.time())
+        daemon(
+            cmd,
+            stdout=f"{self.server.folder}/watchdog.log",
+            pidfile=self.pid_fname,
+            cwd=os.getcwd(),
+        )
+        Cmd.wait_for_file(self.pid_fname)
+        OK(f"watchdog started with pid {Cmd.fread(self.pid_fname)}")
+
+    def stop_daemon(self):
+        if not pathlib.Path(self.pid_fname).exists():
+            return
+        pid = int(Cmd.fread(self.pid_fname))
+        with self.lock():
+            Cmd.kill(pid)
+        Cmd.waitpid(pid, timeout_mins=1)
+        Cmd.rm(self.pid_fname, force=True)
+        if self.state().get("state") == "running":
+            self.write_state(state="stopped")
+
+    def new_output(self, offset: int) -> tuple[int, str]:
+        """
+        read log written after offset, returns new offset and text
+        """
+        try:
+            with open(self.stdout_fname, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return offset, ""
+        return offset + len(data), data.decode(errors="replace")
+
+    def watch(self, pid: int) -> str:
+        """
+        block until server process exits or hangs, returns reason
+        """
+        host, port = self.server.address()
+        offset = os.path.getsize(self.stdout_fname)
+        # failed pings in a row without any server output between them
+        ping_failures = 0
+
+        while True:
+            if Cmd.waitpids([pid], Restart.CHECK_SECS):
+                return "server process exited"
+
+            offset, text = self.new_output(offset)
+            for message in STUCK_TICK:
+                if message in text:
+                    return f'server reported stuck tick: "{message}"'
+            if text:
+                ping_failures = 0
+
+            try:
+                Ping.ping(host, port)
+                ping_failures = 0
+            except MCPingError:
+                ping_failures += 1
+            if ping_failures >= Restart.PING_FAILURES:
+                return (
+                    f"server did not answer {ping_failures} pings and printed "
+                    "nothing meanwhile"
+                )
+
+    def capture(self, pid: int | None, reason: str) -> str:
+        """
+        save what is needed to investigate failure, must be done before
+        restart truncates stdout.log
+        """
+        Cmd.mkdir(self.incidents)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        incident = f"{self.incidents}/{stamp}"
+        # several incidents may happen within one second
+        for i in itertools.count(1):
+            try:
+                os.mkdir(incident)
+                break
+            except FileExistsError:
+                incident = f"{self.incidents}/{stamp}-{i}"
+        Cmd.fwrite(f"{incident}/reason.txt", f"{reason}\npid {pid}\n")
+
+        if pathlib.Path(self.stdout_fname).exists():
+            tail = Cmd.freadlines(self.stdout_fname, strip=False)
+            Cmd.fwrite(f"{incident}/stdout.log", "\n".join(tail[-Restart.TAIL_LINES :]))
+
+        data = f"{self.server.folder}/{Folder.DATA}"
+        started = self.state().get("started", 0)
+        reports = glob.glob(f"{data}/crash-reports/*.txt")
+        if pid is not None:
+            reports += glob.glob(f"{data}/hs_err_pid{pid}.log")
+        for fname in reports:
+            if os.path.getmtime(fname) >= started:
+                shutil.copy2(fname, incident)
+
+        # keep only latest incidents
+        for old in sorted(os.listdir(self.incidents))[: -Restart.MAX_INCIDENTS]:
+            Cmd.rm(f"{self.incidents}/{old}", recursive=True, force=True)
+        return incident
+
+    def recover(self, pid: int | None, reason: str) -> list[float]:
+        """
+        record failure and bring server to stopped state
+        """
+        WARN(f"server {self.server.name}: {reason}")
+        incident = self.capture(pid, reason)
+        INFO(f"incident saved to {incident}")
+
+        if pid is not None and not Cmd.waitpids([pid], 0):
+            Cmd.kill(pid)
+            if not Cmd.waitpids([pid], Restart.TERM_TIMEOUT_SECS):
+                Cmd.kill(pid, signal.SIGKILL)
+                Cmd.waitpids([pid], Restart.TERM_TIMEOUT_SECS)
+        self.server.cleanup()
+
+        now = time.time()
+        failures = self.state().get("failures", [])
+        failures = [t for t in failures if now - t < Restart.WINDOW_SECS] + [now]
+        self.write_state(failures=failures, last_incident=incident, reason=reason)
+        return failures
+
+    def alert(self, message: str):
+        FAIL(message)
+        cmd = os.environ.get(Env.ALERT_CMD)
+        if cmd:
+            Cmd.cmd(shlex.split(cmd) + [message], check=False)
+
+    def loop(self):
+        """
+        body of watchdog daemon
+        """
+        pid = self.server.pid()
+        while pid is not None:
+            reason = self.watch(pid)
+            with self.lock():
+                failures = self.recover(pid, reason)
+
+            while True:
+                if len(failures) >= Restart.MAX_FAILURES:
+                    self.write_state(state="crash-loop")
+                    self.alert(
+                        f"server {self.server.name} failed {len(failures)} times "
+                        f"in {Restart.WINDOW_SECS}s, not restarting it anymore. "
+                        f"last failure: {reason}"
+                    )
+                    Cmd.rm(self.pid_fname, force=True)
+                    return
+
+                delay = min(
+                    Restart.MAX_BACKOFF_SECS,
+                    Restart.MIN_BACKOFF_SECS * 2 ** (len(failures) - 1),
+                )
+                INFO(f"restarting server {self.server.name} in {delay}s")
+                self.write_state(state="restarting")
+                time.sleep(delay)
+
+                with self.lock():
+                    try:
+                        self.server.run(ram=self.ram, recover=True)
+                        break
+                    except Exception as e:
+                        reason = f"server failed to start: {e!r}"
+                        failures = self.recover(self.server.pid(), reason)
+
+            restarts = self.state().get("restarts", 0) + 1
+            self.write_state(state="running", started=time.time(), restarts=restarts)
+            pid = self.server.pid()
+
+        Cmd.rm(self.pid_fname, force=True)
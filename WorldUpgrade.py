@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import json
+import os
+import pathlib
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+from cprint import *
+from defs import *
+from Cmd import Cmd
+from Saga import Saga
+
+# printed by --forceUpgrade about once a second, separately for chunks,
+# entities and poi on newer versions
+PROGRESS = re.compile(r"(\d+)% completed \((\d+) / (\d+) chunks\)")
+DONE = re.compile(r"Done \([\d.,]+s\)!")
+# world files taken from upgraded copy unless live server changed them
+REGION = re.compile(r"(^|/)(region|entities|poi)/r\.-?\d+\.-?\d+\.mca$")
+
+
+class WorldUpgrade:
+    """
+    upgrade copy of server world to new version in background, while server
+    keeps running on old one
+
+    world is cloned to upgrades/<name> (reflinked where filesystem allows) and
+    server of new version runs there with --forceUpgrade on free port, it is
+    stopped as soon as it is up. finished upgrade is applied right away if
+    server is stopped, otherwise on it's next start: region files server did
+    not change since copy are taken from upgraded world, everything else from
+    live one, so nothing played meanwhile is lost. then upgraded world and
+    new VERSION are swapped in
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.folder = f"{Folder.UPGRADES}/{server.name}"
+        self.state_fname = f"{self.folder}/UPGRADE.json"
+        self.manifest_fname = f"{self.folder}/manifest.json"
+        self.pid_fname = f"{self.folder}/UPGRADE_PID"
+        self.log_fname = f"{self.folder}/upgrade.log"
+        level = server.properties().get("level-name") or "world"
+        self.world = f"{server.folder}/{Folder.DATA}/{level}"
+        self.copy = f"{self.folder}/{Folder.DATA}/{level}"
+
+    def active(self) -> bool:
+        return pathlib.Path(self.state_fname).exists()
+
+    def state(self) -> dict:
+        try:
+            return json.loads(Cmd.fread(self.state_fname))
+        except FileNotFoundError:
+            return {}
+
+    def write_state(self, **kwargs):
+        state = self.state() | kwargs
+        tmp_fname = f"{self.state_fname}.tmp"
+        Cmd.fwrite(tmp_fname, Cmd.jdump(state, indent=4))
+        os.replace(tmp_fname, self.state_fname)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        upgrade is applied either by worker or by starting server, not both
+        """
+        Cmd.mkdir(Folder.UPGRADES)
+        with open(f"{Folder.UPGRADES}/{self.server.name}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def upgraded_server(self, version: str):
+        """
+        server of new version living in upgrade folder
+        """
+        server = type(self.server)(self.server.name, version)
+        server.folder = self.folder
+        return server
+
+    @classmethod
+    def stat(cls, path: str) -> list[int]:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def regions(self, world: str) -> dict[str, list[int]]:
+        """
+        size and mtime of region files of world by path relative to it
+        """
+        regions = {}
+        for root, _, files in os.walk(world, followlinks=True):
+            for name in files:
+                rel = os.path.relpath(os.path.join(root, name), world)
+                if REGION.search(rel):
+                    regions[rel] = self.stat(os.path.join(root, name))
+        return regions
+
+    def prepare(self, version: str, erase_cache: bool, port: int):
+        """
+        copy world and configs to upgrade folder
+        """
+        Cmd.rm(self.folder, recursive=True, force=True)
+        data = f"{self.server.folder}/{Folder.DATA}"
+        Cmd.mkdir(f"{self.folder}/{Folder.DATA}")
+        if os.stat(self.folder).st_dev != os.stat(data).st_dev:
+            FAIL(f"{Folder.UPGRADES} and {Folder.WORLDS} are on different filesystems")
+            raise MCInvalidOperationError()
+
+        for name in os.listdir(data):
+            if os.path.isfile(f"{data}/{name}"):
+                shutil.copy2(f"{data}/{name}", f"{self.folder}/{Folder.DATA}")
+
+        start = time.monotonic()
+        stats = self.server.snapshot(self.world, self.copy, ("session.lock",))
+        # copies keep size and mtime of live files, so region files server
+        # writes after they were copied are told by them and taken from live
+        # world when upgrade is applied
+        Cmd.fwrite(self.manifest_fname, Cmd.jdump(self.regions(self.copy)))
+        INFO(
+            f'{stats["bytes"] >> 20}MB in {time.monotonic() - start:.1f}s: '
+            f'{stats["reflink"]} files reflinked, {stats["copy"]} copied'
+        )
+
+        server = self.upgraded_server(version)
+        server.set_property("server-port", str(port))
+        server.set_property("query.port", str(port))
+        server.set_property("enable-query", "false")
+        server.set_property("enable-rcon", "false")
+        self.write_state(
+            state="copied",
+            version=version,
+            old_version=self.server.version,
+            erase_cache=erase_cache,
+            started=time.time(),
+        )
+
+    def start_daemon(self):
+        from Daemon import daemon
+
+        main = pathlib.Path(__file__).absolute().parent / "main.py"
+        cmd = [sys.executable, str(main), Action.UPGRADE_WORKER]
+        daemon(
+            [*cmd, "--name", self.server.name],
+            stdout=f"{self.folder}/worker.log",
+            pidfile=self.pid_fname,
+            cwd=os.getcwd(),
+        )
+        Cmd.wait_for_file(self.pid_fname)
+        OK(f"upgrade worker started with pid {Cmd.fread(self.pid_fname)}")
+
+    def cancel(self):
+        """
+        kill upgrade in progress and remove it's copy of world
+        """
+        state = self.state()
+        # pid of finished upgrade may be taken by other process already
+        pids = [state.get("java_pid")] if state.get("state") == "upgrading" else []
+        if pathlib.Path(self.pid_fname).exists():
+            pids.append(int(Cmd.fread(self.pid_fname)))
+        for pid in filter(None, pids):
+            if Cmd.kill(pid, signal.SIGKILL):
+                Cmd.waitpid(pid, timeout_mins=1)
+        Cmd.rm(self.folder, recursive=True, force=True)
+
+    def run_upgrade(self, state: dict) -> bool:
+        """
+        run new version on copy until it upgraded world and became online
+        """
+        cmd = self.upgraded_server(state["version"]).java_cmd()
+        cmd.append("--forceUpgrade")
+        if state["erase_cache"]:
+            cmd.append("--eraseCache")
+        cmd.append("nogui")
+        Cmd.echo(*cmd)
+
+        proc = subprocess.Popen(
+            cmd,
+            cwd=f"{self.folder}/{Folder.DATA}",
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        self.write_state(state="upgrading", java_pid=proc.pid)
+        done = False
+        reported = 0.0
+        with open(self.log_fname, "w") as log:
+            for line in proc.stdout:
+                log.write(line)
+                log.flush()
+                match = PROGRESS.search(line)
+                if match and time.monotonic() - reported >= Upgrade.STATE_SECS:
+                    reported = time.monotonic()
+                    self.write_state(
+                        progress=int(match[1]),
+                        chunks=int(match[2]),
+                        total=int(match[3]),
+                    )
+                elif not done and DONE.search(line):
+                    done = True
+                    self.write_state(progress=100)
+                    proc.stdin.write("stop\n")
+                    proc.stdin.flush()
+        return proc.wait() == 0 and done
+
+    def loop(self):
+        """
+        body of upgrade worker daemon
+        """
+        from RamWorld import RamWorld
+
+        state = self.state()
+        start = time.monotonic()
+        INFO(f"upgrading world of {self.server.name} to {state['version']}")
+        if not self.run_upgrade(state):
+            self.write_state(state="failed")
+            FAIL(f"upgrade failed, see {self.log_fname}")
+            Cmd.rm(self.pid_fname, force=True)
+            return
+        self.write_state(state="ready", secs=round(time.monotonic() - start, 1))
+        OK(f"world upgraded in {time.monotonic() - start:.1f}s")
+
+        with self.lock():
+            if self.server.is_running() or RamWorld(self.server).active():
+                INFO("server is running, upgrade will be applied on it's next start")
+            else:
+                self.apply()
+        Cmd.rm(self.pid_fname, force=True)
+
+    def merge(self, manifest: dict[str, list[int]]) -> tuple[int, int]:
+        """
+        bring to upgraded world everything live server changed since copy
+        returns number of files taken from upgrade and from live world
+        """
+        upgraded = live = 0
+        current = set()
+        for root, _, files in os.walk(self.world):
+            for name in files:
+                src = os.path.join(root, name)
+                rel = os.path.relpath(src, self.world)
+                dst = os.path.join(self.copy, rel)
+                current.add(rel)
+                if name == "session.lock":
+                    continue
+                if REGION.search(rel) and manifest.get(rel) == self.stat(src):
+                    if os.path.exists(dst):
+                        upgraded += 1
+                        continue
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                if not Cmd.reflink(src, dst):
+                    shutil.copy2(src, dst)
+                live += 1
+
+        # regions removed from live world meanwhile
+        for rel in manifest.keys() - current:
+            Cmd.rm(os.path.join(self.copy, rel), force=True)
+        return upgraded, live
+
+    def apply(self) -> str | None:
+        """
+        swap upgraded world and VERSION in, returns new version
+        must be called with lock held while server is stopped
+        """
+        state = self.state()
+        if state.get("state") != "ready":
+            return None
+
+        with STEP(f"applying upgrade of {self.server.name} to {state['version']}"):
+            manifest = json.loads(Cmd.fread(self.manifest_fname))
+            upgraded, live = self.merge(manifest)
+            INFO(f"{upgraded} upgraded region files, {live} files changed meanwhile")
+
+            old = f"{self.world}.old"
+            Cmd.rm(old, recursive=True, force=True)
+            with Saga() as saga:
+                Cmd.echo("mv", self.world, old)
+                os.rename(self.world, old)
+                saga.compensation(lambda: os.rename(old, self.world))
+                Cmd.echo("mv", self.copy, self.world)
+                os.rename(self.copy, self.world)
+                saga.compensation(lambda: os.rename(self.world, self.copy))
+                Cmd.fwrite(f"{self.server.folder}/VERSION", state["version"])
+
+            self.server.version = state["version"]
+            Cmd.rm(old, self.folder, recursive=True, force=True)
+        OK(f"server {self.server.name} upgraded to {state['version']}")
+        return state["version"]
+
+    def show(self) -> dict:
+        state = self.state()
+        if not state:
+            OK(f"no upgrade of {self.server.name} in progress")
+            return state
+        message = f"upgrade to {state['version']}: {state['state']}"
+        if state["state"] == "upgrading" and "progress" in state:
+            message += (
+                f", {state['progress']}% "
+                f"({state['chunks']} / {state['total']} chunks)"
+            )
+        elif state["state"] == "ready":
+            message += f" in {state['secs']}s, applied on next start"
+        elif state["state"] == "failed":
+            message += f", see {self.log_fname}"
+        log(message)
+        return state
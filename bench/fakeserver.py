@@ -0,0 +1,96 @@
+"""
+tiny stand-in for minecraft server, run instead of `java -jar server.jar`
+
+reads server-port from server.properties in working directory, answers
+server list ping on it, prints "Done" when ready, echoes every command read
+from stdin and exits on "stop"
+"""
+
+import json
+import socket
+import sys
+import threading
+
+STATUS = json.dumps(
+    {
+        "version": {"name": "fake", "protocol": 0},
+        "players": {"online": 0, "max": 20},
+        "description": "fake server",
+    }
+).encode()
+
+
+def read_varint(f) -> int:
+    value = 0
+    for shift in range(0, 35, 7):
+        byte = f.read(1)
+        if not byte:
+            raise EOFError()
+        value |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return value
+    raise ValueError("varint is too long")
+
+
+def varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def packet(packet_id: int, payload: bytes) -> bytes:
+    body = varint(packet_id) + payload
+    return varint(len(body)) + body
+
+
+def answer(conn: socket.socket):
+    with conn, conn.makefile("rb") as f:
+        try:
+            while True:
+                data = f.read(read_varint(f))
+                packet_id = data[0]
+                if packet_id == 0 and len(data) == 1:
+                    conn.sendall(packet(0, varint(len(STATUS)) + STATUS))
+                elif packet_id == 1:
+                    conn.sendall(packet(1, data[1:]))
+                    return
+        except (EOFError, OSError, IndexError, ValueError):
+            pass
+
+
+def listen(sock: socket.socket):
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=answer, args=(conn,), daemon=True).start()
+
+
+def main():
+    port = 25565
+    with open("server.properties") as f:
+        for line in f:
+            key, _, value = line.strip().partition("=")
+            if key == "server-port" and value:
+                port = int(value)
+
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", port))
+    sock.listen(16)
+    threading.Thread(target=listen, args=(sock,), daemon=True).start()
+    print('[Server thread/INFO]: Done (0.001s)! For help, type "help"', flush=True)
+    for line in sys.stdin:
+        cmd = line.strip()
+        print(f"[Server thread/INFO]: {cmd}", flush=True)
+        if cmd.startswith("save-all"):
+            print("[Server thread/INFO]: Saved the game", flush=True)
+        if cmd == "stop":
+            print("[Server thread/INFO]: Stopping server", flush=True)
+            return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/bin/python3
+"""
+measure manager's own cost of create, run, send_cmd, stop, list and ps with
+fake server instead of java (see fakeserver.py), so no jars are needed
+
+usage (from repository root):
+    python3 bench/overhead.py [--scales 1,100,1000] [--sample N] [--save]
+
+every scale runs in fresh temporary workspace with that many servers
+created. run, send_cmd and stop are measured on --sample of them, list and ps
+with all servers created and sample of them running. operations run
+in-process, interpreter startup is measured by startup.py
+
+results are compared with baseline.overhead.json next to this script, --save
+replaces it. exits with 1 if some timing is worse than baseline by more than
+--tolerance. baseline depends on machine, save it on the one you compare on
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).absolute().parent.parent
+BASELINE = pathlib.Path(__file__).absolute().parent / "baseline.overhead.json"
+VERSION = "1.21.4"
+PORT = 30000
+# metrics where bigger value is better, others are timings
+HIGHER_IS_BETTER = ("send_cmd_per_sec",)
+# timings differing less than that are noise, not regression
+NOISE_MS = 1.0
+
+sys.path.insert(0, str(ROOT))
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    hide output of manager and processes it starts, errors are printed if
+    operation fails
+    """
+    from cprint import capture
+
+    errors = []
+
+    def sink(kind: str, text: str):
+        if kind in ("FAIL", "FAILED"):
+            errors.append(text)
+
+    sys.stdout.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        with capture(sink):
+            yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in (*saved, devnull):
+            os.close(fd)
+        for error in errors:
+            print(f"error: {error}")
+
+
+def timed(f, *args) -> float:
+    with quiet():
+        start = time.perf_counter()
+        f(*args)
+        return (time.perf_counter() - start) * 1000
+
+
+def workspace() -> str:
+    """
+    directory to run manager in, with fake java first in PATH and fake jar
+    """
+    path = tempfile.mkdtemp(prefix="mc-bench-")
+    for fname in ("server.properties.json", "config.json"):
+        shutil.copy(ROOT / fname, path)
+    os.makedirs(f"{path}/cores/vanilla")
+    pathlib.Path(f"{path}/cores/vanilla/{VERSION}.jar").touch()
+
+    os.makedirs(f"{path}/bin")
+    java = f"{path}/bin/java"
+    with open(java, "w") as f:
+        f.write(f"#!/bin/sh\nexec {sys.executable} {ROOT}/bench/fakeserver.py\n")
+    os.chmod(java, 0o755)
+    return path
+
+
+def summary(times: list[float]) -> float:
+    return round(statistics.median(times), 3)
+
+
+def bench_scale(n: int, sample: int, commands: int, runs: int) -> dict:
+    import Manager
+    from Server import IServer
+
+    names = [f"bench-{i}" for i in range(n)]
+    sample = names[: min(n, sample)]
+    result = {}
+
+    create = []
+    for i, name in enumerate(names):
+        create.append(timed(Manager.create_server, "vanilla", name, VERSION))
+        server = IServer.get(name)
+        server.set_property("server-port", str(PORT + i))
+        server.set_property("query.port", str(PORT + i))
+    result["create_ms"] = summary(create)
+
+    try:
+        result["run_ms"] = summary(
+            [timed(Manager.run_server, s, False) for s in sample]
+        )
+
+        start = time.perf_counter()
+        for i in range(commands):
+            timed(Manager.send_cmd, sample[0], f"say {i}")
+        secs = time.perf_counter() - start
+        result["send_cmd_per_sec"] = round(commands / secs, 1)
+
+        result["list_ms"] = summary([timed(Manager.list_servers) for _ in range(runs)])
+        result["ps_ms"] = summary(
+            [timed(Manager.list_servers, True) for _ in range(runs)]
+        )
+        result["stop_ms"] = summary([timed(Manager.stop_server, s) for s in sample])
+    finally:
+        for name in sample:
+            if IServer.get(name).is_running():
+                with contextlib.suppress(Exception), quiet():
+                    Manager.stop_server(name, kill=True)
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    print results next to baseline, returns False on regression
+    """
+    ok = True
+    print(f"{'servers':>8} {'metric':18} {'value':>10} {'baseline':>10} {'change':>8}")
+    for scale, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(scale, {}).get(metric)
+            line = f"{scale:>8} {metric:18} {value:10.2f}"
+            if old:
+                change = value / old - 1
+                worse = -change if metric in HIGHER_IS_BETTER else change
+                line += f" {old:10.2f} {change:+8.0%}"
+                noise = metric not in HIGHER_IS_BETTER and value - old < NOISE_MS
+                if worse > tolerance and not noise:
+                    line += "  REGRESSION"
+                    ok = False
+            print(line)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scales", default="1,100,1000", help="numbers of servers to test with"
+    )
+    parser.add_argument(
+        "--sample", type=int, default=10, help="servers to run and stop per scale"
+    )
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=10, help="list and ps runs")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown against baseline",
+    )
+    parser.add_argument("--save", action="store_true", help="save results as baseline")
+    args = parser.parse_args()
+
+    results = {}
+    cwd = os.getcwd()
+    for n in map(int, args.scales.split(",")):
+        path = workspace()
+        os.environ["PATH"] = f"{path}/bin{os.pathsep}{os.environ['PATH']}"
+        os.chdir(path)
+        try:
+            print(f"benchmarking with {n} servers in {path}", flush=True)
+            results[str(n)] = bench_scale(n, args.sample, args.commands, args.runs)
+        finally:
+            os.chdir(cwd)
+            os.environ["PATH"] = os.environ["PATH"].split(os.pathsep, 1)[1]
+            shutil.rmtree(path, ignore_errors=True)
+
+    baseline = {}
+    if BASELINE.exists():
+        baseline = json.loads(BASELINE.read_text())["results"]
+    ok = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        data = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "results": results,
+        }
+        BASELINE.write_text(json.dumps(data, indent=4) + "\n")
+        print(f"baseline saved to {BASELINE}")
+    elif not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
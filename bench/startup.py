@@ -0,0 +1,95 @@
+#!/bin/python3
+"""
+measure wall time of main.py invocations
+
+usage (from repository root):
+    python3 bench/startup.py [--runs N] [--daemon]
+
+with --daemon control daemon is started first, so list and ps are
+forwarded to it through thin client path
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).absolute().parent.parent
+SOCKET = ROOT / "manager.sock"
+ACTIONS = ["help", "list", "ps"]
+
+
+def measure(action: str, runs: int, env: dict) -> list[float]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "main.py", action],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def start_daemon() -> subprocess.Popen:
+    if SOCKET.exists():
+        print(f"{SOCKET} exists, is control daemon already running?")
+        sys.exit(1)
+    proc = subprocess.Popen(
+        [sys.executable, "main.py", "serve"],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while not SOCKET.exists():
+        if time.time() > deadline:
+            proc.kill()
+            print("control daemon did not start")
+            sys.exit(1)
+        time.sleep(0.05)
+    return proc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--daemon", action="store_true")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    daemon = None
+    if args.daemon:
+        daemon = start_daemon()
+        env.pop("MC_LOCAL", None)
+    else:
+        env["MC_LOCAL"] = "1"
+
+    try:
+        print(
+            f"{'action':8} {'min':>8} {'median':>8} {'max':>8}  (ms, {args.runs} runs)"
+        )
+        for action in ACTIONS:
+            times = measure(action, args.runs, env)
+            print(
+                f"{action:8} {min(times):8.1f} {statistics.median(times):8.1f} "
+                f"{max(times):8.1f}"
+            )
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+            SOCKET.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
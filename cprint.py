@@ -1,11 +1,48 @@
 import sys
 from contextlib import contextmanager
-from typing import NoReturn
+from contextvars import ContextVar
+from typing import Callable, NoReturn
 
 from MCException import *
+from Trace import span
+
+# optional per-context receiver of printed messages, used to capture output of
+# operations running in-process (e.g. in telegram bot worker threads)
+_sink: ContextVar[Callable[[str, str], None] | None] = ContextVar(
+    "cprint_sink", default=None
+)
+
+
+@contextmanager
+def capture(sink: Callable[[str, str], None]):
+    """
+    call sink(kind, text) for every message printed in current context
+    kind is one of: LOG, STEP, DONE, FAILED, DBUG, INFO, OK, WARN, FAIL, CMD
+    """
+    outer = _sink.get()
+    if outer is not None:
+        # nested capture, messages are still delivered to outer receiver
+        inner = sink
+
+        def sink(kind: str, text: str):
+            inner(kind, text)
+            outer(kind, text)
+
+    token = _sink.set(sink)
+    try:
+        yield
+    finally:
+        _sink.reset(token)
+
+
+def emit(kind: str, *args):
+    sink = _sink.get()
+    if sink is not None:
+        sink(kind, " ".join(str(arg) for arg in args))
 
 
 def log(*args, **kwargs):
+    emit("LOG", *args)
     print(*args, **kwargs, flush=True)
 
 
@@ -34,37 +71,47 @@ def cprint(color, *args, **kwargs):
 
 @contextmanager
 def STEP(*args, **kwargs):
+    emit("STEP", *args)
     cprint("yellow")
     cprint("yellow", *args, **kwargs)
 
-    try:
-        yield
-        OK("done", *args, **kwargs)
-    except Exception:
-        FAIL("failed", *args, **kwargs)
-        raise
+    with span(" ".join(str(arg) for arg in args)):
+        try:
+            yield
+            emit("DONE", *args)
+            OK("done", *args, **kwargs)
+        except Exception:
+            emit("FAILED", *args)
+            FAIL("failed", *args, **kwargs)
+            raise
 
 
 def DEBUG(*args, **kwargs):
+    emit("DBUG", *args)
     cprint("bwhite", "[DBUG]:", *args, **kwargs)
 
 
 def INFO(*args, **kwargs):
+    emit("INFO", *args)
     cprint("bblue", "[INFO]:", *args, **kwargs)
 
 
 def OK(*args, **kwargs):
+    emit("OK", *args)
     cprint("bgreen", "[ OK ]:", *args, **kwargs)
 
 
 def WARN(*args, **kwargs):
+    emit("WARN", *args)
     cprint("byellow", "[WARN]:", *args, **kwargs)
 
 
 def FAIL(*args, **kwargs):
+    emit("FAIL", *args)
     cprint("bred", "[FAIL]:", *args, **kwargs)
 
 
 def ABORT(*args, **kwargs) -> NoReturn:
+    emit("FAIL", *args)
     cprint("bred", "[INTERNAL_ERROR]:", *args, **kwargs)
     raise MCInternalError()
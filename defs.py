@@ -6,12 +6,26 @@ class LauncherType:
 class Fname:
     VERSIONS_VANILLA = f"versions.{LauncherType.VANILLA}.json"
     VERSIONS_FORGE = f"versions.{LauncherType.FORGE}.json"
+    VERSIONS = {
+        LauncherType.VANILLA: VERSIONS_VANILLA,
+        LauncherType.FORGE: VERSIONS_FORGE,
+    }
+    SOCKET = "manager.sock"
+    HOSTS = "hosts.json"
+    AGENT_KEY = "agent.key"
+    SCHEDULE = "schedule.json"
+    SCHEDULE_STATE = "schedule.state.json"
+    SCHEDULE_LOCK = "schedule.lock"
+    ROUTES = "routes.json"
+    PROXY_STATS = "proxy.stats.json"
 
 
 class Folder:
     SERVERS = "cores"
     WORLDS = "worlds"
     DATA = "data"
+    JOURNAL = "journal"
+    UPGRADES = "upgrades"
 
 
 class Java:
@@ -28,9 +42,275 @@ class Action:
     RUN = "run"
     STOP = "stop"
     CMD = "cmd"
+    SAVE = "save"
+    SHUTDOWN_ALL = "shutdown-all"
     BACKUP = "backup"
     RESTORE = "restore"
     LIST = "list"
     LIST_RUNNING = "ps"
     LIST_VERSIONS = "list-versions"
     UPDATE_VERSIONS = "update-versions"
+    SERVE = "serve"
+    JOURNAL = "journal"
+    RAM_SYNC = "ram-sync"
+    COMPACT = "compact"
+    CLONE = "clone"
+    AGENT = "agent"
+    RESOURCES = "resources"
+    FLEET_LIST = "fleet-list"
+    WATCHDOG = "watchdog"
+    SCHEDULE = "schedule"
+    PROFILE = "profile"
+    PROXY = "proxy"
+    PROXY_STATS = "proxy-stats"
+    UPGRADE = "upgrade"
+    UPGRADE_WORKER = "upgrade-worker"
+
+
+class Env:
+    # set to run every command in current process, ignoring control daemon
+    LOCAL = "MC_LOCAL"
+    # launcher version manifest url, may be file path of local stand-in
+    MANIFEST = "MC_VERSION_MANIFEST"
+    # command run with alert message as last argument, e.g. webhook script
+    ALERT_CMD = "MC_ALERT_CMD"
+    # forge version lists and maven repository, may be local stand-ins
+    FORGE_PROMOTIONS = "MC_FORGE_PROMOTIONS"
+    FORGE_METADATA = "MC_FORGE_METADATA"
+    FORGE_MAVEN = "MC_FORGE_MAVEN"
+
+
+class Status:
+    HOST = "127.0.0.1"
+    PORT = 25565
+    TIMEOUT_SECS = 2
+    CACHE_TTL_SECS = 10
+    MAX_PACKET = 2**21
+    WORKERS = 16
+
+
+class Mojang:
+    MANIFEST_URL = "https://piston-meta.mojang.com/mc/game/version_manifest_v2.json"
+    TIMEOUT_SECS = 10
+    WORKERS = 8
+
+
+class Forge:
+    PROMOTIONS_URL = (
+        "https://files.minecraftforge.net/net/minecraftforge/forge/promotions_slim.json"
+    )
+    METADATA_URL = (
+        "https://files.minecraftforge.net/net/minecraftforge/forge/maven-metadata.json"
+    )
+    MAVEN_URL = "https://maven.minecraftforge.net/net/minecraftforge/forge"
+    # library store shared by installations of all forge versions
+    LIBRARIES = "libraries"
+    # written to installation folder when it is complete
+    LAUNCH = "LAUNCH.json"
+    WORKERS = 16
+    TIMEOUT_SECS = 30
+    INSTALL_TIMEOUT_MINS = 20
+
+
+class Bot:
+    WORKERS = 4
+    # read-only queries run on their own threads, not behind long operations
+    QUERY_WORKERS = 4
+    PROGRESS_INTERVAL_SECS = 1
+    MAX_MESSAGE = 4000
+
+
+class Event:
+    CONSOLE = "console"
+    JOIN = "join"
+    LEAVE = "leave"
+    DEATH = "death"
+    CRASH = "crash"
+    LAG = "lag"
+    ALL = (JOIN, LEAVE, DEATH, CRASH, LAG)
+
+
+class Stream:
+    # log is followed with inotify, this is only safety re-check interval
+    IDLE_SECS = 30
+    FLUSH_SECS = 3
+    MAX_PENDING = 200
+    CHAT_RATE = 1
+    CHAT_BURST = 3
+    GLOBAL_RATE = 25
+    GLOBAL_BURST = 30
+
+
+class Fleet:
+    JOBS = 4
+    STAGGER_SECS = 10
+
+
+class Agent:
+    HOST = "0.0.0.0"
+    PORT = 25600
+    CONNECT_TIMEOUT_SECS = 5
+    WORKERS = 16
+    # signed request line is argv with challenge and mac, never that long
+    MAX_REQUEST = 1 << 16
+    # connections must authenticate within that time, only that many at once
+    AUTH_TIMEOUT_SECS = 10
+    MAX_UNAUTHENTICATED = 64
+    # hosts with less available memory do not get new servers
+    MIN_FREE_MB = 1024
+    # templates copied to agent root if it has none
+    TEMPLATES = ("server.properties.json", "config.json")
+
+
+class Proxy:
+    HOST = "0.0.0.0"
+    PORT = 25565
+    BACKLOG = 4096
+    # handshake is a few hundred bytes, anything longer is not minecraft
+    MAX_HANDSHAKE = 1024
+    HANDSHAKE_TIMEOUT_SECS = 10
+    CONNECT_TIMEOUT_SECS = 3
+    ROUTES_SECS = 5
+    STATS_SECS = 5
+
+
+class Restart:
+    CHECK_SECS = 10
+    # server is hung after that many failed pings in a row without any output
+    PING_FAILURES = 6
+    MIN_BACKOFF_SECS = 1
+    MAX_BACKOFF_SECS = 300
+    # give up after that many failures within window
+    MAX_FAILURES = 5
+    WINDOW_SECS = 3600
+    TERM_TIMEOUT_SECS = 30
+    TAIL_LINES = 200
+    MAX_INCIDENTS = 20
+
+
+class Profile:
+    CHECK_SECS = 10
+    # "tick query" is sent that often on versions supporting it
+    MSPT_QUERY_SECS = 30
+    # tick takes 50ms at most to keep 20 tps
+    MSPT_SPIKE = 50
+    # lag spikes are captured at most that often
+    MIN_INTERVAL_SECS = 900
+    JFR_SECS = 30
+    JFR_MAX_MB = 50
+    # oldest captures are removed when all of them take more than that
+    MAX_MB = 500
+    JCMD_TIMEOUT_MINS = 1
+
+
+class Warm:
+    BUDGET_MB = 1024
+    # part of available memory warm-up may take at most
+    MAX_FILL = 0.5
+    # regions around spawn, loaded before recently written ones
+    SPAWN_RADIUS = 1
+    JOBS = 8
+
+
+class Upgrade:
+    # progress of --forceUpgrade is written to state file at most that often
+    STATE_SECS = 2
+
+
+class Io:
+    # pace of background copies while server runs, bytes per second
+    START_RATE = 32 << 20
+    MIN_RATE = 2 << 20
+    # no limit at all above that
+    MAX_RATE = 512 << 20
+    ADJUST_SECS = 2
+    # "tick query" reports mspt since 1.20.3
+    TICK_QUERY_VERSION = (1, 20, 3)
+    MSPT_QUERY_SECS = 10
+    # tick takes 50ms at most to keep 20 tps
+    MSPT_HIGH = 40
+    MSPT_LOW = 20
+    IONICE = ("ionice", "-c", "2", "-n", "7")
+    CGROUP = "/sys/fs/cgroup"
+    CHUNK = 1 << 20
+
+
+class Timer:
+    # schedule file is checked for changes at least that often
+    RELOAD_SECS = 30
+    # tasks of one concurrency group running at a time, unless configured
+    GROUP_JOBS = 2
+    MAX_MISSED = 10000
+
+
+class Shutdown:
+    MESSAGE = "server is shutting down for maintenance"
+    WARN_SECS = 10
+    STOP_TIMEOUT_SECS = 120
+    TERM_TIMEOUT_SECS = 30
+    KILL_TIMEOUT_SECS = 10
+
+
+class Wait:
+    # backoff used when inotify is not available
+    MIN_BACKOFF_SECS = 0.05
+    MAX_BACKOFF_SECS = 2
+
+
+class Fs:
+    RM_JOBS = 8
+    # smaller trees are removed by shutil.rmtree on one thread
+    RM_PARALLEL_MIN_FILES = 1000
+    COPY_JOBS = 8
+
+
+class Clone:
+    # runtime files of source server, relative to server folder
+    SKIP = (
+        "PID",
+        "KEEPER_PID",
+        "stdin.fifo",
+        "history.txt",
+        "stdout.log",
+        "STATUS.json",
+        "RAM_*",
+        "ram-sync.log",
+        "WATCHDOG*",
+        "watchdog.log",
+        "incidents",
+        "PROFILER_PID",
+        "profiler.log",
+        "profiles",
+        "*/session.lock",
+    )
+    # files server never modifies in place, safe to share between servers
+    HARDLINK = ("*.jar", "*.zip", "*.gz")
+    # ports of new servers are searched starting from Status.PORT
+    MAX_PORT = 65535
+
+
+class Ram:
+    ROOT = "/dev/shm/minecraft"
+    SYNC_SECS = 300
+    SAVE_TIMEOUT_SECS = 60
+    # refuse to fill memory-backed filesystem more than that
+    MAX_FILL = 0.8
+
+
+class Git:
+    # modes of entries in git ls-tree
+    TREE = "040000"
+    SYMLINK = "120000"
+
+
+class Anvil:
+    SECTOR = 4096
+    CHUNKS = 1024
+    # longer chunks are stored in external .mcc files
+    MAX_SECTORS = 255
+    COMPRESSION = ("keep", "deflate", "lz4", "none")
+    # first version which reads lz4 compressed chunks
+    LZ4_VERSION = (1, 20, 5)
+    # region files of the same coordinates in these folders belong together
+    REGION_FOLDERS = ("region", "entities", "poi")
+    DIMENSIONS = {"overworld": ".", "nether": "DIM-1", "end": "DIM1"}
@@ -3,17 +3,59 @@
 from __future__ import annotations
 
 import argparse
+import os
+import sys
 
-import Manager
-from Enviroment import Enviroment, IEnviroment
 from cprint import *
 from defs import *
+from Trace import span
+
+# actions which are never forwarded to control daemon
+# shutdown-all must work as systemd ExecStop even if daemon is stopping already
+LOCAL_ACTIONS = (
+    Action.HELP,
+    Action.SERVE,
+    Action.DEPENDENCIES,
+    Action.SHUTDOWN_ALL,
+    Action.RAM_SYNC,
+    Action.WATCHDOG,
+    Action.PROFILE,
+    Action.UPGRADE_WORKER,
+    Action.AGENT,
+    Action.FLEET_LIST,
+    Action.PROXY,
+)
 
 
 def add_name_argument(subparser):
     subparser.add_argument("--name", required=True)
 
 
+def add_selector_arguments(subparser, stagger=False):
+    selector = subparser.add_mutually_exclusive_group(required=True)
+    selector.add_argument("--name", help="server name or glob pattern, e.g. 'test-*'")
+    selector.add_argument("--all", action="store_true", help="select all servers")
+    subparser.add_argument(
+        "--running", action="store_true", help="select only running servers"
+    )
+    subparser.add_argument(
+        "--jobs",
+        type=int,
+        default=Fleet.JOBS,
+        help=f"how many servers to process in parallel (default {Fleet.JOBS})",
+    )
+    if stagger:
+        subparser.add_argument(
+            "--stagger",
+            type=float,
+            default=Fleet.STAGGER_SECS,
+            help=(
+                "minimal delay in seconds between server starts "
+                f"(default {Fleet.STAGGER_SECS})"
+            ),
+        )
+
+
 def add_launcher_argument(subparser):
     subparser.add_argument("--launcher", choices=["vanilla", "forge"], required=True)
 
@@ -36,6 +78,19 @@ def add_create_option(subparsers):
     create.set_defaults(action=Action.CREATE)
 
 
+def add_clone_option(subparsers):
+    clone = subparsers.add_parser(
+        Action.CLONE,
+        help=(
+            "copy existing server (even running) to new one with it's own "
+            "world name and port, using copy-on-write where supported"
+        ),
+    )
+    clone.add_argument("--from", dest="source", required=True, help="server to copy")
+    add_name_argument(clone)
+    clone.set_defaults(action=Action.CLONE)
+
+
 def add_delete_option(subparsers):
     delete = subparsers.add_parser(Action.DELETE, help="delete server")
     # delete.add_argument(
@@ -54,10 +109,103 @@ def add_run_option(subparsers):
         action="store_true",
         help="run server interactively, not as daemon",
     )
-    add_name_argument(run)
+    run.add_argument(
+        "--ram",
+        action="store_true",
+        help=(
+            f"keep world in memory-backed {Ram.ROOT} while server runs, "
+            "syncing it back to disk periodically, on save-all and on stop"
+        ),
+    )
+    run.add_argument(
+        "--recover",
+        action="store_true",
+        help="sync RAM world left by crashed server back to disk before start",
+    )
+    run.add_argument(
+        "--watchdog",
+        action="store_true",
+        help=(
+            "restart server when it crashes or hangs, giving up after "
+            f"{Restart.MAX_FAILURES} failures in {Restart.WINDOW_SECS}s"
+        ),
+    )
+    run.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "take thread dump and java flight recording on lag spikes, "
+            f"at most once in {Profile.MIN_INTERVAL_SECS}s, "
+            "saved to profiles folder of server"
+        ),
+    )
+    run.add_argument(
+        "--warm",
+        nargs="?",
+        type=int,
+        const=Warm.BUDGET_MB,
+        metavar="MB",
+        help=(
+            "read regions around spawn and recently played ones to page cache "
+            f"before start, up to MB (default {Warm.BUDGET_MB})"
+        ),
+    )
+    add_selector_arguments(run, stagger=True)
     run.set_defaults(action=Action.RUN)
 
 
+def add_ram_sync_option(subparsers):
+    # internal action, started by run --ram as background daemon
+    ram_sync = subparsers.add_parser(Action.RAM_SYNC)
+    add_name_argument(ram_sync)
+    ram_sync.set_defaults(action=Action.RAM_SYNC)
+
+
+def add_watchdog_option(subparsers):
+    # internal action, started by run --watchdog as background daemon
+    watchdog = subparsers.add_parser(Action.WATCHDOG)
+    add_name_argument(watchdog)
+    watchdog.add_argument("--ram", action="store_true")
+    watchdog.set_defaults(action=Action.WATCHDOG)
+
+
+def add_profile_option(subparsers):
+    # internal action, started by run --profile as background daemon
+    profile = subparsers.add_parser(Action.PROFILE)
+    add_name_argument(profile)
+    profile.set_defaults(action=Action.PROFILE)
+
+
+def add_upgrade_option(subparsers):
+    upgrade = subparsers.add_parser(
+        Action.UPGRADE,
+        help=(
+            "upgrade server world to new version in background while server "
+            "keeps running, new world and version are swapped in on it's next start"
+        ),
+    )
+    add_name_argument(upgrade)
+    job = upgrade.add_mutually_exclusive_group(required=True)
+    job.add_argument("--version", help="version to upgrade to")
+    job.add_argument("--status", action="store_true", help="show progress of upgrade")
+    job.add_argument(
+        "--cancel", action="store_true", help="stop upgrade and remove it's files"
+    )
+    upgrade.add_argument(
+        "--erase-cache",
+        action="store_true",
+        help="also drop cached lighting and other derived data of world",
+    )
+    upgrade.set_defaults(action=Action.UPGRADE)
+
+
+def add_upgrade_worker_option(subparsers):
+    # internal action, started by upgrade as background daemon
+    worker = subparsers.add_parser(Action.UPGRADE_WORKER)
+    add_name_argument(worker)
+    worker.set_defaults(action=Action.UPGRADE_WORKER)
+
+
 def add_stop_option(subparsers):
     stop = subparsers.add_parser(
         Action.STOP, help="gracefully stop running server saving world data"
@@ -68,20 +216,100 @@ def add_stop_option(subparsers):
         help=(
             "kill server process without saving world. "
             "WARNING: can corrupt world data, use only after "
-            "graceful stop did not work",
+            "graceful stop did not work"
         ),
     )
-    add_name_argument(stop)
+    add_selector_arguments(stop)
     stop.set_defaults(action=Action.STOP)
 
 
 def add_cmd_option(subparsers):
     cmd = subparsers.add_parser(Action.CMD, help="run command to server")
     cmd.add_argument("command", help="command to run on server")
-    add_name_argument(cmd)
+    add_selector_arguments(cmd)
     cmd.set_defaults(action=Action.CMD)
 
 
+def add_save_option(subparsers):
+    save = subparsers.add_parser(
+        Action.SAVE, help="commit server world state to worlds repository"
+    )
+    add_selector_arguments(save)
+    save.set_defaults(action=Action.SAVE)
+
+
+def add_shutdown_all_option(subparsers):
+    shutdown = subparsers.add_parser(
+        Action.SHUTDOWN_ALL,
+        help=(
+            "stop all running servers in parallel before host maintenance, "
+            "suitable for systemd ExecStop"
+        ),
+    )
+    shutdown.add_argument(
+        "--message",
+        default=Shutdown.MESSAGE,
+        help="message broadcasted to players, empty to skip warning",
+    )
+    shutdown.add_argument(
+        "--warn-secs",
+        type=float,
+        default=Shutdown.WARN_SECS,
+        help="delay between warning and stop",
+    )
+    shutdown.add_argument(
+        "--stop-timeout",
+        type=float,
+        default=Shutdown.STOP_TIMEOUT_SECS,
+        help="seconds to wait for graceful stop before sending SIGTERM",
+    )
+    shutdown.add_argument(
+        "--term-timeout",
+        type=float,
+        default=Shutdown.TERM_TIMEOUT_SECS,
+        help="seconds to wait after SIGTERM before sending SIGKILL",
+    )
+    shutdown.set_defaults(action=Action.SHUTDOWN_ALL)
+
+
+def add_journal_option(subparsers):
+    journal = subparsers.add_parser(
+        Action.JOURNAL,
+        help=(
+            "list operations interrupted by process death, rerun the same "
+            "command to resume one or roll it back"
+        ),
+    )
+    journal.add_argument(
+        "--rollback", metavar="OPERATION", help="roll back interrupted operation"
+    )
+    journal.set_defaults(action=Action.JOURNAL)
+
+
+def add_compact_option(subparsers):
+    compact = subparsers.add_parser(
+        Action.COMPACT,
+        help=(
+            "rewrite region files of stopped server removing free space, "
+            "optionally recompressing chunks"
+        ),
+    )
+    add_name_argument(compact)
+    compact.add_argument(
+        "--compression",
+        choices=Anvil.COMPRESSION,
+        default="keep",
+        help="recompress chunks with codec (lz4 needs minecraft 1.20.5+)",
+    )
+    compact.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="how many files to process in parallel (default cpu count)",
+    )
+    compact.set_defaults(action=Action.COMPACT)
+
+
 def add_backup_option(subparsers):
     backup = subparsers.add_parser(
         Action.BACKUP, help="backup existing server to repository"
@@ -91,7 +319,36 @@ def add_backup_option(subparsers):
 
 
 def add_restore_option(subparsers):
-    pass
+    restore = subparsers.add_parser(
+        Action.RESTORE,
+        help=(
+            "roll back regions or block area of stopped server world to "
+            "snapshot made by save, leaving rest of world as it is"
+        ),
+    )
+    add_name_argument(restore)
+    restore.add_argument(
+        "--snapshot",
+        required=True,
+        help="commit of worlds repository, see git -C worlds log",
+    )
+    area = restore.add_mutually_exclusive_group(required=True)
+    area.add_argument(
+        "--region",
+        nargs="+",
+        help="whole region files to restore, as r.<x>.<z>.mca or <x>,<z>",
+    )
+    area.add_argument(
+        "--box",
+        nargs=4,
+        type=int,
+        metavar=("X1", "Z1", "X2", "Z2"),
+        help="restore only chunks of this block area, bounds are inclusive",
+    )
+    restore.add_argument(
+        "--dimension", choices=list(Anvil.DIMENSIONS), default="overworld"
+    )
+    restore.set_defaults(action=Action.RESTORE)
 
 
 def add_list_option(subparsers):
@@ -125,65 +382,336 @@ def add_update_versions_option(subparsers):
     update_versions.set_defaults(action=Action.UPDATE_VERSIONS)
 
 
-def main():
+def add_serve_option(subparsers):
+    serve = subparsers.add_parser(
+        Action.SERVE,
+        help=(
+            "run control daemon, other invocations will forward "
+            "commands to it instead of running them in new process"
+        ),
+    )
+    serve.set_defaults(action=Action.SERVE)
+
+
+def add_agent_option(subparsers):
+    agent = subparsers.add_parser(
+        Action.AGENT,
+        help="run host agent, letting manager on other host control this one",
+    )
+    agent.add_argument(
+        "--listen",
+        default=f"{Agent.HOST}:{Agent.PORT}",
+        help=f"address to listen on (default {Agent.HOST}:{Agent.PORT})",
+    )
+    agent.add_argument(
+        "--root", default=".", help="directory with worlds and cores of this agent"
+    )
+    agent.add_argument(
+        "--key-file",
+        default=Fname.AGENT_KEY,
+        help="shared key file relative to root, generated if missing",
+    )
+    agent.set_defaults(action=Action.AGENT)
+
+
+def add_resources_option(subparsers):
+    resources = subparsers.add_parser(
+        Action.RESOURCES, help="show free memory and cpu load of this host"
+    )
+    resources.set_defaults(action=Action.RESOURCES)
+
+
+def add_fleet_list_option(subparsers):
+    fleet_list = subparsers.add_parser(
+        Action.FLEET_LIST, help=f"list servers of all hosts from {Fname.HOSTS}"
+    )
+    fleet_list.set_defaults(action=Action.FLEET_LIST)
+
+
+def add_proxy_option(subparsers):
+    proxy = subparsers.add_parser(
+        Action.PROXY,
+        help=(
+            "forward players connecting to one port to servers by hostname "
+            "they connect with, e.g. survival.example.com to server survival, "
+            f"or as mapped in {Fname.ROUTES}"
+        ),
+    )
+    proxy.add_argument(
+        "--listen",
+        default=f"{Proxy.HOST}:{Proxy.PORT}",
+        help=(
+            f"address to listen on (default {Proxy.HOST}:{Proxy.PORT}), "
+            "servers must listen on other ports"
+        ),
+    )
+    proxy.add_argument("--default", help="server for hostnames matching no route")
+    proxy.set_defaults(action=Action.PROXY)
+
+
+def add_proxy_stats_option(subparsers):
+    stats = subparsers.add_parser(
+        Action.PROXY_STATS, help="show connection and byte counters of proxy routes"
+    )
+    stats.set_defaults(action=Action.PROXY_STATS)
+
+
+def add_schedule_option(subparsers):
+    schedule = subparsers.add_parser(
+        Action.SCHEDULE,
+        help=(
+            f"show or edit recurring tasks from {Fname.SCHEDULE}, "
+            f"run by control daemon ('{Action.SERVE}')"
+        ),
+    )
+    schedule.set_defaults(action=Action.SCHEDULE, schedule_action="list")
+    actions = schedule.add_subparsers()
+
+    show = actions.add_parser("list", help="show tasks, their last and next runs")
+    show.set_defaults(schedule_action="list")
+
+    add = actions.add_parser(
+        "add",
+        help=(
+            "add or replace task, e.g. "
+            "add --jitter 600 nightly '0 4 * * *' stop --name x ';' run --name x"
+        ),
+    )
+    add.add_argument("id", help="task name")
+    add.add_argument("cron", help="5 field cron expression or @hourly, @daily, ...")
+    add.add_argument(
+        "command",
+        nargs=argparse.REMAINDER,
+        help="main.py arguments, several commands are separated by ';'",
+    )
+    add.add_argument(
+        "--jitter",
+        type=int,
+        default=0,
+        help="delay every run by random number of seconds up to that",
+    )
+    add.add_argument(
+        "--group",
+        default="default",
+        help="concurrency group, limit it with 'schedule limit'",
+    )
+    add.set_defaults(schedule_action="add")
+
+    remove = actions.add_parser("remove", help="remove task")
+    remove.add_argument("id", help="task name")
+    remove.set_defaults(schedule_action="remove")
+
+    limit = actions.add_parser(
+        "limit",
+        help=(
+            "set how many tasks of group run at a time " f"(default {Timer.GROUP_JOBS})"
+        ),
+    )
+    limit.add_argument("group")
+    limit.add_argument("jobs", type=int)
+    limit.set_defaults(schedule_action="limit")
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        help=(
+            f"run command on host agent from {Fname.HOSTS}, "
+            "'auto' chooses host for create by free memory and cpu"
+        ),
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help=(
+            "write timings of steps and commands to FILE in chrome trace "
+            "format and print their summary, command runs in this process"
+        ),
+    )
     subparsers = parser.add_subparsers(required=True)
 
     add_help_option(subparsers)
     add_deps_option(subparsers)
     add_create_option(subparsers)
+    add_clone_option(subparsers)
     add_delete_option(subparsers)
     add_run_option(subparsers)
     add_stop_option(subparsers)
     add_cmd_option(subparsers)
+    add_save_option(subparsers)
+    add_shutdown_all_option(subparsers)
+    add_journal_option(subparsers)
+    add_ram_sync_option(subparsers)
+    add_watchdog_option(subparsers)
+    add_profile_option(subparsers)
+    add_compact_option(subparsers)
     add_backup_option(subparsers)
     add_restore_option(subparsers)
+    add_upgrade_option(subparsers)
+    add_upgrade_worker_option(subparsers)
     add_list_option(subparsers)
     add_list_running_option(subparsers)
     add_list_versions_option(subparsers)
     add_update_versions_option(subparsers)
+    add_serve_option(subparsers)
+    add_agent_option(subparsers)
+    add_resources_option(subparsers)
+    add_fleet_list_option(subparsers)
+    add_proxy_option(subparsers)
+    add_proxy_stats_option(subparsers)
+    add_schedule_option(subparsers)
+    return parser
 
-    args = parser.parse_args()
 
-    match args.action:
-        case Action.HELP:
-            parser.print_help()
-            return
+def is_bulk(args) -> bool:
+    """
+    check if command selects several servers instead of one by exact name
+    """
+    if args.all or args.running:
+        return True
+    return any(c in args.name for c in "*?[")
+
 
+def dispatch(args):
+    # heavy modules are imported only when action really needs them
+    import Manager
+
+    match args.action:
         case Action.CREATE:
             Manager.create_server(args.launcher, args.name, args.version)
 
+        case Action.CLONE:
+            Manager.clone_server(args.source, args.name)
+
         case Action.DELETE:
             Manager.delete_server(args.name)
 
+        case Action.RUN if is_bulk(args):
+            if args.interactive:
+                FAIL("cannot run several servers interactively")
+                raise MCInvalidOperationError()
+            return Manager.bulk_run(
+                args.name,
+                args.running,
+                args.jobs,
+                args.stagger,
+                args.ram,
+                args.recover,
+                args.watchdog,
+                args.profile,
+                args.warm,
+            )
+
         case Action.RUN:
-            Manager.run_server(args.name, args.interactive)
+            Manager.run_server(
+                args.name,
+                args.interactive,
+                args.ram,
+                args.recover,
+                args.watchdog,
+                args.profile,
+                args.warm,
+            )
+
+        case Action.STOP if is_bulk(args):
+            return Manager.bulk_stop(args.name, args.running, args.jobs, args.kill)
 
         case Action.STOP:
-            Manager.stop_server(args.name)
+            Manager.stop_server(args.name, args.kill)
+
+        case Action.CMD if is_bulk(args):
+            return Manager.bulk_cmd(args.name, args.running, args.jobs, args.command)
 
         case Action.CMD:
             Manager.send_cmd(args.name, args.command)
 
+        case Action.SAVE if is_bulk(args):
+            return Manager.bulk_save(args.name, args.running, args.jobs)
+
+        case Action.SAVE:
+            Manager.save_server(args.name)
+
+        case Action.SHUTDOWN_ALL:
+            return Manager.shutdown_all(
+                args.message, args.warn_secs, args.stop_timeout, args.term_timeout
+            )
+
+        case Action.RAM_SYNC:
+            Manager.ram_sync(args.name)
+
+        case Action.WATCHDOG:
+            Manager.watchdog(args.name, args.ram)
+
+        case Action.PROFILE:
+            Manager.profile(args.name)
+
+        case Action.COMPACT:
+            return Manager.compact_server(args.name, args.compression, args.jobs)
+
+        case Action.JOURNAL if args.rollback:
+            Manager.rollback_operation(args.rollback)
+
+        case Action.JOURNAL:
+            return Manager.list_journal()
+
         case Action.BACKUP:
             # Manager.backup_server(args.name)
             pass
 
         case Action.RESTORE:
-            # Manager.restore_server(args.name)
-            pass
+            return Manager.restore_server(
+                args.name, args.snapshot, args.region, args.box, args.dimension
+            )
+
+        case Action.UPGRADE if args.status:
+            return Manager.upgrade_status(args.name)
+
+        case Action.UPGRADE if args.cancel:
+            Manager.cancel_upgrade(args.name)
+
+        case Action.UPGRADE:
+            Manager.upgrade_server(args.name, args.version, args.erase_cache)
+
+        case Action.UPGRADE_WORKER:
+            Manager.upgrade_worker(args.name)
 
         case Action.LIST:
-            Manager.list_servers()
+            return Manager.list_servers()
 
         case Action.LIST_RUNNING:
-            Manager.list_servers(only_running=True)
+            return Manager.list_servers(only_running=True)
 
         case Action.UPDATE_VERSIONS:
             Manager.update_versions(args.launcher)
 
         case Action.LIST_VERSIONS:
-            Enviroment(args.launcher).list_versions(args.show_snapshots)
+            return Manager.list_versions(args.launcher, args.show_snapshots)
+
+        case Action.RESOURCES:
+            return Manager.host_resources()
+
+        case Action.FLEET_LIST:
+            import Hosts
+
+            return Hosts.fleet_list()
+
+        case Action.PROXY_STATS:
+            return Manager.proxy_stats()
+
+        case Action.SCHEDULE if args.schedule_action == "add":
+            Manager.schedule_task(
+                args.id, args.cron, args.command, args.jitter, args.group
+            )
+
+        case Action.SCHEDULE if args.schedule_action == "remove":
+            Manager.unschedule_task(args.id)
+
+        case Action.SCHEDULE if args.schedule_action == "limit":
+            Manager.limit_schedule_group(args.group, args.jobs)
+
+        case Action.SCHEDULE:
+            return Manager.list_schedule()
 
         case Action.DEPENDENCIES:
             Manager.download_dependencies()
@@ -192,8 +720,65 @@ def main():
             ABORT(f"invalid action: {args.action}")
 
 
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.action == Action.HELP:
+        parser.print_help()
+        return
+
+    if args.trace is not None:
+        import Trace
+
+        Trace.enable(args.trace)
+
+    if args.action == Action.SERVE:
+        import Control
+
+        Control.serve()
+        return
+
+    if args.action == Action.AGENT:
+        import Control
+        import Hosts
+
+        host, _, port = args.listen.rpartition(":")
+        Hosts.agent_root(args.root)
+        Control.serve_agent((host or Agent.HOST, int(port)), args.key_file)
+        return
+
+    if args.action == Action.PROXY:
+        import ProxyServer
+
+        host, _, port = args.listen.rpartition(":")
+        ProxyServer.serve((host or Proxy.HOST, int(port)), args.default)
+        return
+
+    if args.host is not None:
+        import Hosts
+
+        Hosts.forward(args.host, sys.argv[1:], args.action)
+        return
+
+    interactive = getattr(args, "interactive", False)
+    # traced command must run here to be traced
+    if args.action not in LOCAL_ACTIONS and not interactive and args.trace is None:
+        if not os.environ.get(Env.LOCAL):
+            import Control
+
+            # thin client mode: let running control daemon do the work
+            if Control.forward(sys.argv[1:]):
+                return
+
+    with span(f"main.py {args.action}", "command", argv=sys.argv[1:]):
+        dispatch(args)
+
+
 if __name__ == "__main__":
     try:
         main()
     except MCError as e:
-        print(e)
+        if str(e):
+            print(e, file=sys.stderr)
+        sys.exit(1)